@@ -0,0 +1,110 @@
+"""
+Compare the JSON codecs main.py can use (orjson / ujson / stdlib) on the
+payloads it actually handles: webhook update bodies (parsed from bytes) and
+the pretty-printed backup document.
+
+    python bench/json_codec.py [--groups 2000] [--users 20000]
+
+Codecs that are not installed are skipped. main is imported only for its
+codec loader; importing it does no network I/O, so dummy settings suffice.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+for _key, _val in (('TOKEN', '1:bench'), ('OWNER_ID', '1'),
+                   ('WEBHOOK_URL', 'https://example.invalid/'), ('REDIS_URL', 'redis://127.0.0.1:1')):
+    os.environ.setdefault(_key, _val)
+
+import main  # noqa: E402
+
+_USER = {'id': 123456789, 'is_bot': False, 'first_name': 'Анна', 'username': 'anna_k', 'language_code': 'ru'}
+_GROUP = {'id': -1001234567890, 'title': 'Music & Lyrics 🎵', 'type': 'supergroup'}
+
+UPDATES = {
+    'group text': {'update_id': 900000001, 'message': {
+        'message_id': 48213, 'from': _USER, 'chat': _GROUP, 'date': 1760000000,
+        'text': 'does anyone have the lyrics for this one? 🎶'}},
+    'group link': {'update_id': 900000002, 'message': {
+        'message_id': 48214, 'from': _USER, 'chat': _GROUP, 'date': 1760000001,
+        'text': 'https://example.com/track/8812', 'entities': [{'offset': 0, 'length': 30, 'type': 'url'}]}},
+    'callback': {'update_id': 900000003, 'callback_query': {
+        'id': '5533887766554433221', 'from': _USER, 'chat_instance': '-8812345678901234567',
+        'data': 'group_menu:-1001234567890',
+        'message': {'message_id': 77, 'from': {'id': 1, 'is_bot': True, 'first_name': 'Minibot'},
+                    'chat': {'id': 123456789, 'type': 'private', 'first_name': 'Анна'}, 'date': 1760000002,
+                    'text': '⚙️ Group settings', 'reply_markup': {'inline_keyboard': [
+                        [{'text': f'Button {i}', 'callback_data': f'action_{i}:-1001234567890'}] for i in range(8)]}}}},
+    'join': {'update_id': 900000004, 'message': {
+        'message_id': 48215, 'from': _USER, 'chat': _GROUP, 'date': 1760000003,
+        'new_chat_members': [_USER], 'new_chat_member': _USER, 'new_chat_participant': _USER}},
+}
+
+
+def backup_document(groups, users):
+    """Same shape as _collect_all_redis_data() output."""
+    data = {'meta': {'bot': 'GroupManagementBot', 'timestamp': '2026-01-01T00:00:00Z', 'version': 1},
+            'scalars': {}, 'sets': {}, 'hashes': {}, 'lists': {}, 'pattern_scalars': {}}
+    data['sets']['groups'] = [str(-1001000000000 - i) for i in range(groups)]
+    for i in range(groups):
+        gid = -1001000000000 - i
+        data['pattern_scalars'][f'repeat_task:{gid}'] = 'True'
+        data['pattern_scalars'][f'repeat_text:{gid}'] = 'Daily reminder ✨ ' * 4
+        data['pattern_scalars'][f'repeat_interval:{gid}'] = '3600'
+        data['pattern_scalars'][f'join_reply_text:{gid}'] = 'Welcome to the group!'
+        data['lists'][f'sent_messages:{gid}'] = [str(40000 + m) for m in range(10)]
+    for shard in range(128):
+        members = [str(1000000 + u) for u in range(shard, users, 128)]
+        data['sets'][f'users:{shard}'] = members
+        data['hashes'][f'users_info:{shard}'] = {
+            uid: '{"username": "user%s", "full_name": "User %s"}' % (uid, uid) for uid in members}
+    return data
+
+
+def _bench(fn, arg, min_time=0.5):
+    n, elapsed = 0, 0.0
+    start = time.perf_counter()
+    while elapsed < min_time:
+        for _ in range(100):
+            fn(arg)
+        n += 100
+        elapsed = time.perf_counter() - start
+    return elapsed / n * 1e6
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--groups', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=20000)
+    args = parser.parse_args()
+
+    codecs = []
+    for name in ('orjson', 'ujson', 'json'):
+        loaded = main._load_json_codec(name)
+        if loaded[0] == name:
+            codecs.append(loaded)
+    print(f"active codec in main.py: {main.JSON_CODEC}; benchmarking: {', '.join(c[0] for c in codecs)}\n")
+
+    ref_dumps = codecs[-1][2]
+    print(f"{'update loads (bytes)':<24}" + ''.join(f"{c[0]:>12}" for c in codecs))
+    for label, update in UPDATES.items():
+        body = ref_dumps(update)
+        row = ''.join(f"{_bench(loads, body):>10.1f}us" for _, loads, _ in codecs)
+        print(f"{label + f' ({len(body)}B)':<24}{row}")
+
+    doc = backup_document(args.groups, args.users)
+    print(f"\n{'backup dumps (pretty)':<24}" + ''.join(f"{c[0]:>12}" for c in codecs))
+    times, sizes = [], []
+    for _, _, dumps in codecs:
+        start = time.perf_counter()
+        out = dumps(doc, pretty=True)
+        times.append((time.perf_counter() - start) * 1000)
+        sizes.append(len(out))
+    print(f"{'time':<24}" + ''.join(f"{t:>10.1f}ms" for t in times))
+    print(f"{'size':<24}" + ''.join(f"{s / 1024:>10.0f}KB" for s in sizes))
+
+
+if __name__ == '__main__':
+    main_()
@@ -0,0 +1,103 @@
+"""
+Sustained webhook throughput against a running instance.
+
+    gunicorn -c gunicorn.conf.py &
+    python bench/webhook_throughput.py --url http://127.0.0.1:5000/ --duration 30 --concurrency 32
+
+Posts synthetic group text messages (to a chat id the bot does not manage,
+so handlers do their Redis lookups but never call Telegram) over keep-alive
+connections, then prints requests/s, status codes and ack latency
+percentiles. Only the standard library is used.
+"""
+import argparse
+import http.client
+import itertools
+import json
+import threading
+import time
+from urllib.parse import urlparse
+
+_update_ids = itertools.count(1)
+_update_lock = threading.Lock()
+
+
+def _payload(chat_id):
+    with _update_lock:
+        update_id = next(_update_ids)
+    return json.dumps({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'supergroup', 'title': 'bench'},
+            'from': {'id': 10_000 + update_id % 500, 'is_bot': False, 'first_name': 'bench'},
+            'text': 'benchmark message without a link',
+        },
+    })
+
+
+def _client(url, chat_ids, deadline, results):
+    target = urlparse(url)
+    conn = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=10)
+    path = target.path or '/'
+    latencies, statuses = [], {}
+    for chat_id in itertools.cycle(chat_ids):
+        if time.time() >= deadline:
+            break
+        body = _payload(chat_id)
+        started = time.perf_counter()
+        try:
+            conn.request('POST', path, body, {'Content-Type': 'application/json'})
+            resp = conn.getresponse()
+            resp.read()
+            status = resp.status
+        except Exception:
+            conn.close()
+            conn = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=10)
+            status = 'error'
+        latencies.append(time.perf_counter() - started)
+        statuses[status] = statuses.get(status, 0) + 1
+    conn.close()
+    results.append((latencies, statuses))
+
+
+def _pct(values, pct):
+    return values[min(len(values) - 1, int(len(values) * pct / 100))] * 1000 if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:5000/')
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--chats', type=int, default=64, help='distinct synthetic chat ids')
+    args = parser.parse_args()
+
+    chat_ids = [-1009999000000 - i for i in range(args.chats)]
+    deadline = time.time() + args.duration
+    results = []
+    threads = [
+        threading.Thread(target=_client, args=(args.url, chat_ids[i::args.concurrency] or chat_ids, deadline, results))
+        for i in range(args.concurrency)
+    ]
+    started = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - started
+
+    latencies = sorted(l for lat, _ in results for l in lat)
+    statuses = {}
+    for _, st in results:
+        for k, v in st.items():
+            statuses[k] = statuses.get(k, 0) + v
+    print(f"requests:    {len(latencies)} in {elapsed:.1f}s")
+    print(f"throughput:  {len(latencies) / elapsed:.0f} req/s")
+    print(f"status:      {statuses}")
+    print(f"ack latency: p50 {_pct(latencies, 50):.1f}ms  p95 {_pct(latencies, 95):.1f}ms  "
+          f"p99 {_pct(latencies, 99):.1f}ms  max {latencies[-1] * 1000 if latencies else 0:.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
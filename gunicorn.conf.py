@@ -0,0 +1,38 @@
+"""
+Production serving:  gunicorn -c gunicorn.conf.py
+
+The master process only forks; each worker imports main (no I/O at import)
+and calls main.init() once it is up, because threads do not survive fork.
+Jobs that must run once per deployment — repeats, backups, scheduled
+deletes, resuming parked sends and broadcasts — are gated by the leader lock
+in main.py, so extra workers only add webhook capacity.
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+wsgi_app = 'main:app'
+
+# One process by default: owner conversations (next-step handlers), the send
+# queue's per-group rate limiter and the config caches live in process
+# memory. Scale with threads first — the webhook only enqueues and acks.
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+preload_app = False
+
+timeout = 60
+# Leave room for main.shutdown() to drain after in-flight requests finish
+graceful_timeout = int(os.environ.get('DRAIN_TIMEOUT', 20)) + 15
+keepalive = 75          # Telegram reuses webhook connections
+loglevel = 'info'
+
+
+def post_worker_init(worker):
+    import main
+    # gunicorn owns SIGTERM in workers; the drain runs from worker_exit below
+    main.init(install_signal_handler=False)
+
+
+def worker_exit(server, worker):
+    import main
+    main.shutdown()
@@ -1,14 +1,21 @@
 import os
 import io
+import sys
+import signal
 import json
 import re
 import time
 import heapq
+import html
+import bisect
+import hashlib
+import queue
 import logging
 import psutil
 import datetime
-from collections import deque
-from flask import Flask, request, abort
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, request, abort
 import telebot
 from telebot import types
 import redis
@@ -22,12 +29,55 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ─── JSON codec ──────────────────────────────────────────────────────────────
+# orjson, then ujson, then the stdlib — whichever is installed; JSON_CODEC
+# forces one. json_loads() takes bytes as well as str, so request bodies and
+# uploaded files are parsed without a decode copy.
+def _load_json_codec(preferred=None):
+    for name in ([preferred] if preferred else ['orjson', 'ujson']):
+        try:
+            if name == 'orjson':
+                import orjson
+                base = orjson.OPT_NON_STR_KEYS
+
+                def dumps_bytes(obj, pretty=False, default=None):
+                    return orjson.dumps(obj, default=default,
+                                        option=(base | orjson.OPT_INDENT_2) if pretty else base)
+                return name, orjson.loads, dumps_bytes
+            if name == 'ujson':
+                import ujson
+
+                def dumps_bytes(obj, pretty=False, default=None):
+                    return ujson.dumps(obj, ensure_ascii=False, indent=2 if pretty else 0,
+                                       default=default).encode('utf-8')
+                return name, ujson.loads, dumps_bytes
+        except ImportError:
+            continue
+
+    def dumps_bytes(obj, pretty=False, default=None):
+        return json.dumps(obj, ensure_ascii=False, indent=2 if pretty else None,
+                          default=default).encode('utf-8')
+    return 'json', json.loads, dumps_bytes
+
+JSON_CODEC, json_loads, json_dumps_bytes = _load_json_codec(os.environ.get('JSON_CODEC'))
+
+def json_dumps(obj, pretty=False, default=None):
+    return json_dumps_bytes(obj, pretty, default).decode('utf-8')
+
 # ─── Monitoring Counters ──────────────────────────────────────────────────────
 _flood_wait_counter = 0
 _flood_wait_lock = threading.Lock()
 
-# Per-group runtime error log: {chat_id: [error_str, ...]}
-_runtime_errors = {}
+# Per-group runtime error store with fixed memory. Each group keeps a ring of
+# at most _ERROR_RING_SIZE distinct error signatures; a repeat of a known
+# signature bumps its count instead of taking a slot. Groups are evicted
+# least-recently-failing first once _ERROR_MAX_GROUPS is reached.
+# Entry: [signature, last_msg, count, first_ts, last_ts]
+_ERROR_RING_SIZE = 20
+_ERROR_MAX_GROUPS = 500
+_ERROR_PERSIST = os.environ.get('ERROR_STORE_PERSIST', 'False') == 'True'
+_ERROR_PERSIST_TTL = 7 * 86400
+_runtime_errors = OrderedDict()    # chat_id → deque of entries, LRU order
 _runtime_errors_lock = threading.Lock()
 
 def _increment_flood_counter(seconds=0):
@@ -36,44 +86,154 @@ def _increment_flood_counter(seconds=0):
         _flood_wait_counter += 1
     logger.warning(f"FloodWait hit — retry_after={seconds}s (total hits: {_flood_wait_counter})")
 
+# A quote only opens after a non-word character and closes before one, so
+# apostrophes (can't, don't) are left alone.
+_QUOTED_RE = re.compile(r"(?<!\w)'[^']*'(?!\w)|(?<!\w)\"[^\"]*\"(?!\w)")
+
+def _error_signature(msg):
+    """Collapse ids, counts and quoted values so repeats of one failure match."""
+    sig = _QUOTED_RE.sub("'…'", msg)
+    return re.sub(r'-?\d+', '#', sig)[:120]
+
 def _log_runtime_error(chat_id, context, error_str):
     """Store a runtime error per group and log it."""
     msg = f"[{context}] {error_str}"
+    sig = _error_signature(msg)
+    now = time.time()
+    evicted_sig = None
     with _runtime_errors_lock:
-        if chat_id not in _runtime_errors:
-            _runtime_errors[chat_id] = []
-        _runtime_errors[chat_id].append(msg)
-        # Keep last 20 errors per group
-        if len(_runtime_errors[chat_id]) > 20:
-            _runtime_errors[chat_id] = _runtime_errors[chat_id][-20:]
+        ring = _runtime_errors.get(chat_id)
+        if ring is None:
+            ring = _runtime_errors[chat_id] = deque(maxlen=_ERROR_RING_SIZE)
+            if len(_runtime_errors) > _ERROR_MAX_GROUPS:
+                _runtime_errors.popitem(last=False)
+        _runtime_errors.move_to_end(chat_id)
+        entry = next((e for e in ring if e[0] == sig), None)
+        if entry is not None:
+            ring.remove(entry)
+            entry[1], entry[2], entry[4] = msg, entry[2] + 1, now
+        else:
+            if len(ring) == ring.maxlen:
+                evicted_sig = ring[0][0]
+            entry = [sig, msg, 1, now, now]
+        ring.append(entry)
+        snapshot = list(entry)
+    if _ERROR_PERSIST:
+        try:
+            pipe = r.pipeline()
+            pipe.hset(f'runtime_errors:{chat_id}', sig, json_dumps(snapshot[1:]))
+            if evicted_sig is not None:
+                pipe.hdel(f'runtime_errors:{chat_id}', evicted_sig)
+            pipe.expire(f'runtime_errors:{chat_id}', _ERROR_PERSIST_TTL)
+            pipe.execute()
+        except Exception:
+            pass
     logger.error(f"Group {chat_id} {msg}")
 
+def get_runtime_errors(chat_id):
+    """Entries for a group, oldest first. Falls back to Redis when persisted."""
+    with _runtime_errors_lock:
+        ring = _runtime_errors.get(chat_id)
+        if ring is not None:
+            return [list(e) for e in ring]
+    if not _ERROR_PERSIST:
+        return []
+    try:
+        stored = r.hgetall(f'runtime_errors:{chat_id}')
+    except Exception:
+        return []
+    entries = sorted(([sig] + json_loads(v) for sig, v in stored.items()), key=lambda e: e[4])
+    return entries[-_ERROR_RING_SIZE:]
+
+def runtime_error_signatures(limit=8):
+    """[(signature, total_count, group_count, last_ts)] across every group in memory."""
+    agg = {}
+    with _runtime_errors_lock:
+        for ring in _runtime_errors.values():
+            for sig, _, count, _, last_ts in ring:
+                a = agg.setdefault(sig, [0, 0, 0])
+                a[0] += count
+                a[1] += 1
+                a[2] = max(a[2], last_ts)
+    ranked = sorted(agg.items(), key=lambda kv: kv[1][0], reverse=True)[:limit]
+    return [(sig, total, groups, last) for sig, (total, groups, last) in ranked]
+
+def clear_runtime_errors():
+    with _runtime_errors_lock:
+        _runtime_errors.clear()
+    # Scan rather than use the LRU: persisted entries outlive eviction and
+    # restarts, and may have been written while ERROR_STORE_PERSIST was on.
+    try:
+        keys = list(r.scan_iter('runtime_errors:*'))
+        for i in range(0, len(keys), 500):
+            r.delete(*keys[i:i + 500])
+    except Exception:
+        pass
+
+# Latency histograms for /metrics: {(name, label_str): [bucket_counts, sum, count]}
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+def observe_latency(name, seconds, labels=''):
+    """Add one observation to a process-lifetime latency histogram."""
+    with _histograms_lock:
+        h = _histograms.get((name, labels))
+        if h is None:
+            h = _histograms[(name, labels)] = [[0] * len(_LATENCY_BUCKETS), 0.0, 0]
+        for i, bound in enumerate(_LATENCY_BUCKETS):
+            if seconds <= bound:
+                h[0][i] += 1
+                break
+        h[1] += seconds
+        h[2] += 1
+
 # Environment variables
 TOKEN = os.environ['TOKEN']
 OWNER_ID = int(os.environ['OWNER_ID'])
-WEBHOOK_URL = os.environ['WEBHOOK_URL']
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')   # optional with INGEST_MODE=polling
 REDIS_URL = os.environ['REDIS_URL']
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+# e.g. http://127.0.0.1:8081/bot{0}/{1} to load-test against a fake Bot API
+if os.environ.get('TELEGRAM_API_URL'):
+    telebot.apihelper.API_URL = os.environ['TELEGRAM_API_URL']
 
 bot = telebot.TeleBot(TOKEN, threaded=False)
 app = Flask(__name__)
 r   = redis.Redis.from_url(REDIS_URL, decode_responses=True)
-_BOT_ID = bot.get_me().id   # cached once at startup — used by bot detection system
+
+# ─── Bot identity ────────────────────────────────────────────────────────────
+_bot_id = None
+_bot_id_lock = threading.Lock()
+
+def get_bot_id():
+    """The bot's own user id, resolved once on first use. The token's prefix
+    is the bot id, so this normally needs no network call at all."""
+    global _bot_id
+    if _bot_id is None:
+        with _bot_id_lock:
+            if _bot_id is None:
+                prefix = TOKEN.split(':', 1)[0]
+                _bot_id = int(prefix) if prefix.isdigit() else bot.get_me().id
+    return _bot_id
 
 # ─── Defaults ────────────────────────────────────────────────────────────────
-if r.get('link_only_global') is None:
-    r.set('link_only_global', 'False')
-if r.get('global_start_reply') is None:
-    r.set('global_start_reply', 'Hello! This bot is managed by its owner. Use groups for features.')
-if r.get('global_join_reply_enabled') is None:
-    r.set('global_join_reply_enabled', 'False')
-if r.get('global_join_reply_text') is None:
-    r.set('global_join_reply_text', 'Welcome to the group!')
-if r.get('global_group_start_reply_enabled') is None:
-    r.set('global_group_start_reply_enabled', 'False')
-if r.get('added_to_group_msg_enabled') is None:
-    r.set('added_to_group_msg_enabled', 'True')
-if r.get('added_to_group_msg') is None:
-    r.set('added_to_group_msg', 'https://t.me/AllMusicShazamandlyrics_bot?startgroup=true&admin=change_info+delete_messages+restrict_members+invite_users+pin_messages+manage_video_chats+anonymous+manage_chat+post_stories+edit_stories+delete_stories')
+# Written by init() in one pipelined SET NX batch — existing values win.
+_DEFAULTS = {
+    'link_only_global':                 'False',
+    'global_start_reply':               'Hello! This bot is managed by its owner. Use groups for features.',
+    'global_join_reply_enabled':        'False',
+    'global_join_reply_text':           'Welcome to the group!',
+    'global_group_start_reply_enabled': 'False',
+    'added_to_group_msg_enabled':       'True',
+    'added_to_group_msg':               'https://t.me/AllMusicShazamandlyrics_bot?startgroup=true&admin=change_info+delete_messages+restrict_members+invite_users+pin_messages+manage_video_chats+anonymous+manage_chat+post_stories+edit_stories+delete_stories',
+}
+
+def _write_defaults():
+    pipe = r.pipeline(transaction=False)
+    for key, value in _DEFAULTS.items():
+        pipe.set(key, value, nx=True)
+    pipe.execute()
 
 # ─── Group helpers ────────────────────────────────────────────────────────────
 def get_groups():
@@ -106,24 +266,29 @@ def remove_group(chat_id):
     r.delete(f'group_start_reply_independent:{chat_id}')
     r.delete(f'cache_group_title:{chat_id}')
     r.delete(f'cache_group_status:{chat_id}')
+    r.delete(f'cache_group_fresh:{chat_id}')
     r.delete(f'global_last_sent:{chat_id}')
-    r.delete(f'group_error:{chat_id}')
     r.delete(f'gr_next_send:{chat_id}')
-    r.srem('groups_with_errors', str(chat_id))
+    r.delete(f'next_repeat_at:{chat_id}')
+    clear_group_health(chat_id)
     _invalidate_groups_cache()
     _invalidate_group_config_cache(chat_id)
+    _invalidate_global_cache(f'link_only:{chat_id}')
+    _invalidate_bot_member(chat_id)
 
 def is_link_only(chat_id):
-    group_specific = r.get(f'link_only:{chat_id}')
+    group_specific = _get_cached_global(f'link_only:{chat_id}')
     if group_specific is not None:
         return group_specific == 'True'
-    return r.get('link_only_global') == 'True'
+    return _get_cached_global('link_only_global') == 'True'
 
 def set_link_only(chat_id, value):
     if chat_id is None:
         r.set('link_only_global', 'True' if value else 'False')
+        _invalidate_global_cache('link_only_global')
     else:
         r.set(f'link_only:{chat_id}', 'True' if value else 'False')
+        _invalidate_global_cache(f'link_only:{chat_id}')
 
 def save_last_sent(chat_id, message_id):
     sent_list_key = f'sent_messages:{chat_id}'
@@ -138,31 +303,182 @@ def get_sent_messages(chat_id):
 def clear_sent_messages(chat_id):
     r.delete(f'sent_messages:{chat_id}')
 
-def get_group_info(chat_id, force_refresh=False):
-    title_key = f'cache_group_title:{chat_id}'
-    status_key = f'cache_group_status:{chat_id}'
-    if not force_refresh:
-        cached_title = r.get(title_key)
-        cached_status = r.get(status_key)
-        if cached_title and cached_status:
-            return cached_title, cached_status
+# Group title/status cache uses stale-while-revalidate: the title/status keys
+# live for a day, cache_group_fresh:{id} marks them fresh for 10 minutes.
+# Stale entries are served immediately and refreshed in the background.
+_GROUP_INFO_FRESH_TTL = 600
+_GROUP_INFO_STALE_TTL = 86400
+_GROUP_INFO_FETCH_WORKERS = 8      # max parallel getChat lookups per batch
+
+_group_info_refreshing = set()     # chat_ids with a background refresh in flight
+_group_info_refresh_lock = threading.Lock()
+
+def _member_status_label(member):
+    if member.status in ['administrator', 'creator']:
+        return "Admin"
+    return "Member" if member.status == 'member' else "Other"
+
+def _store_group_info(chat_id, title, status):
+    """Write a freshly observed title/status into the group info cache."""
+    pipe = r.pipeline()
+    if title:
+        pipe.set(f'cache_group_title:{chat_id}', title, ex=_GROUP_INFO_STALE_TTL)
+    pipe.set(f'cache_group_status:{chat_id}', status, ex=_GROUP_INFO_STALE_TTL)
+    if title:
+        pipe.set(f'cache_group_fresh:{chat_id}', '1', ex=_GROUP_INFO_FRESH_TTL)
+    pipe.execute()
+
+def _fetch_group_info(chat_id):
+    """Live API lookup of (title, status). Writes the cache; never raises."""
     try:
         chat = bot.get_chat(chat_id)
         title = chat.title or f"Group {chat_id}"
-        member = bot.get_chat_member(chat_id, bot.get_me().id)
-        status = "Admin" if member.status in ['administrator', 'creator'] else (
-            "Member" if member.status == 'member' else "Other"
-        )
-        r.set(title_key, title, ex=600)
-        r.set(status_key, status, ex=600)
+        status = _member_status_label(get_bot_member(chat_id))
+        _store_group_info(chat_id, title, status)
         return title, status
     except Exception:
         return f"Group {chat_id}", "Error"
 
+def _fetch_group_infos(chat_ids):
+    """Bounded-parallel live lookup. Returns {chat_id: (title, status)}."""
+    if not chat_ids:
+        return {}
+    workers = min(_GROUP_INFO_FETCH_WORKERS, len(chat_ids))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return dict(zip(chat_ids, pool.map(_fetch_group_info, chat_ids)))
+
+def _refresh_group_infos_async(chat_ids):
+    """Revalidate stale entries in the background, one refresh per group at a time."""
+    with _group_info_refresh_lock:
+        todo = [g for g in chat_ids if g not in _group_info_refreshing]
+        _group_info_refreshing.update(todo)
+    if not todo:
+        return
+    def _run():
+        try:
+            _fetch_group_infos(todo)
+        finally:
+            with _group_info_refresh_lock:
+                _group_info_refreshing.difference_update(todo)
+    threading.Thread(target=_run, daemon=True).start()
+
+def get_group_infos(chat_ids, force_refresh=False):
+    """
+    Bulk (title, status) resolver for menus: {chat_id: (title, status)}.
+    One MGET for every cached title/status, parallel API lookups for misses
+    only, and background refresh for entries past their fresh window.
+    """
+    chat_ids = list(chat_ids)
+    if not chat_ids:
+        return {}
+    if force_refresh:
+        return _fetch_group_infos(chat_ids)
+
+    keys = []
+    for g in chat_ids:
+        keys += [f'cache_group_title:{g}', f'cache_group_status:{g}', f'cache_group_fresh:{g}']
+    values = r.mget(keys)
+
+    result, misses, stale = {}, [], []
+    for i, g in enumerate(chat_ids):
+        title, status, fresh = values[i * 3:i * 3 + 3]
+        if title and status:
+            result[g] = (title, status)
+            if not fresh:
+                stale.append(g)
+        else:
+            misses.append(g)
+
+    result.update(_fetch_group_infos(misses))
+    if stale:
+        _refresh_group_infos_async(stale)
+    return result
+
+def get_group_info(chat_id, force_refresh=False):
+    return get_group_infos([chat_id], force_refresh)[chat_id]
+
+# ─── Group index ─────────────────────────────────────────────────────────────
+# Group pickers page through every group sorted by title. The sort order
+# comes from this index: one MGET of the cached titles, kept for a few
+# minutes and dropped whenever the group set changes. Groups whose title is
+# not cached yet sort last, by id, and never match a title search. A page
+# then loads title and status for its own groups through get_group_infos().
+_GROUP_INDEX_TTL = 300
+_group_index = []                  # sorted [(0, casefolded title, chat_id) | (1, chat_id)]
+_PREFIX_END = chr(0x10FFFF)        # sorts after every character a title can continue with
+_group_index_built_at = 0.0
+_group_index_lock = threading.Lock()
+
+def invalidate_group_index():
+    global _group_index_built_at
+    with _group_index_lock:
+        _group_index_built_at = 0.0
+
+def _get_group_index():
+    global _group_index, _group_index_built_at
+    with _group_index_lock:
+        if time.time() - _group_index_built_at < _GROUP_INDEX_TTL:
+            return _group_index
+    groups = _get_cached_groups()
+    titles = r.mget([f'cache_group_title:{g}' for g in groups]) if groups else []
+    index = sorted(
+        ((0, t.casefold(), g) if t else (1, g) for g, t in zip(groups, titles))
+    )
+    with _group_index_lock:
+        _group_index = index
+        _group_index_built_at = time.time()
+    return index
+
+def group_index_slice(offset, limit, prefix=None):
+    """(chat_ids, total) for one page of the title-sorted index, optionally
+    only groups whose title starts with prefix (case-insensitive)."""
+    index = _get_group_index()
+    if not prefix:
+        return [e[-1] for e in index[offset:offset + limit]], len(index)
+    prefix = prefix.casefold()
+    lo = bisect.bisect_left(index, (0, prefix))
+    hi = bisect.bisect_left(index, (0, prefix + _PREFIX_END), lo)
+    return [e[-1] for e in index[lo + offset:min(hi, lo + offset + limit)]], hi - lo
+
+# ─── Bot's own membership cache ───────────────────────────────────────────────
+# The bot's ChatMember per group, shared by every permission helper below.
+# Kept current by my_chat_member updates; the TTL only bounds drift if an
+# update is ever missed.
+_bot_member_cache = {}             # chat_id → (ChatMember, fetched_at)
+_bot_member_cache_lock = threading.Lock()
+_BOT_MEMBER_CACHE_TTL = 300        # 5 minutes
+
+def _set_bot_member(chat_id, member):
+    with _bot_member_cache_lock:
+        _bot_member_cache[chat_id] = (member, time.time())
+
+def _invalidate_bot_member(chat_id):
+    with _bot_member_cache_lock:
+        _bot_member_cache.pop(chat_id, None)
+
+def get_bot_member(chat_id, force_refresh=False):
+    """Return the bot's own ChatMember in a group. Raises on API failure."""
+    if not force_refresh:
+        with _bot_member_cache_lock:
+            entry = _bot_member_cache.get(chat_id)
+            if entry and (time.time() - entry[1]) < _BOT_MEMBER_CACHE_TTL:
+                return entry[0]
+    member = bot.get_chat_member(chat_id, get_bot_id())
+    _set_bot_member(chat_id, member)
+    return member
+
+def bot_can_restrict(chat_id):
+    try:
+        member = get_bot_member(chat_id)
+    except Exception:
+        return False
+    return member.status == 'creator' or (
+        member.status == 'administrator' and bool(getattr(member, 'can_restrict_members', False))
+    )
+
 def bot_can_add_members(chat_id):
     try:
-        me = bot.get_me()
-        member = bot.get_chat_member(chat_id, me.id)
+        member = get_bot_member(chat_id)
         if member.status == 'creator':
             return True, True
         if member.status == 'administrator':
@@ -173,6 +489,13 @@ def bot_can_add_members(chat_id):
     except Exception:
         return False, False
 
+_ADMIN_PERMISSION_KEYS = [
+    'can_manage_chat', 'can_change_info', 'can_delete_messages',
+    'can_restrict_members', 'can_invite_users', 'can_pin_messages',
+    'can_manage_video_chats', 'can_promote_members',
+    'can_post_stories', 'can_edit_stories', 'can_delete_stories',
+]
+
 def get_bot_admin_permissions(chat_id):
     """
     Returns a dict of the bot's own admin permissions in the group.
@@ -180,44 +503,18 @@ def get_bot_admin_permissions(chat_id):
     own permissions first and only attempt to grant those.
     """
     try:
-        me = bot.get_me()
-        member = bot.get_chat_member(chat_id, me.id)
+        member = get_bot_member(chat_id)
         if member.status == 'creator':
-            return {
-                'can_manage_chat': True,
-                'can_change_info': True,
-                'can_delete_messages': True,
-                'can_restrict_members': True,
-                'can_invite_users': True,
-                'can_pin_messages': True,
-                'can_manage_video_chats': True,
-                'can_promote_members': True,
-                'can_post_stories': True,
-                'can_edit_stories': True,
-                'can_delete_stories': True,
-            }
+            return {k: True for k in _ADMIN_PERMISSION_KEYS}
         if member.status == 'administrator':
-            return {
-                'can_manage_chat': getattr(member, 'can_manage_chat', False),
-                'can_change_info': getattr(member, 'can_change_info', False),
-                'can_delete_messages': getattr(member, 'can_delete_messages', False),
-                'can_restrict_members': getattr(member, 'can_restrict_members', False),
-                'can_invite_users': getattr(member, 'can_invite_users', False),
-                'can_pin_messages': getattr(member, 'can_pin_messages', False),
-                'can_manage_video_chats': getattr(member, 'can_manage_video_chats', False),
-                'can_promote_members': getattr(member, 'can_promote_members', False),
-                'can_post_stories': getattr(member, 'can_post_stories', False),
-                'can_edit_stories': getattr(member, 'can_edit_stories', False),
-                'can_delete_stories': getattr(member, 'can_delete_stories', False),
-            }
+            return {k: getattr(member, k, False) for k in _ADMIN_PERMISSION_KEYS}
         return {}
     except Exception:
         return {}
 
 def bot_can_pin(chat_id):
     try:
-        me = bot.get_me()
-        member = bot.get_chat_member(chat_id, me.id)
+        member = get_bot_member(chat_id)
         if member.status == 'creator':
             return True
         if member.status == 'administrator':
@@ -231,18 +528,184 @@ def bot_can_pin(chat_id):
         return False
 
 # ─── User tracking ────────────────────────────────────────────────────────────
+# Users are partitioned into _USER_SHARDS buckets by user_id so no single key
+# grows with the user base:
+#   users:{n}     set  — user ids
+#   users_info:{n} hash — user_id → JSON {username, full_name}
+#   users_fs:{n}  hash — user_id → first-seen epoch, base-36 packed
+# All bulk reads stream with SSCAN/HSCAN; nothing loads the full registry.
+# users_by_first_seen is a sorted set (score = first-seen epoch) derived from
+# users_fs:* — it answers every stats question with ZCARD/ZCOUNT. It is not
+# backed up; _ensure_first_seen_index() rebuilds it when it falls behind.
+_USER_SHARDS = 128
+_USER_SCAN_COUNT = 1000
+_B36_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+# Record first-seen once and index the stored value, not the caller's clock,
+# so a user already in users_fs:* is never scored as new.
+_track_first_seen = r.register_script(
+    "redis.call('hsetnx', KEYS[1], ARGV[1], ARGV[2]) "
+    "local first = tonumber(redis.call('hget', KEYS[1], ARGV[1]), 36) "
+    "return redis.call('zadd', KEYS[2], 'NX', first, ARGV[1])")
+
+def _user_shard(user_id):
+    return int(user_id) % _USER_SHARDS
+
+def _pack_ts(ts):
+    """Epoch seconds → base 36 (6 chars instead of 10 for current dates)."""
+    ts = int(ts)
+    out = ''
+    while True:
+        ts, rem = divmod(ts, 36)
+        out = _B36_DIGITS[rem] + out
+        if not ts:
+            return out
+
+def _unpack_ts(packed):
+    return int(packed, 36)
+
 def track_user(user_id, username=None, full_name=None):
-    r.sadd('bot_users', str(user_id))
-    r.hset('user_info', str(user_id), json.dumps({
+    shard = _user_shard(user_id)
+    uid = str(user_id)
+    pipe = r.pipeline()
+    pipe.sadd(f'users:{shard}', uid)
+    pipe.hset(f'users_info:{shard}', uid, json_dumps({
         'username': username,
         'full_name': full_name,
-        'first_seen': r.hget('user_first_seen', str(user_id)) or str(int(time.time()))
     }))
-    if not r.hexists('user_first_seen', str(user_id)):
-        r.hset('user_first_seen', str(user_id), str(int(time.time())))
+    _track_first_seen(keys=[f'users_fs:{shard}', 'users_by_first_seen'],
+                      args=[uid, _pack_ts(time.time())], client=pipe)
+    pipe.execute()
+
+def count_users():
+    """Total registered users — one pipelined SCARD per shard."""
+    pipe = r.pipeline()
+    for n in range(_USER_SHARDS):
+        pipe.scard(f'users:{n}')
+    return sum(pipe.execute())
+
+def iter_users():
+    """Stream every user id, shard by shard, without loading the whole set."""
+    for n in range(_USER_SHARDS):
+        for uid in r.sscan_iter(f'users:{n}', count=_USER_SCAN_COUNT):
+            yield int(uid)
+
+def iter_user_first_seen():
+    """Stream (user_id, first_seen_epoch) pairs."""
+    for n in range(_USER_SHARDS):
+        for uid, packed in r.hscan_iter(f'users_fs:{n}', count=_USER_SCAN_COUNT):
+            yield int(uid), _unpack_ts(packed)
+
+def daily_new_users(days=7):
+    """[(date 'YYYY-MM-DD', new users)] for the last `days` UTC days, oldest first."""
+    today = datetime.datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    starts = [today - datetime.timedelta(days=i) for i in range(days - 1, -1, -1)]
+    pipe = r.pipeline()
+    for day in starts:
+        start = int(day.replace(tzinfo=datetime.timezone.utc).timestamp())
+        pipe.zcount('users_by_first_seen', start, f'({start + 86400}')
+    return [(d.strftime('%Y-%m-%d'), n) for d, n in zip(starts, pipe.execute())]
+
+def _ensure_first_seen_index(rebuild=False):
+    """Backfill users_by_first_seen from users_fs:* if it is missing entries
+    (first run after upgrade). rebuild=True (after a restore) replaces it
+    outright: its count can match while its members and scores are stale."""
+    try:
+        if not rebuild and r.zcard('users_by_first_seen') >= count_users():
+            return
+        # users_fs:* is authoritative, so scores are overwritten, not NX
+        target = 'users_by_first_seen:rebuild' if rebuild else 'users_by_first_seen'
+        r.delete('users_by_first_seen:rebuild')
+        added = 0
+        pipe = r.pipeline()
+        for uid, first_seen in iter_user_first_seen():
+            pipe.zadd(target, {str(uid): first_seen})
+            added += 1
+            if added % _USER_SCAN_COUNT == 0:
+                pipe.execute()
+        pipe.execute()
+        if rebuild:
+            if added:
+                r.rename(target, 'users_by_first_seen')
+            else:
+                r.delete('users_by_first_seen')
+        logger.info(f"[USERS] First-seen index rebuilt ({added} users)")
+    except Exception as e:
+        logger.error(f"[USERS] First-seen index rebuild failed: {e}")
+
+def _render_user_stats():
+    """Text for /stats and the Bot Stats menu — a handful of O(log N) reads."""
+    now = int(time.time())
+    today_start = now - now % 86400
+    pipe = r.pipeline()
+    pipe.zcard('users_by_first_seen')
+    pipe.zcount('users_by_first_seen', today_start, '+inf')
+    pipe.zcount('users_by_first_seen', now - 7 * 86400, '+inf')
+    pipe.zcount('users_by_first_seen', now - 30 * 86400, '+inf')
+    pipe.scard('groups')
+    total, new_today, new_7d, new_30d, groups_count = pipe.execute()
+    growth = "\n".join(f"`{day[5:]}`  +{n}" for day, n in daily_new_users(7))
+    return (
+        f"📊 *Bot Statistics*\n\n"
+        f"👤 Total users: *{total}*\n"
+        f"🆕 New users today: *{new_today}*\n"
+        f"🆕 New users (last 7 days): *{new_7d}*\n"
+        f"🆕 New users (last 30 days): *{new_30d}*\n"
+        f"👥 Active groups: *{groups_count}*\n\n"
+        f"📈 *Daily new users:*\n{growth}"
+    )
 
-def get_all_users():
-    return [int(u) for u in r.smembers('bot_users')]
+def _migrate_legacy_user_registry():
+    """
+    One-time move from the single bot_users / user_info / user_first_seen
+    keys into the sharded layout. Streams in batches; the legacy keys are
+    deleted only after everything was copied. Safe to re-run (restore of an
+    old backup brings the legacy keys back).
+    """
+    if not r.exists('bot_users', 'user_info', 'user_first_seen'):
+        return
+    moved = 0
+    try:
+        batch = []
+        def _flush():
+            pipe = r.pipeline()
+            for kind, uid, val in batch:
+                shard = _user_shard(uid)
+                if kind == 'user':
+                    pipe.sadd(f'users:{shard}', uid)
+                elif kind == 'info':
+                    try:
+                        info = json_loads(val)
+                        val = json_dumps({'username': info.get('username'),
+                                          'full_name': info.get('full_name')})
+                    except Exception:
+                        pass
+                    pipe.hset(f'users_info:{shard}', uid, val)
+                else:
+                    pipe.hsetnx(f'users_fs:{shard}', uid, _pack_ts(val))
+            pipe.execute()
+            batch.clear()
+
+        for uid in r.sscan_iter('bot_users', count=_USER_SCAN_COUNT):
+            batch.append(('user', uid, None))
+            moved += 1
+            if len(batch) >= _USER_SCAN_COUNT:
+                _flush()
+        for uid, val in r.hscan_iter('user_info', count=_USER_SCAN_COUNT):
+            batch.append(('info', uid, val))
+            if len(batch) >= _USER_SCAN_COUNT:
+                _flush()
+        for uid, val in r.hscan_iter('user_first_seen', count=_USER_SCAN_COUNT):
+            if val and val.isdigit():
+                batch.append(('fs', uid, int(val)))
+            if len(batch) >= _USER_SCAN_COUNT:
+                _flush()
+        if batch:
+            _flush()
+        r.delete('bot_users', 'user_info', 'user_first_seen')
+        logger.info(f"[USERS] Migrated {moved} users to {_USER_SHARDS} shards")
+    except Exception as e:
+        logger.error(f"[USERS] Legacy registry migration failed (legacy keys kept): {e}")
 
 def save_private_sent(user_id, message_id):
     key = f'private_sent:{user_id}'
@@ -279,14 +742,18 @@ _group_repeat_cache_lock = threading.Lock()
 _GROUP_CONFIG_CACHE_TTL = 300      # 5 minutes
 
 def _get_cached_global(key):
-    """Return cached value for a global Redis key, refreshing if stale."""
+    """Return cached value for a config key, refreshing if stale.
+    While Redis client tracking is live, entries only expire on invalidation."""
     with _global_config_cache_lock:
         entry = _global_config_cache.get(key)
-        if entry and (time.time() - entry[1]) < _CONFIG_CACHE_TTL:
+        if entry and (_tracking_active.is_set() or (time.time() - entry[1]) < _CONFIG_CACHE_TTL):
             return entry[0]
+    gen = _tracking_generation
     val = r.get(key)
     with _global_config_cache_lock:
-        _global_config_cache[key] = (val, time.time())
+        # Skip the fill if an invalidation landed while we were reading
+        if gen == _tracking_generation:
+            _global_config_cache[key] = (val, time.time())
     return val
 
 def _invalidate_global_cache(*keys):
@@ -311,13 +778,16 @@ def _invalidate_groups_cache():
     global _groups_cache_fetched_at
     with _groups_cache_lock:
         _groups_cache_fetched_at = 0.0
+    invalidate_group_index()
 
 def _get_cached_group_config(chat_id):
-    """Return cached per-group repeat config, refreshing every 5 minutes."""
+    """Return cached per-group repeat config, refreshing every 5 minutes
+    (or only on invalidation while Redis client tracking is live)."""
     with _group_repeat_cache_lock:
         cfg = _group_repeat_cache.get(chat_id)
-        if cfg and (time.time() - cfg.get('_fetched', 0)) < _GROUP_CONFIG_CACHE_TTL:
+        if cfg and (_tracking_active.is_set() or (time.time() - cfg.get('_fetched', 0)) < _GROUP_CONFIG_CACHE_TTL):
             return cfg
+    gen = _tracking_generation
     # Pipeline to read all keys in one round-trip
     pipe = r.pipeline()
     pipe.get(f'repeat_task:{chat_id}')
@@ -335,13 +805,136 @@ def _get_cached_group_config(chat_id):
         '_fetched':         time.time(),
     }
     with _group_repeat_cache_lock:
-        _group_repeat_cache[chat_id] = cfg
+        if gen == _tracking_generation:
+            _group_repeat_cache[chat_id] = cfg
     return cfg
 
 def _invalidate_group_config_cache(chat_id):
     with _group_repeat_cache_lock:
         _group_repeat_cache.pop(chat_id, None)
 
+def _clear_config_caches():
+    """Drop every cached config entry (restore, tracking link up/down)."""
+    _invalidate_groups_cache()
+    with _global_config_cache_lock:
+        _global_config_cache.clear()
+    with _group_repeat_cache_lock:
+        _group_repeat_cache.clear()
+
+
+# ── Server-assisted client-side caching (Redis CLIENT TRACKING) ───────────────
+# Redis 6+ pushes an invalidation message for every write to a tracked key
+# prefix, so while the link is up cached config never goes stale and never
+# needs a TTL re-read.  We use BCAST + REDIRECT mode: a dedicated pub/sub
+# connection receives `__redis__:invalidate`, a second connection owns the
+# tracking state.  This works with the plain RESP2 client `r` uses.
+# On older servers, or while the link is down, the TTL caches above apply.
+
+_CLIENT_TRACKING = os.environ.get('REDIS_CLIENT_TRACKING', 'True') == 'True'
+# Only keys the in-process caches above hold. A broader prefix such as
+# 'global_' would also match hot keys like global_last_sent:{id} and flood
+# the link with invalidations nobody needs.
+_TRACKED_PREFIXES = (
+    'link_only:', 'link_only_global',
+    'repeat_task:', 'repeat_text:', 'repeat_interval:',
+    'repeat_autodelete:', 'repeat_self_delete:',
+)
+_TRACKING_PROBE_INTERVAL = 30      # seconds between redirect-health checks
+
+_tracking_active = threading.Event()
+_tracking_generation = 0           # bumped on every invalidation message
+_tracking_gen_lock = threading.Lock()
+
+def _on_tracking_invalidate(keys):
+    """Apply one invalidation message. keys=None means the DB was flushed."""
+    global _tracking_generation
+    with _tracking_gen_lock:
+        _tracking_generation += 1
+    if keys is None:
+        _clear_config_caches()
+        return
+    if isinstance(keys, str):
+        keys = [keys]
+    for key in keys:
+        _invalidate_global_cache(key)
+        if key.startswith('repeat_') and ':' in key:
+            try:
+                _invalidate_group_config_cache(int(key.split(':', 1)[1]))
+            except ValueError:
+                pass
+
+def _tracking_link_ok(trk, redirect_id):
+    """True while the tracking connection still redirects to our subscriber."""
+    try:
+        info = trk.execute_command('CLIENT', 'TRACKINGINFO')
+    except redis.exceptions.ResponseError:
+        return bool(trk.ping())    # Redis 6.0 has no TRACKINGINFO — liveness only
+    info = dict(zip(info[::2], info[1::2]))
+    flags = info.get('flags') or []
+    return 'broken_redirect' not in flags and int(info.get('redirect', -1)) == int(redirect_id)
+
+def _client_tracking_worker():
+    """Owns the invalidation link. Reconnects with backoff; gives up for good
+    if the server does not support CLIENT TRACKING."""
+    backoff = 5
+    while True:
+        pubsub = None
+        trk = None
+        try:
+            name = f'minibot-inv-{os.getpid()}-{int(time.time())}'
+            inv_client = redis.Redis.from_url(REDIS_URL, decode_responses=True, client_name=name)
+            pubsub = inv_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe('__redis__:invalidate')
+            redirect_id = next(c['id'] for c in r.client_list() if c.get('name') == name)
+
+            trk = redis.Redis.from_url(REDIS_URL, decode_responses=True, single_connection_client=True)
+            args = ['CLIENT', 'TRACKING', 'ON', 'REDIRECT', redirect_id, 'BCAST']
+            for prefix in _TRACKED_PREFIXES:
+                args += ['PREFIX', prefix]
+            trk.execute_command(*args)
+
+            # Anything cached before the link existed may have missed an invalidation
+            _clear_config_caches()
+            _tracking_active.set()
+            logger.info(f"[CACHE] Redis client tracking active (redirect={redirect_id})")
+            backoff = 5
+
+            last_probe = time.time()
+            while True:
+                msg = pubsub.get_message(timeout=5)
+                if msg and msg.get('type') == 'message':
+                    _on_tracking_invalidate(msg.get('data'))
+                if time.time() - last_probe >= _TRACKING_PROBE_INTERVAL:
+                    last_probe = time.time()
+                    if not _tracking_link_ok(trk, redirect_id):
+                        raise ConnectionError('tracking redirect broken')
+        except redis.exceptions.ResponseError as e:
+            logger.warning(f"[CACHE] Redis client tracking unsupported — using TTL caches ({e})")
+            _tracking_active.clear()
+            return
+        except Exception as e:
+            if _tracking_active.is_set():
+                logger.warning(f"[CACHE] Client tracking link lost — falling back to TTL caches: {e}")
+            else:
+                logger.warning(f"[CACHE] Client tracking setup failed: {e}")
+        finally:
+            if _tracking_active.is_set():
+                _tracking_active.clear()
+                _clear_config_caches()
+            for conn in (pubsub, trk):
+                try:
+                    if conn is not None:
+                        conn.close()
+                except Exception:
+                    pass
+        time.sleep(backoff)
+        backoff = min(backoff * 2, 300)
+
+def start_client_tracking():
+    if not _CLIENT_TRACKING:
+        return
+    threading.Thread(target=_client_tracking_worker, daemon=True).start()
+
 
 # ─────────────────────────────────────────────────────────────────────────────
 #  PLAN 2: PER-GROUP RATE LIMITING + PRIORITY QUEUE
@@ -351,11 +944,17 @@ def _invalidate_group_config_cache(chat_id):
 
 # Priority levels: 1=join replies, 2=start@ replies, 3=manual broadcasts, 4=global repeat
 
-_send_queue = []                   # heapq of (priority, seq, chat_id, text, result_holder)
+_send_queue = []                   # heapq of (priority, seq, chat_id, text, result_holder, reply_markup, park)
 _send_queue_lock = threading.Lock()
 _send_queue_event = threading.Event()
 _send_queue_seq = 0                # tie-breaker for same priority
 _INTER_MSG_DELAY = 0.4            # 0.4s between any two sends globally (≤2.5/sec)
+
+# Graceful drain (see shutdown()): once _shutting_down is set new sends are
+# parked in Redis for the next instance instead of the in-memory queue.
+_shutting_down = threading.Event()
+_send_worker_stop = threading.Event()
+_send_worker_stopped = threading.Event()
 _MAX_PER_GROUP_PER_MIN = 18       # stay under Telegram's ~20/min per-chat limit
 
 # Per-group rate state (in memory — no Redis needed for this)
@@ -389,8 +988,106 @@ def _group_set_cooldown(chat_id, retry_after):
     with _group_rate_lock:
         _group_cooldown_until[chat_id] = time.time() + retry_after
     _increment_flood_counter(retry_after)
+    record_metric('rate_limited', chat_id)
     logger.warning(f"[FLOOD] Group {chat_id} cooldown {retry_after}s")
 
+# ─── Group health aggregate ──────────────────────────────────────────────────
+# Updated on every send outcome so the health report never walks the fleet:
+#   group_health             hash  chat_id → "class|first_ts|last_ts|error"
+#   group_health:{class}     set   failing chat_ids per error class (SCARD = count)
+#   group_health_offenders   zset  chat_id → failures since it last worked
+# A successful send clears the group from all of them in one pipeline.
+_HEALTH_CLASSES = [
+    ('access',    '🚫 Kicked / no access'),
+    ('not_found', '❓ Chat not found / migrated'),
+    ('rights',    '🔒 Missing rights'),
+    ('network',   '🌐 Network / timeout'),
+    ('other',     '❌ Other API errors'),
+]
+_HEALTH_CLASS_LABELS = dict(_HEALTH_CLASSES)
+
+def _classify_group_error(err):
+    low = err.lower()
+    if 'forbidden' in low or 'kicked' in low or 'not a member' in low or '403' in low:
+        return 'access'
+    if 'chat not found' in low or 'migrated' in low or 'upgraded to a supergroup' in low:
+        return 'not_found'
+    if 'not enough rights' in low or 'have no rights' in low or 'need administrator' in low:
+        return 'rights'
+    if 'timed out' in low or 'timeout' in low or 'connection' in low or 'max retries' in low:
+        return 'network'
+    return 'other'
+
+def _parse_group_health(raw):
+    if not raw:
+        return None
+    cls, first_ts, last_ts, err = raw.split('|', 3)
+    return {'class': cls, 'first': int(first_ts), 'last': int(last_ts), 'error': err}
+
+def record_group_failure(chat_id, err):
+    err = err[:200]
+    cls = _classify_group_error(err)
+    now = int(time.time())
+    prev = _parse_group_health(r.hget('group_health', chat_id))
+    pipe = r.pipeline()
+    pipe.hset('group_health', chat_id, f"{cls}|{prev['first'] if prev else now}|{now}|{err}")
+    for other, _ in _HEALTH_CLASSES:
+        if other != cls:
+            pipe.srem(f'group_health:{other}', chat_id)
+    pipe.sadd(f'group_health:{cls}', chat_id)
+    pipe.zincrby('group_health_offenders', 1, chat_id)
+    pipe.execute()
+
+def clear_group_health(chat_id):
+    pipe = r.pipeline()
+    pipe.hdel('group_health', chat_id)
+    pipe.zrem('group_health_offenders', chat_id)
+    for cls, _ in _HEALTH_CLASSES:
+        pipe.srem(f'group_health:{cls}', chat_id)
+    pipe.execute()
+
+def get_group_health(chat_id):
+    """{'class', 'first', 'last', 'error'} for a failing group, else None."""
+    return _parse_group_health(r.hget('group_health', chat_id))
+
+def reset_group_health():
+    r.delete('group_health', 'group_health_offenders', *[f'group_health:{cls}' for cls, _ in _HEALTH_CLASSES])
+
+def _fold_legacy_group_errors():
+    """Per-group errors used to live in group_error:{id} (older processes and
+    older backups); fold them into the aggregate."""
+    for key in list(r.scan_iter('group_error:*')):
+        err = r.get(key)
+        try:
+            if err:
+                record_group_failure(int(key.split(':', 1)[1]), err)
+        except ValueError:
+            pass
+        r.delete(key)
+
+def _rebuild_group_health_index():
+    """Derive the per-class sets and the offenders zset from the group_health
+    hash, which is the only part backups carry. Failure counts already in the
+    zset are kept; groups new to it start at 1."""
+    health = r.hgetall('group_health')
+    by_class = {cls: [] for cls, _ in _HEALTH_CLASSES}
+    for chat_id, raw in health.items():
+        try:
+            by_class.setdefault(_parse_group_health(raw)['class'], []).append(chat_id)
+        except ValueError:
+            pass
+    stale = [m for m in r.zrange('group_health_offenders', 0, -1) if m not in health]
+    pipe = r.pipeline()
+    for cls, members in by_class.items():
+        pipe.delete(f'group_health:{cls}')
+        if members:
+            pipe.sadd(f'group_health:{cls}', *members)
+    if stale:
+        pipe.zrem('group_health_offenders', *stale)
+    if health:
+        pipe.zadd('group_health_offenders', {chat_id: 1 for chat_id in health}, nx=True)
+    pipe.execute()
+
 def _do_send(chat_id, text, _flood_callback=None, reply_markup=None):
     """Execute send. 429 is per-group only — never blocks other groups."""
     for attempt in range(3):
@@ -400,9 +1097,9 @@ def _do_send(chat_id, text, _flood_callback=None, reply_markup=None):
                 disable_web_page_preview=True,
                 reply_markup=reply_markup
             )
-            r.srem('groups_with_errors', str(chat_id))
-            r.delete(f'group_error:{chat_id}')
+            clear_group_health(chat_id)
             _group_record_send(chat_id)
+            record_metric('send_ok', chat_id)
             return sent
         except telebot.apihelper.ApiTelegramException as e:
             err = str(e)
@@ -418,43 +1115,52 @@ def _do_send(chat_id, text, _flood_callback=None, reply_markup=None):
                 else:
                     return None
             else:
-                r.sadd('groups_with_errors', str(chat_id))
-                r.set(f'group_error:{chat_id}', err[:200])
+                record_group_failure(chat_id, err)
+                record_metric('send_fail', chat_id)
                 _log_runtime_error(chat_id, 'send', err[:200])
                 logger.error(f"[ERR] send to {chat_id}: {err[:100]}")
                 return None
         except Exception as e:
-            r.sadd('groups_with_errors', str(chat_id))
-            r.set(f'group_error:{chat_id}', str(e)[:200])
+            record_group_failure(chat_id, str(e))
+            record_metric('send_fail', chat_id)
             _log_runtime_error(chat_id, 'send', str(e)[:200])
             logger.error(f"[ERR] send to {chat_id}: {str(e)[:100]}")
             return None
     return None
 
+_send_enqueued_at = {}   # seq → enqueue time, for per-priority wait histograms
+
 def _send_queue_worker():
     """Priority queue worker. Per-group rate limit enforced before each send."""
     while True:
         _send_queue_event.wait()
         requeue_batch = []
-        while True:
+        while not _send_worker_stop.is_set():
             with _send_queue_lock:
                 if not _send_queue:
                     _send_queue_event.clear()
                     break
-                priority, seq, chat_id, text, result_holder, reply_markup = heapq.heappop(_send_queue)
+                priority, seq, chat_id, text, result_holder, reply_markup, park = heapq.heappop(_send_queue)
 
             if not _group_is_allowed(chat_id):
-                requeue_batch.append((priority + 0.001, seq, chat_id, text, result_holder, reply_markup))
+                requeue_batch.append((priority + 0.001, seq, chat_id, text, result_holder, reply_markup, park))
                 time.sleep(0.05)
                 continue
 
+            started = time.time()
             sent = _do_send(chat_id, text, reply_markup=reply_markup)
+            observe_latency('send_latency_seconds', time.time() - started)
 
             if sent is None and not _group_is_allowed(chat_id):
-                requeue_batch.append((priority + 0.001, seq, chat_id, text, result_holder, reply_markup))
+                requeue_batch.append((priority + 0.001, seq, chat_id, text, result_holder, reply_markup, park))
             else:
                 if result_holder is not None:
                     result_holder.append(sent)
+                with _send_queue_lock:
+                    enqueued = _send_enqueued_at.pop(seq, None)
+                if enqueued is not None:
+                    observe_latency('send_queue_wait_seconds', started - enqueued,
+                                    f'priority="{int(priority)}"')
 
             time.sleep(_INTER_MSG_DELAY)
 
@@ -463,22 +1169,63 @@ def _send_queue_worker():
                 for item in requeue_batch:
                     heapq.heappush(_send_queue, item)
                 _send_queue_event.set()
-            time.sleep(1)
+            if not _send_worker_stop.is_set():
+                time.sleep(1)
+
+        if _send_worker_stop.is_set():
+            _send_worker_stopped.set()
+            return
 
 _send_worker_thread = threading.Thread(target=_send_queue_worker, daemon=True)
-_send_worker_thread.start()
 
-def _enqueue(chat_id, text, result_holder, priority=3, reply_markup=None):
+def _persist_sends(items):
+    """Park [(priority, chat_id, text, reply_markup)] in Redis for the next instance."""
+    if not items:
+        return
+    pipe = r.pipeline(transaction=False)
+    for priority, chat_id, text, reply_markup in items:
+        pipe.rpush('pending_sends', json_dumps({
+            'priority': int(priority), 'chat_id': chat_id, 'text': text,
+            'markup': reply_markup.to_json() if reply_markup else None,
+        }))
+    pipe.execute()
+
+def _resume_pending_sends():
+    """Re-queue sends a previous instance parked while shutting down."""
+    pipe = r.pipeline()
+    pipe.lrange('pending_sends', 0, -1)
+    pipe.delete('pending_sends')
+    items = pipe.execute()[0]
+    for raw in items:
+        item = json_loads(raw)
+        markup = types.InlineKeyboardMarkup.de_json(item['markup']) if item.get('markup') else None
+        safe_send_nowait(item['chat_id'], item['text'], priority=item['priority'], reply_markup=markup)
+    if items:
+        logger.info(f"[STARTUP] Resumed {len(items)} send(s) parked by the previous instance")
+
+def _enqueue(chat_id, text, result_holder, priority=3, reply_markup=None, park=True):
     global _send_queue_seq
+    if _shutting_down.is_set():
+        if park:
+            try:
+                _persist_sends([(priority, chat_id, text, reply_markup)])
+            except Exception as e:
+                logger.error(f"[SHUTDOWN] Could not park send to {chat_id}: {e}")
+        if result_holder is not None:
+            result_holder.append(None)
+        return
     with _send_queue_lock:
         _send_queue_seq += 1
-        heapq.heappush(_send_queue, (priority, _send_queue_seq, chat_id, text, result_holder, reply_markup))
+        _send_enqueued_at[_send_queue_seq] = time.time()
+        heapq.heappush(_send_queue, (priority, _send_queue_seq, chat_id, text, result_holder, reply_markup, park))
         _send_queue_event.set()
 
-def safe_send(chat_id, text, priority=3, reply_markup=None):
-    """Queue a message, block until sent. Returns Message or None."""
+def safe_send(chat_id, text, priority=3, reply_markup=None, park=True):
+    """Queue a message, block until sent. Returns Message or None.
+    park=False: a send cut off by shutdown is dropped instead of parked for
+    the next instance (the caller keeps its own checkpoint)."""
     result_holder = []
-    _enqueue(chat_id, text, result_holder, priority, reply_markup=reply_markup)
+    _enqueue(chat_id, text, result_holder, priority, reply_markup=reply_markup, park=park)
     deadline = time.time() + 180
     while time.time() < deadline:
         if result_holder:
@@ -498,6 +1245,32 @@ def safe_delete(chat_id, message_id):
         _log_runtime_error(chat_id, 'delete', str(e)[:200])
         logger.error(f"[DELETE ERROR] chat_id={chat_id} message_id={message_id} error={e}")
 
+# ─── Scheduled deletes ───────────────────────────────────────────────────────
+# Self-delete timers live in the 'pending_deletes' sorted set (member
+# "chat_id:message_id", score = due time) rather than in sleeping threads,
+# so a deploy or crash doesn't leave messages behind.
+_DELETE_POLL_INTERVAL = 5
+
+def schedule_delete(chat_id, message_id, delay):
+    r.zadd('pending_deletes', {f'{chat_id}:{message_id}': time.time() + delay})
+
+def _delete_scheduler_worker():
+    while True:
+        time.sleep(_DELETE_POLL_INTERVAL)
+        if not _is_leader.is_set():
+            continue
+        try:
+            due = r.zrangebyscore('pending_deletes', '-inf', time.time(), start=0, num=100)
+            for member in due:
+                # ZREM is the claim — only one instance deletes each message
+                if r.zrem('pending_deletes', member):
+                    chat_id, message_id = member.rsplit(':', 1)
+                    safe_delete(int(chat_id), int(message_id))
+        except Exception as e:
+            logger.error(f"[DELETE] Scheduler error: {e}")
+
+_delete_scheduler_thread = threading.Thread(target=_delete_scheduler_worker, daemon=True)
+
 
 # ─────────────────────────────────────────────────────────────────────────────
 #  PER-GROUP REPEATING MESSAGE
@@ -510,15 +1283,27 @@ def safe_delete(chat_id, message_id):
 active_repeat_threads = {}
 _repeat_thread_lock = threading.Lock()
 
-def repeat_message_task(chat_id):
-    """Per-group repeat thread. Uses in-memory cache — reads Redis only every 5 min."""
+def repeat_message_task(chat_id, first_delay=0):
+    """Per-group repeat thread. Uses in-memory cache — reads Redis only every 5 min.
+    `first_delay` holds the first send back (warm start after a deploy)."""
     _last_cfg_refresh = 0.0
     _cfg = {}
 
+    deadline = time.time() + first_delay
+    while time.time() < deadline:
+        time.sleep(max(0, min(10, deadline - time.time())))
+        _repeat_heartbeats[chat_id] = time.time()
+        if _get_cached_group_config(chat_id).get('repeat_task') != 'True':
+            return
+
     while True:
+        if not _is_leader.is_set():
+            return  # the process holding bg_leader runs this group's repeat
         now = time.time()
-        # Refresh config from Redis every 5 minutes (or on first run)
-        if now - _last_cfg_refresh >= _GROUP_CONFIG_CACHE_TTL:
+        _repeat_heartbeats[chat_id] = now
+        # Refresh config from Redis every 5 minutes (or on first run).
+        # With client tracking the cached read is free and always current.
+        if _tracking_active.is_set() or now - _last_cfg_refresh >= _GROUP_CONFIG_CACHE_TTL:
             _cfg = _get_cached_group_config(chat_id)
             _last_cfg_refresh = now
 
@@ -544,16 +1329,16 @@ def repeat_message_task(chat_id):
             save_last_sent(chat_id, sent.message_id)
 
             if self_delete_after:
-                secs = int(self_delete_after)
-                msg_id_snap = sent.message_id
-                def _self_delete(cid=chat_id, mid=msg_id_snap, delay=secs):
-                    time.sleep(delay)
-                    safe_delete(cid, mid)
-                threading.Thread(target=_self_delete, daemon=True).start()
+                schedule_delete(chat_id, sent.message_id, int(self_delete_after))
 
         interval = int(_cfg.get('repeat_interval') or 3600)
         elapsed = time.time() - cycle_start
         sleep_time = max(interval - elapsed, 1)
+        try:
+            # Lets the next deploy resume this group's schedule instead of firing at once
+            r.set(f'next_repeat_at:{chat_id}', int(time.time() + sleep_time), ex=interval * 2 + 60)
+        except Exception:
+            pass
 
         # Sleep in chunks so we can pick up stop signals within 10s
         slept = 0
@@ -563,24 +1348,95 @@ def repeat_message_task(chat_id):
             slept += chunk
             # Quick in-memory check: re-read from Redis only if cache is stale
             now2 = time.time()
-            if now2 - _last_cfg_refresh >= _GROUP_CONFIG_CACHE_TTL:
+            _repeat_heartbeats[chat_id] = now2
+            if _tracking_active.is_set() or now2 - _last_cfg_refresh >= _GROUP_CONFIG_CACHE_TTL:
                 _cfg = _get_cached_group_config(chat_id)
                 _last_cfg_refresh = now2
-            if _cfg.get('repeat_task') != 'True':
+            if _cfg.get('repeat_task') != 'True' or not _is_leader.is_set():
                 return
 
-def start_repeat_thread(chat_id):
-    key = f'repeat_task:{chat_id}'
-    if r.get(key) != 'True':
+def start_repeat_thread(chat_id, first_delay=0, enabled=None):
+    if enabled is None:
+        enabled = r.get(f'repeat_task:{chat_id}') == 'True'
+    if not enabled:
         return
     with _repeat_thread_lock:
         existing = active_repeat_threads.get(chat_id)
         if existing and existing.is_alive():
             return
-        thread = threading.Thread(target=repeat_message_task, args=(chat_id,), daemon=True)
+        thread = threading.Thread(target=repeat_message_task, args=(chat_id, first_delay), daemon=True)
         thread.start()
         active_repeat_threads[chat_id] = thread
 
+# ─── Warm start ──────────────────────────────────────────────────────────────
+# After a deploy every repeating group used to fire within a second. Now one
+# pipeline loads every group's repeat config plus its persisted next-fire
+# time; groups still inside their interval wait it out, and overdue groups
+# are spread evenly over REPEAT_WARM_RAMP seconds, most overdue first.
+_REPEAT_WARM_RAMP = int(os.environ.get('REPEAT_WARM_RAMP', 300))
+_REPEAT_CONFIG_FIELDS = ('repeat_task', 'repeat_text', 'repeat_interval',
+                         'repeat_autodelete', 'repeat_self_delete')
+
+def _warm_start_repeats(ramp=None):
+    ramp = _REPEAT_WARM_RAMP if ramp is None else ramp
+    groups = get_groups()
+    if not groups:
+        return
+    gen = _tracking_generation
+    pipe = r.pipeline(transaction=False)
+    for g in groups:
+        for field in _REPEAT_CONFIG_FIELDS:
+            pipe.get(f'{field}:{g}')
+        pipe.get(f'next_repeat_at:{g}')
+    results = pipe.execute()
+
+    now = time.time()
+    width = len(_REPEAT_CONFIG_FIELDS) + 1
+    scheduled, overdue = [], []
+    for i, g in enumerate(groups):
+        row = results[i * width:(i + 1) * width]
+        cfg = dict(zip(_REPEAT_CONFIG_FIELDS, row[:-1]))
+        cfg['_fetched'] = now
+        with _group_repeat_cache_lock:
+            if gen == _tracking_generation:
+                _group_repeat_cache[g] = cfg
+        if cfg['repeat_task'] != 'True' or not cfg['repeat_text']:
+            continue
+        next_ts = float(row[-1]) if row[-1] else 0
+        if next_ts > now:
+            scheduled.append((g, next_ts - now))
+        else:
+            overdue.append((next_ts, g))
+
+    overdue.sort()
+    step = ramp / len(overdue) if overdue else 0
+    for slot, (_, g) in enumerate(overdue):
+        start_repeat_thread(g, first_delay=slot * step, enabled=True)
+    for g, delay in scheduled:
+        start_repeat_thread(g, first_delay=delay, enabled=True)
+    logger.info(f"[WARMSTART] {len(scheduled)} repeat task(s) resumed on schedule, "
+                f"{len(overdue)} overdue spread over {ramp}s")
+
+def _reconcile_repeats():
+    """Leader only: start repeat threads that are enabled but not running here —
+    switched on from another process, or stopped by a leadership handover."""
+    with _repeat_thread_lock:
+        running = {g for g, t in active_repeat_threads.items() if t.is_alive()}
+    missing = [g for g in get_groups() if g not in running]
+    if missing:
+        pipe = r.pipeline(transaction=False)
+        for g in missing:
+            pipe.get(f'repeat_task:{g}')
+            pipe.exists(f'repeat_text:{g}')
+            pipe.get(f'next_repeat_at:{g}')
+        results = pipe.execute()
+        now = time.time()
+        for i, g in enumerate(missing):
+            enabled, has_text, next_ts = results[i * 3:i * 3 + 3]
+            if enabled == 'True' and has_text:
+                start_repeat_thread(g, first_delay=max(0, float(next_ts or 0) - now), enabled=True)
+    start_global_repeat_thread()
+
 
 
 # GLOBAL REPEAT - OPTIMIZED WITH CACHING
@@ -600,6 +1456,10 @@ def _global_repeat_worker():
     _next_send = {}   # chat_id → float
 
     while True:
+        if not _is_leader.is_set():
+            print("[GLOBAL REPEAT] Stopped (no longer leader)")
+            _global_repeat_running = False
+            return
         now = time.time()
 
         # Refresh global config every 60 seconds
@@ -644,7 +1504,7 @@ def _global_repeat_worker():
 
         for chat_id in groups:
             # Re-check task flag from cache (no Redis read per group)
-            if _cfg_cache.get('task') != 'True':
+            if _cfg_cache.get('task') != 'True' or not _is_leader.is_set():
                 break
 
             # Initialize next_send from Redis if first time seeing this group
@@ -687,10 +1547,7 @@ def _global_repeat_worker():
             if sent:
                 r.set(f'global_last_sent:{chat_id}', str(sent.message_id))
                 if self_delete_secs is not None:
-                    def _self_del(cid=chat_id, mid=sent.message_id, delay=self_delete_secs):
-                        time.sleep(delay)
-                        safe_delete(cid, mid)
-                    threading.Thread(target=_self_del, daemon=True).start()
+                    schedule_delete(chat_id, sent.message_id, self_delete_secs)
 
             sent_this_tick = True
             time.sleep(_INTER_MSG_DELAY)
@@ -723,24 +1580,134 @@ def reset_global_repeat_schedule():
         r.delete(f'gr_next_send:{g}')
 
 
-# ─── Heartbeat Task ───────────────────────────────────────────────────────────
+# ─── Heartbeat & Self-Diagnostics ─────────────────────────────────────────────
+# The heartbeat samples every 10s, logs a summary every 60s and runs the
+# checks below. A failing check alerts OWNER_ID at most once per
+# _DIAG_ALERT_COOLDOWN; the first passing run after an alert sends a
+# recovery note. Each threshold can be overridden by the env var of the same
+# name without the leading underscore (e.g. DIAG_QUEUE_AGE_SLO=300).
+_HEARTBEAT_TICK = 10
+_HEARTBEAT_LOG_EVERY = 60
+_DIAG_ALERT_COOLDOWN = int(os.environ.get('DIAG_ALERT_COOLDOWN', 1800))
+_DIAG_QUEUE_AGE_SLO = int(os.environ.get('DIAG_QUEUE_AGE_SLO', 120))      # oldest queued message, seconds
+_DIAG_REDIS_P95_MS = float(os.environ.get('DIAG_REDIS_P95_MS', 50))
+_DIAG_THREAD_GROWTH = int(os.environ.get('DIAG_THREAD_GROWTH', 50))       # extra threads vs. 15 min ago
+_DIAG_RSS_GROWTH_MB_H = float(os.environ.get('DIAG_RSS_GROWTH_MB_H', 100))
+_DIAG_WEBHOOK_LAG_S = float(os.environ.get('DIAG_WEBHOOK_LAG_S', 30))     # p95 of (handled − sent by Telegram)
+_DIAG_REPEAT_STALL_S = int(os.environ.get('DIAG_REPEAT_STALL_S', 600))    # repeat loop hasn't ticked for this long
+
+_redis_ping_ms = deque(maxlen=90)          # last 15 min of 10s samples
+_diag_history = deque(maxlen=60)           # (ts, threads, rss_mb), once a minute
+_webhook_lag = deque(maxlen=500)           # (ts, lag_s)
+_repeat_heartbeats = {}                    # chat_id → last repeat loop tick
+_diag_alerted = {}                         # check → last alert ts
+_diag_last_results = []                    # [(check, ok, detail)] from the last run
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def _record_webhook_lag(update):
+    # An edit's `date` is when the original message was sent; edit_date is
+    # when Telegram emitted this update.
+    if update.edited_message is not None:
+        sent_at = update.edited_message.edit_date
+    else:
+        msg = update.message or update.my_chat_member
+        sent_at = getattr(msg, 'date', None)
+    if sent_at:
+        _webhook_lag.append((time.time(), max(0, time.time() - sent_at)))
+
+def _run_diagnostics():
+    now = time.time()
+    results = []
+
+    with _send_queue_lock:
+        oldest = next(iter(_send_enqueued_at.values()), None)
+        depth = len(_send_queue)
+    age = now - oldest if oldest else 0
+    results.append(('queue_age', age <= _DIAG_QUEUE_AGE_SLO,
+                    f"oldest queued message {age:.0f}s ({depth} pending, SLO {_DIAG_QUEUE_AGE_SLO}s)"))
+
+    pings = list(_redis_ping_ms)
+    p50, p95, p99 = (_percentile(pings, p) for p in (50, 95, 99))
+    results.append(('redis_latency', p95 <= _DIAG_REDIS_P95_MS,
+                    f"Redis ping p50 {p50:.1f}ms / p95 {p95:.1f}ms / p99 {p99:.1f}ms"))
+
+    if len(_diag_history) >= 2:
+        first, last = _diag_history[0], _diag_history[-1]
+        window_h = max((last[0] - first[0]) / 3600, 1 / 60)
+        base_threads = _diag_history[-16][1] if len(_diag_history) >= 16 else first[1]
+        results.append(('thread_growth', last[1] - base_threads <= _DIAG_THREAD_GROWTH,
+                        f"{last[1]} threads ({last[1] - base_threads:+d} in 15 min)"))
+        rate = (last[2] - first[2]) / window_h
+        results.append(('rss_growth', rate <= _DIAG_RSS_GROWTH_MB_H or window_h < 0.5,
+                        f"RSS {last[2]:.0f} MB, {rate:+.0f} MB/h over {window_h * 60:.0f} min"))
+
+    lags = [lag for ts, lag in list(_webhook_lag) if now - ts <= 300]
+    if lags:
+        lag_p95 = _percentile(lags, 95)
+        results.append(('webhook_lag', lag_p95 <= _DIAG_WEBHOOK_LAG_S,
+                        f"webhook lag p95 {lag_p95:.1f}s over {len(lags)} updates"))
+
+    with _repeat_thread_lock:
+        alive = [cid for cid, t in active_repeat_threads.items() if t.is_alive()]
+    stuck = [cid for cid in alive if now - _repeat_heartbeats.get(cid, now) > _DIAG_REPEAT_STALL_S]
+    results.append(('stuck_repeats', not stuck,
+                    f"{len(stuck)} of {len(alive)} repeat tasks stalled"
+                    + (f": {', '.join(str(c) for c in stuck[:5])}" if stuck else "")))
+    return results
+
+def _diag_alert(results):
+    now = time.time()
+    for check, ok, detail in results:
+        last = _diag_alerted.get(check)
+        if ok:
+            if last is not None:
+                _diag_alerted.pop(check, None)
+                text = f"✅ Recovered: {check} — {detail}"
+            else:
+                continue
+        elif last is None or now - last >= _DIAG_ALERT_COOLDOWN:
+            _diag_alerted[check] = now
+            text = f"🚨 Diagnostics: {check}\n{detail}"
+        else:
+            continue
+        logger.warning(f"[DIAG] {text}")
+        try:
+            # Straight to the API: the send queue may be the thing that is stuck
+            bot.send_message(OWNER_ID, text)
+        except Exception as e:
+            logger.error(f"[DIAG] Alert to owner failed: {e}")
+
 def _heartbeat_worker():
-    """Runs every 60 seconds and logs key system metrics."""
+    """Samples every 10s; logs key system metrics and runs diagnostics every 60s."""
+    global _diag_last_results
+    last_log = time.time()
     while True:
-        time.sleep(60)
+        time.sleep(_HEARTBEAT_TICK)
         try:
-            with _repeat_thread_lock:
-                active_repeats = sum(1 for t in active_repeat_threads.values() if t.is_alive())
-            total_groups = r.scard('groups')
             try:
+                started = time.time()
                 r.ping()
+                _redis_ping_ms.append((time.time() - started) * 1000)
                 redis_status = "OK"
             except Exception:
                 redis_status = "ERROR"
+            if time.time() - last_log < _HEARTBEAT_LOG_EVERY:
+                continue
+            last_log = time.time()
+
+            with _repeat_thread_lock:
+                active_repeats = sum(1 for t in active_repeat_threads.values() if t.is_alive())
+            total_groups = r.scard('groups')
             try:
                 proc = psutil.Process()
                 mem_mb = proc.memory_info().rss / 1024 / 1024
                 mem_str = f"{mem_mb:.1f} MB"
+                _diag_history.append((time.time(), threading.active_count(), mem_mb))
             except Exception:
                 mem_str = "N/A"
             with _flood_wait_lock:
@@ -749,11 +1716,140 @@ def _heartbeat_worker():
                 f"HEARTBEAT | active_repeats={active_repeats} | groups={total_groups} "
                 f"| redis={redis_status} | memory={mem_str} | flood_waits={flood_count}"
             )
+            _diag_last_results = _run_diagnostics()
+            _diag_alert(_diag_last_results)
         except Exception as e:
             logger.error(f"Heartbeat error: {e}")
 
 _heartbeat_thread = threading.Thread(target=_heartbeat_worker, daemon=True)
-_heartbeat_thread.start()
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  METRICS — ROLLING TIME SERIES
+#  Events are counted in memory and flushed every 10s into Redis hashes at
+#  three resolutions at once (minute / hour / day), each with its own
+#  retention.  Field names are "{metric}" for the global total and
+#  "{metric}:{chat_id}" for the per-group share, so one HGETALL of a bucket
+#  answers both "how many" and "which groups".
+# ─────────────────────────────────────────────────────────────────────────────
+
+_METRICS_FLUSH_INTERVAL = 10
+_METRIC_RESOLUTIONS = {            # name → (bucket seconds, retention seconds)
+    'm': (60,    3 * 3600),
+    'h': (3600,  8 * 86400),
+    'd': (86400, 92 * 86400),
+}
+_METRIC_LABELS = {
+    'send_ok':      '✅ Sends',
+    'send_fail':    '❌ Send failures',
+    'rate_limited': '⚡ 429s',
+    'join':         '👋 Joins',
+    'bot_kick':     '🤖 Bots kicked',
+    'bot_removed':  '🚪 Bot removed',
+    'update_duplicate': '♻️ Duplicate updates',
+    'edit_skipped': '🪞 Menu edits skipped',
+}
+
+_metrics_pending = {}              # (metric, chat_id or None) → count
+_metric_totals = {}                # metric → count since process start (/metrics)
+_metrics_lock = threading.Lock()
+
+def record_metric(metric, chat_id=None, n=1):
+    """Count an event. Cheap — only touches memory; flushed in the background."""
+    with _metrics_lock:
+        _metric_totals[metric] = _metric_totals.get(metric, 0) + n
+        key = (metric, None)
+        _metrics_pending[key] = _metrics_pending.get(key, 0) + n
+        if chat_id is not None:
+            key = (metric, chat_id)
+            _metrics_pending[key] = _metrics_pending.get(key, 0) + n
+
+def _metric_bucket_key(res, ts):
+    step = _METRIC_RESOLUTIONS[res][0]
+    return f'metrics:{res}:{int(ts) // step}'
+
+def _sample_queue_depth():
+    """Queue depth gauge, recorded as sum + sample count so every resolution
+    can show an average without needing a server-side max/avg."""
+    with _send_queue_lock:
+        per_group = {}
+        for item in _send_queue:
+            per_group[item[2]] = per_group.get(item[2], 0) + 1
+        total = len(_send_queue)
+    with _metrics_lock:
+        for key, n in [(('queue_samples', None), 1), (('queue_depth_sum', None), total)] + \
+                      [(('queue_depth_sum', cid), depth) for cid, depth in per_group.items()]:
+            _metrics_pending[key] = _metrics_pending.get(key, 0) + n
+
+def _flush_metrics():
+    with _metrics_lock:
+        pending = dict(_metrics_pending)
+        _metrics_pending.clear()
+    if not pending:
+        return
+    now = time.time()
+    pipe = r.pipeline()
+    for res, (_, retention) in _METRIC_RESOLUTIONS.items():
+        key = _metric_bucket_key(res, now)
+        for (metric, chat_id), n in pending.items():
+            if n:
+                pipe.hincrby(key, metric if chat_id is None else f'{metric}:{chat_id}', n)
+        pipe.expire(key, retention)
+    try:
+        pipe.execute()
+    except Exception:
+        # MULTI/EXEC applied nothing — hand the counts back for the next flush
+        with _metrics_lock:
+            for k, n in pending.items():
+                _metrics_pending[k] = _metrics_pending.get(k, 0) + n
+        raise
+
+def _metrics_worker():
+    while True:
+        time.sleep(_METRICS_FLUSH_INTERVAL)
+        try:
+            _sample_queue_depth()
+            _flush_metrics()
+        except Exception as e:
+            logger.error(f"[METRICS] Flush failed: {e}")
+
+_metrics_thread = threading.Thread(target=_metrics_worker, daemon=True)
+
+def metrics_series(metric, res='h', points=24, chat_id=None):
+    """Counts for the last `points` buckets at resolution `res`, oldest first."""
+    step = _METRIC_RESOLUTIONS[res][0]
+    now = time.time()
+    field = metric if chat_id is None else f'{metric}:{chat_id}'
+    pipe = r.pipeline()
+    for i in range(points - 1, -1, -1):
+        pipe.hget(_metric_bucket_key(res, now - i * step), field)
+    return [int(v or 0) for v in pipe.execute()]
+
+def metrics_top_groups(metric, res='h', points=24, limit=5):
+    """[(chat_id, total)] — the groups contributing most to `metric`."""
+    step = _METRIC_RESOLUTIONS[res][0]
+    now = time.time()
+    pipe = r.pipeline()
+    for i in range(points):
+        pipe.hgetall(_metric_bucket_key(res, now - i * step))
+    totals = {}
+    prefix = f'{metric}:'
+    for bucket in pipe.execute():
+        for field, val in bucket.items():
+            if field.startswith(prefix):
+                try:
+                    chat_id = int(field[len(prefix):])
+                except ValueError:
+                    continue
+                totals[chat_id] = totals.get(chat_id, 0) + int(val)
+    return sorted(totals.items(), key=lambda kv: kv[1], reverse=True)[:limit]
+
+def _sparkline(values):
+    bars = '▁▂▃▄▅▆▇█'
+    peak = max(values) if values else 0
+    if not peak:
+        return bars[0] * len(values)
+    return ''.join(bars[min(len(bars) - 1, v * len(bars) // (peak + 1))] for v in values)
 
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -785,13 +1881,11 @@ _BACKUP_SCALAR_KEYS = [
 ]
 
 _BACKUP_SET_KEYS = [
-    'groups', 'bot_users', 'recently_removed_groups', 'groups_with_errors',
+    'groups', 'recently_removed_groups',
     'bot_kick_whitelist',
 ]
 
-_BACKUP_HASH_KEYS = [
-    'user_info', 'user_first_seen',
-]
+_BACKUP_HASH_KEYS = ['group_health']
 
 _BACKUP_PATTERN_KEYS = [
     'repeat_task:*', 'repeat_text:*', 'repeat_interval:*',
@@ -801,11 +1895,12 @@ _BACKUP_PATTERN_KEYS = [
     'join_reply_autodelete:*', 'join_reply_last_msg:*',
     'bot_kick_enabled:*', 'bot_kick_count:*', 'bot_kick_no_perm:*',
     'link_only:*', 'last_sent:*', 'global_last_sent:*',
-    'gr_next_send:*', 'group_error:*',
+    'gr_next_send:*',
     'sent_messages:*', 'private_sent:*',
     'aawm_enabled:*', 'aawm_text:*', 'aawm_buttons:*',
     'cache_group_title:*', 'cache_group_status:*',
     'inline_btns:*',
+    'users:*', 'users_info:*', 'users_fs:*',
     'embedded_draft:*', 'post_draft:*',
     'btn_broadcast_text:*', 'btn_broadcast_btn_text:*', 'btn_broadcast_btn_url:*',
 ]
@@ -915,8 +2010,7 @@ def _collect_all_redis_data():
 
 def _build_backup_bytes(data):
     """Serialize backup dict to UTF-8 JSON bytes wrapped in io.BytesIO."""
-    raw = json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
-    buf = io.BytesIO(raw)
+    buf = io.BytesIO(json_dumps_bytes(data, pretty=True))
     buf.name = f"backup_{data['meta']['timestamp'][:10]}.json"
     return buf
 
@@ -939,6 +2033,9 @@ def _auto_backup_worker():
     # Stagger first run by 5 minutes so startup noise settles
     time.sleep(300)
     while True:
+        if not _is_leader.is_set():
+            time.sleep(60)
+            continue
         try:
             data, total = _collect_all_redis_data()
             buf = _build_backup_bytes(data)
@@ -1021,7 +2118,7 @@ def start_backup_thread():
 @bot.message_handler(content_types=['new_chat_members'])
 def handle_new_chat_members(message):
     chat_id = message.chat.id
-    bot_id = bot.get_me().id
+    bot_id = get_bot_id()
 
     bot_joined = any(m.id == bot_id for m in message.new_chat_members)
 
@@ -1090,7 +2187,7 @@ def handle_new_chat_members(message):
 
         if not kicked:
             try:
-                bot_member = bot.get_chat_member(chat_id, bot_id)
+                bot_member = get_bot_member(chat_id, force_refresh=True)
                 bot_is_admin = bot_member.status in ['administrator', 'creator']
                 status_str = "Admin" if bot_is_admin else "Member"
                 r.set(f'cache_group_status:{chat_id}', status_str, ex=600)
@@ -1183,6 +2280,7 @@ def handle_new_chat_members(message):
     for member in message.new_chat_members:
         if member.id == bot_id:
             continue
+        record_metric('join', chat_id)
 
         # ── Bot detection: kick other bots silently ───────────────────────────
         if getattr(member, 'is_bot', False):
@@ -1229,19 +2327,51 @@ def handle_new_chat_members(message):
 
 @bot.message_handler(content_types=['left_chat_member'])
 def handle_left_chat_member(message):
-    if message.left_chat_member.id == bot.get_me().id:
+    if message.left_chat_member.id == get_bot_id():
         remove_group(message.chat.id)
 
 
+@bot.my_chat_member_handler()
+def handle_my_chat_member(update):
+    """
+    Telegram reports every change to the bot's own membership here, so the
+    groups set, bot-member cache and cache_group_status:* are maintained
+    incrementally — no polling or refresh scan needed to stay accurate.
+    Owner notifications for joins stay in handle_new_chat_members.
+    """
+    if update.chat.type not in ['group', 'supergroup']:
+        return
+    chat_id = update.chat.id
+    member = update.new_chat_member
+    still_in = member.status in ['member', 'administrator', 'creator'] or (
+        member.status == 'restricted' and getattr(member, 'is_member', False)
+    )
+    if not still_in:
+        old = getattr(update.old_chat_member, 'status', None)
+        logger.info(f"[MEMBERSHIP] Bot removed from {chat_id} ({old} → {member.status})")
+        record_metric('bot_removed', chat_id)
+        remove_group(chat_id)
+        return
+
+    _set_bot_member(chat_id, member)
+    if not r.sismember('groups', str(chat_id)):
+        add_group(chat_id)
+        logger.info(f"[MEMBERSHIP] Bot present in {chat_id} as {member.status} — registered")
+    try:
+        _store_group_info(chat_id, update.chat.title, _member_status_label(member))
+    except Exception as e:
+        logger.error(f"[MEMBERSHIP] Cache update failed for {chat_id}: {e}")
+
+
 # ─────────────────────────────────────────────────────────────────────────────
 #  AAWM — AUTO APPROVE + WELCOME MESSAGE
 # ─────────────────────────────────────────────────────────────────────────────
 
 # Redis defaults for AAWM
-if r.get('aawm_enabled') is None:
-    r.set('aawm_enabled', 'False')
-if r.get('aawm_text') is None:
-    r.set('aawm_text', 'Welcome to the group! Please read the rules.')
+_DEFAULTS.update({
+    'aawm_enabled': 'False',
+    'aawm_text':    'Welcome to the group! Please read the rules.',
+})
 
 @bot.chat_join_request_handler()
 def handle_join_request(update):
@@ -1261,7 +2391,7 @@ def handle_join_request(update):
     reply_markup = None
     if aawm_btns_raw:
         try:
-            btn_list = json.loads(aawm_btns_raw)
+            btn_list = json_loads(aawm_btns_raw)
             flat = [(b['text'], b['url']) for b in btn_list]
             rows = _auto_layout_buttons(flat)
             reply_markup = build_inline_keyboard(rows)
@@ -1299,23 +2429,11 @@ def start(message):
 def stats_command(message):
     if message.from_user.id != OWNER_ID:
         return
-    total = r.scard('bot_users')
-    now = int(time.time())
-    thirty_days_ago = now - (30 * 24 * 3600)
-    new_users = 0
-    for uid in r.smembers('bot_users'):
-        first_seen = r.hget('user_first_seen', uid)
-        if first_seen and int(first_seen) >= thirty_days_ago:
-            new_users += 1
-    groups_count = r.scard('groups')
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("🏠 Main Menu", callback_data="back"))
     bot.send_message(
         message.chat.id,
-        f"📊 *Bot Statistics*\n\n"
-        f"👤 Total users: *{total}*\n"
-        f"🆕 New users (last 30 days): *{new_users}*\n"
-        f"👥 Active groups: *{groups_count}*",
+        _render_user_stats(),
         parse_mode='Markdown',
         reply_markup=markup
     )
@@ -1710,7 +2828,7 @@ def _process_restore_file(message):
         return
 
     try:
-        data = json.loads(file_bytes.decode('utf-8'))
+        data = json_loads(file_bytes)
     except Exception as e:
         _edit(f"❌ Invalid JSON file:\n{e}\n\nPlease check the file and try again.")
         logger.error(f"[RESTORE] JSON parse failed: {e}")
@@ -1829,13 +2947,15 @@ def _process_restore_file(message):
     except Exception as e:
         logger.error(f"[RESTORE] Failed to record restore metadata: {e}")
 
+    _fold_legacy_group_errors()
+    _rebuild_group_health_index()
+    # Older backups carry the unsharded user registry — fold it back in
+    _migrate_legacy_user_registry()
+    _ensure_first_seen_index(rebuild=True)
+
     # Invalidate all in-memory caches so the restored data takes effect
     try:
-        _invalidate_groups_cache()
-        with _global_config_cache_lock:
-            _global_config_cache.clear()
-        with _group_repeat_cache_lock:
-            _group_repeat_cache.clear()
+        _clear_config_caches()
     except Exception as e:
         logger.error(f"[RESTORE] Cache invalidation error: {e}")
 
@@ -1986,7 +3106,7 @@ def _botdet_is_whitelisted(bot_id_or_username):
 
 def _botdet_log_kick(chat_id, target_id, target_username, reason='auto'):
     try:
-        entry = json.dumps({
+        entry = json_dumps({
             'ts':        int(time.time()),
             'chat_id':   chat_id,
             'target_id': target_id,
@@ -2000,13 +3120,14 @@ def _botdet_log_kick(chat_id, target_id, target_username, reason='auto'):
         pipe.incr('bot_kick_count')
         pipe.incr(f'bot_kick_count:{chat_id}')
         pipe.execute()
+        record_metric('bot_kick', chat_id)
     except Exception as e:
         logger.error(f'[BOTDET] Log kick failed: {e}')
 
 def _botdet_check_permission(chat_id):
     """
     Returns ('kick', None), ('no_admin', reason), ('no_perm', reason), or ('error', reason).
-    Uses cached _BOT_ID — no get_me() API call.
+    Uses the shared bot-member cache — no per-call API round trip.
 
     Key fix: in basic groups (type='group'), can_restrict_members may be absent
     from the API response even though the bot has full admin rights. We default
@@ -2014,7 +3135,7 @@ def _botdet_check_permission(chat_id):
     refusing. If the actual kick fails, we surface the real error to the owner.
     """
     try:
-        member = bot.get_chat_member(chat_id, _BOT_ID)
+        member = get_bot_member(chat_id)
         if member.status == 'creator':
             return ('kick', None)
         if member.status == 'administrator':
@@ -2068,7 +3189,7 @@ def _botdet_handle_new_bot(chat_id, target_user):
         target_id       = target_user.id
         target_username = target_user.username or str(target_id)
 
-        if target_id == _BOT_ID:
+        if target_id == get_bot_id():
             return
 
         # Whitelisted — silent skip
@@ -2162,7 +3283,7 @@ def _botdet_scan_group(chat_id):
             user = admin.user
             if not user.is_bot:
                 continue
-            if user.id == _BOT_ID:
+            if user.id == get_bot_id():
                 continue
             admin_bots_found += 1
             uname = user.username or str(user.id)
@@ -2189,32 +3310,98 @@ def _botdet_scan_group(chat_id):
 #  MAIN MENU
 # ─────────────────────────────────────────────────────────────────────────────
 
+# ─── Menu render cache ───────────────────────────────────────────────────────
+# Owner menus are rebuilt on every press, and a lot of presses (Refresh, a
+# toggle that lands where it was, Go Back to an unchanged menu) produce what
+# is already on screen. Telegram answers those edits with "message is not
+# modified" — a wasted round trip. We remember a digest of the last text and
+# keyboard put on each (chat, message) and skip the call when it matches.
+# Every edit of a menu message must go through edit_menu() so the digest
+# stays true; like next-step handlers it lives in process memory.
+_RENDER_CACHE_SIZE = 500
+_render_cache = OrderedDict()      # (chat_id, message_id) → digest
+_render_cache_lock = threading.Lock()
+
+def _render_digest(text, markup_json, parse_mode, extra):
+    raw = f"{parse_mode}\0{text}\0{markup_json}\0{sorted(extra.items()) if extra else ''}"
+    return hashlib.blake2b(raw.encode(), digest_size=16).digest()
+
+def forget_render(chat_id, message_id):
+    with _render_cache_lock:
+        _render_cache.pop((chat_id, message_id), None)
+
+def edit_menu(text, chat_id, message_id, reply_markup=None, parse_mode=None, **kwargs):
+    """
+    Drop-in for bot.edit_message_text on menu messages. Returns False without
+    calling Telegram when the message already shows this exact render.
+    reply_markup may be a markup object or its prebuilt JSON string.
+    """
+    if reply_markup is not None and not isinstance(reply_markup, str):
+        reply_markup = reply_markup.to_json()
+    key = (chat_id, message_id)
+    digest = _render_digest(text, reply_markup, parse_mode, kwargs)
+    with _render_cache_lock:
+        if _render_cache.get(key) == digest:
+            _render_cache.move_to_end(key)
+            hit = True
+        else:
+            hit = False
+    if hit:
+        record_metric('edit_skipped')
+        return False
+    try:
+        bot.edit_message_text(text, chat_id, message_id, reply_markup=reply_markup,
+                              parse_mode=parse_mode, **kwargs)
+    except telebot.apihelper.ApiTelegramException as e:
+        if 'message is not modified' not in str(e).lower():
+            forget_render(chat_id, message_id)
+            raise
+    except Exception:
+        forget_render(chat_id, message_id)
+        raise
+    with _render_cache_lock:
+        _render_cache[key] = digest
+        _render_cache.move_to_end(key)
+        while len(_render_cache) > _RENDER_CACHE_SIZE:
+            _render_cache.popitem(last=False)
+    return True
+
+_main_menu_json = None
+
+def _main_menu_markup():
+    """The main menu never changes, so it is built and serialized once."""
+    global _main_menu_json
+    if _main_menu_json is None:
+        markup = types.InlineKeyboardMarkup(row_width=1)
+        markup.add(
+            types.InlineKeyboardButton("📢 Broadcast to All Groups", callback_data="broadcast_all"),
+            types.InlineKeyboardButton("📨 Send to One Group", callback_data="my_groups_send"),
+            types.InlineKeyboardButton("🔗 Toggle Global Link-Only", callback_data="toggle_global"),
+            types.InlineKeyboardButton("💬 Set Global /start Reply", callback_data="set_global_start_reply"),
+            types.InlineKeyboardButton("📝 Set Global /start@ Group Reply", callback_data="set_global_group_start_reply"),
+            types.InlineKeyboardButton("👋 Join Reply (Global)", callback_data="global_join_reply_menu"),
+            types.InlineKeyboardButton("🔁 Global Broadcast Repeat", callback_data="global_repeat_menu"),
+            types.InlineKeyboardButton("📣 Broadcast to Bot Users", callback_data="broadcast_users"),
+            types.InlineKeyboardButton("🗑 Delete All Private Sent Msgs", callback_data="delete_all_private"),
+            types.InlineKeyboardButton("➕ Add Account to Group", callback_data="add_account_menu"),
+            types.InlineKeyboardButton("📊 Bot Stats", callback_data="bot_stats"),
+            types.InlineKeyboardButton("👥 My Groups", callback_data="my_groups"),
+            types.InlineKeyboardButton("📩 'Added to Group' Message", callback_data="added_to_group_menu"),
+            types.InlineKeyboardButton("📡 Updates & Group Health", callback_data="updates_menu"),
+            types.InlineKeyboardButton("🔗 Global Broadcast Embedded Links", callback_data="broadcast_embedded_links"),
+            types.InlineKeyboardButton("🤖 Auto Approve Welcome (AAWM)", callback_data="aawm_menu"),
+            types.InlineKeyboardButton("📝 Create Post", callback_data="create_post_menu"),
+            types.InlineKeyboardButton("🚫 Ban User", callback_data="ban_user_menu"),
+            types.InlineKeyboardButton("🤖 Bot Detection & Auto-Kick", callback_data="bot_detection_menu"),
+        )
+        _main_menu_json = markup.to_json()
+    return _main_menu_json
+
 def show_main_menu(chat_id, text, message_id=None):
-    markup = types.InlineKeyboardMarkup(row_width=1)
-    markup.add(
-        types.InlineKeyboardButton("📢 Broadcast to All Groups", callback_data="broadcast_all"),
-        types.InlineKeyboardButton("📨 Send to One Group", callback_data="my_groups_send"),
-        types.InlineKeyboardButton("🔗 Toggle Global Link-Only", callback_data="toggle_global"),
-        types.InlineKeyboardButton("💬 Set Global /start Reply", callback_data="set_global_start_reply"),
-        types.InlineKeyboardButton("📝 Set Global /start@ Group Reply", callback_data="set_global_group_start_reply"),
-        types.InlineKeyboardButton("👋 Join Reply (Global)", callback_data="global_join_reply_menu"),
-        types.InlineKeyboardButton("🔁 Global Broadcast Repeat", callback_data="global_repeat_menu"),
-        types.InlineKeyboardButton("📣 Broadcast to Bot Users", callback_data="broadcast_users"),
-        types.InlineKeyboardButton("🗑 Delete All Private Sent Msgs", callback_data="delete_all_private"),
-        types.InlineKeyboardButton("➕ Add Account to Group", callback_data="add_account_menu"),
-        types.InlineKeyboardButton("📊 Bot Stats", callback_data="bot_stats"),
-        types.InlineKeyboardButton("👥 My Groups", callback_data="my_groups"),
-        types.InlineKeyboardButton("📩 'Added to Group' Message", callback_data="added_to_group_menu"),
-        types.InlineKeyboardButton("📡 Updates & Group Health", callback_data="updates_menu"),
-        types.InlineKeyboardButton("🔗 Global Broadcast Embedded Links", callback_data="broadcast_embedded_links"),
-        types.InlineKeyboardButton("🤖 Auto Approve Welcome (AAWM)", callback_data="aawm_menu"),
-        types.InlineKeyboardButton("📝 Create Post", callback_data="create_post_menu"),
-        types.InlineKeyboardButton("🚫 Ban User", callback_data="ban_user_menu"),
-        types.InlineKeyboardButton("🤖 Bot Detection & Auto-Kick", callback_data="bot_detection_menu"),
-    )
+    markup = _main_menu_markup()
     if message_id:
         try:
-            bot.edit_message_text(text, chat_id, message_id, reply_markup=markup)
+            edit_menu(text, chat_id, message_id, reply_markup=markup)
         except Exception:
             bot.send_message(chat_id, text, reply_markup=markup)
     else:
@@ -2257,10 +3444,10 @@ def _get_pending_buttons(user_id):
     raw = r.get(f'inline_btns:{user_id}')
     if not raw:
         return []
-    return json.loads(raw)
+    return json_loads(raw)
 
 def _set_pending_buttons(user_id, btns):
-    r.set(f'inline_btns:{user_id}', json.dumps(btns), ex=600)
+    r.set(f'inline_btns:{user_id}', json_dumps(btns), ex=600)
 
 def _clear_pending_buttons(user_id):
     r.delete(f'inline_btns:{user_id}')
@@ -2293,1939 +3480,2126 @@ def _ask_add_buttons(message, on_yes_cb_data, on_no_cb_data, context_label=""):
 # ─────────────────────────────────────────────────────────────────────────────
 #  CALLBACK HANDLER
 # ─────────────────────────────────────────────────────────────────────────────
+# Buttons are dispatched through a route table instead of one long if/elif
+# chain. A route is a callback_data pattern: plain strings ("bot_stats") go
+# into a dict; parameterized ones ("group_menu:{int}", "post_to_one:{str}:{int}")
+# are filed in a character trie under their literal prefix, and the rest is
+# matched against the placeholders, which arrive converted as arguments.
+# A press costs one dict lookup or a walk the length of the prefix.
 
-@bot.callback_query_handler(func=lambda call: True)
-def callback(call):
-    if call.from_user.id != OWNER_ID:
-        bot.answer_callback_query(call.id, "⛔ Only owner can use this bot.")
-        return
+class CallbackContext:
+    """One button press: the query plus the edit/answer/reload helpers every route uses."""
 
-    cid = call.message.chat.id
-    mid = call.message.message_id
-    data = call.data
+    __slots__ = ('call', 'cid', 'mid', 'data')
 
-    def edit(text, markup=None, parse_mode=None):
+    def __init__(self, call, data=None):
+        self.call = call
+        self.cid = call.message.chat.id
+        self.mid = call.message.message_id
+        self.data = call.data if data is None else data
+
+    def edit(self, text, markup=None, parse_mode=None):
         try:
-            bot.edit_message_text(text, cid, mid, reply_markup=markup, parse_mode=parse_mode)
+            edit_menu(text, self.cid, self.mid, reply_markup=markup, parse_mode=parse_mode)
         except telebot.apihelper.ApiTelegramException as e:
             if 'message is not modified' in str(e).lower():
                 pass  # same content — not an error
             else:
                 try:
-                    bot.send_message(cid, text, reply_markup=markup, parse_mode=parse_mode,
+                    bot.send_message(self.cid, text, reply_markup=markup, parse_mode=parse_mode,
                                      disable_web_page_preview=True)
                 except Exception:
                     pass
         except Exception:
             try:
-                bot.send_message(cid, text, reply_markup=markup, parse_mode=parse_mode,
+                bot.send_message(self.cid, text, reply_markup=markup, parse_mode=parse_mode,
                                  disable_web_page_preview=True)
             except Exception:
                 pass
 
-    def answer(text="", alert=False):
+    def answer(self, text="", alert=False):
         try:
-            bot.answer_callback_query(call.id, text, show_alert=alert)
+            bot.answer_callback_query(self.call.id, text, show_alert=alert)
         except Exception:
             pass
 
-    def _reload(new_data):
-        """Re-render a menu in-place by faking a callback with new data."""
-        fake = types.CallbackQuery(
-            id=call.id, from_user=call.from_user,
-            message=call.message, data=new_data,
-            chat_instance=getattr(call, 'chat_instance', '')
-        )
-        callback(fake)
-
-    # ── MAIN MENU ────────────────────────────────────────────────────────────
-    if data == "back":
-        show_main_menu(cid, "🏠 Main menu:", mid)
-        answer()
-
-    # ── BOT STATS ────────────────────────────────────────────────────────────
-    elif data == "bot_stats":
-        total = r.scard('bot_users')
-        now = int(time.time())
-        thirty_days_ago = now - (30 * 24 * 3600)
-        new_users = sum(
-            1 for uid in r.smembers('bot_users')
-            if (fs := r.hget('user_first_seen', uid)) and int(fs) >= thirty_days_ago
-        )
-        groups_count = r.scard('groups')
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="back"))
-        edit(
-            f"📊 *Bot Statistics*\n\n"
-            f"👤 Total users: *{total}*\n"
-            f"🆕 New users (last 30 days): *{new_users}*\n"
-            f"👥 Active groups: *{groups_count}*",
-            markup, parse_mode='Markdown'
-        )
-        answer()
-
-    # ── GLOBAL /start REPLY ──────────────────────────────────────────────────
-    elif data == "set_global_start_reply":
-        edit("✏️ Send new custom reply for private /start.\nSend 'reset' to remove.")
-        bot.register_next_step_handler(call.message, process_global_start_reply)
-        answer()
-
-    # ── GLOBAL /start@ GROUP REPLY ───────────────────────────────────────────
-    elif data == "set_global_group_start_reply":
-        current = r.get('global_group_start_reply') or "Not set"
-        enabled = r.get('global_group_start_reply_enabled') == 'True'
-        markup = types.InlineKeyboardMarkup(row_width=1)
-        markup.row(
-            types.InlineKeyboardButton("✅ ON (Override All)", callback_data="global_group_start_reply_on"),
-            types.InlineKeyboardButton("❌ OFF", callback_data="global_group_start_reply_off"),
-        )
-        markup.add(
-            types.InlineKeyboardButton("✏️ Set / Edit Reply", callback_data="do_set_global_group_start_reply"),
-            types.InlineKeyboardButton("🗑 Remove Reply", callback_data="reset_global_group_start_reply"),
-            types.InlineKeyboardButton("🔙 Go Back", callback_data="back"),
-        )
-        status_text = "✅ ON (overrides all groups)" if enabled else "❌ OFF"
-        menu_text = (
-            f"📝 Global /start@ Group Reply\n\n"
-            f"Status: {status_text}\n\n"
-            f"Current Reply:\n{current}\n\n"
-            f"ℹ️ When ON, this overrides all group-specific /start@ replies.\n"
-            f"Groups you set individually will run independently.\n"
-            f"Turning OFF then ON again resets all groups back under global control."
-        )
-        try:
-            bot.edit_message_text(menu_text, cid, mid, reply_markup=markup)
-        except Exception:
-            try:
-                bot.send_message(cid, menu_text, reply_markup=markup)
-            except Exception:
-                pass
-        answer()
+    def reload(self, new_data):
+        """Re-render another menu in place, as if its button had been pressed."""
+        dispatch_callback(CallbackContext(self.call, new_data))
 
-    elif data == "global_group_start_reply_on":
-        for g in get_groups():
-            r.delete(f'group_start_reply_independent:{g}')
-        r.set('global_group_start_reply_enabled', 'True')
-        current = r.get('global_group_start_reply') or "Not set"
-        markup = types.InlineKeyboardMarkup(row_width=1)
-        markup.row(
-            types.InlineKeyboardButton("✅ ON (Override All)", callback_data="global_group_start_reply_on"),
-            types.InlineKeyboardButton("❌ OFF", callback_data="global_group_start_reply_off"),
-        )
-        markup.add(
-            types.InlineKeyboardButton("✏️ Set / Edit Reply", callback_data="do_set_global_group_start_reply"),
-            types.InlineKeyboardButton("🗑 Remove Reply", callback_data="reset_global_group_start_reply"),
-            types.InlineKeyboardButton("🔙 Go Back", callback_data="back"),
-        )
-        menu_text = (
-            f"📝 Global /start@ Group Reply\n\n"
-            f"Status: ✅ ON (overrides all groups)\n\n"
-            f"Current Reply:\n{current}\n\n"
-            f"ℹ️ When ON, this overrides all group-specific /start@ replies.\n"
-            f"Groups you set individually will run independently.\n"
-            f"Turning OFF then ON again resets all groups back under global control."
-        )
-        try:
-            bot.edit_message_text(menu_text, cid, mid, reply_markup=markup)
-        except Exception:
-            bot.send_message(cid, menu_text, reply_markup=markup)
-        answer("✅ Global /start@ reply is ON — overrides all groups.")
+_CALLBACK_ARG_TYPES = {'int': (r'(-?\d+)', int), 'key': (r'([^:]+)', str), 'str': (r'(.+)', str)}
+_callback_exact = {}     # data → handler
+_callback_trie = {}      # char → child node; node[None] → [(regex, converters, handler), ...]
 
-    elif data == "global_group_start_reply_off":
-        r.set('global_group_start_reply_enabled', 'False')
-        current = r.get('global_group_start_reply') or "Not set"
-        markup = types.InlineKeyboardMarkup(row_width=1)
-        markup.row(
-            types.InlineKeyboardButton("✅ ON (Override All)", callback_data="global_group_start_reply_on"),
-            types.InlineKeyboardButton("❌ OFF", callback_data="global_group_start_reply_off"),
-        )
-        markup.add(
-            types.InlineKeyboardButton("✏️ Set / Edit Reply", callback_data="do_set_global_group_start_reply"),
-            types.InlineKeyboardButton("🗑 Remove Reply", callback_data="reset_global_group_start_reply"),
-            types.InlineKeyboardButton("🔙 Go Back", callback_data="back"),
-        )
-        menu_text = (
-            f"📝 Global /start@ Group Reply\n\n"
-            f"Status: ❌ OFF\n\n"
-            f"Current Reply:\n{current}\n\n"
-            f"ℹ️ When ON, this overrides all group-specific /start@ replies.\n"
-            f"Groups you set individually will run independently.\n"
-            f"Turning OFF then ON again resets all groups back under global control."
-        )
-        try:
-            bot.edit_message_text(menu_text, cid, mid, reply_markup=markup)
-        except Exception:
-            bot.send_message(cid, menu_text, reply_markup=markup)
-        answer("✅ Global /start@ reply is OFF.")
+def callback_route(*patterns):
+    """Register the decorated function for one or more callback_data patterns."""
+    def register(fn):
+        for pattern in patterns:
+            if '{' not in pattern:
+                _callback_exact[pattern] = fn
+                continue
+            prefix, rest = pattern.split('{', 1)
+            regex, converters = '', []
+            for i, part in enumerate(re.split(r'\{(\w+)\}', '{' + rest)):
+                if i % 2:
+                    group, conv = _CALLBACK_ARG_TYPES[part]
+                    regex += group
+                    converters.append(conv)
+                else:
+                    regex += re.escape(part)
+            node = _callback_trie
+            for ch in prefix:
+                node = node.setdefault(ch, {})
+            node.setdefault(None, []).append((re.compile(regex), converters, fn))
+        fn._callback_patterns = patterns
+        return fn
+    return register
+
+def match_callback(data):
+    """callback_data → (handler, args, route name), or (None, (), None)."""
+    fn = _callback_exact.get(data)
+    if fn is not None:
+        return fn, (), data
+    node, candidates = _callback_trie, []
+    for i, ch in enumerate(data):
+        node = node.get(ch)
+        if node is None:
+            break
+        if None in node:
+            candidates.append((i + 1, node[None]))
+    for end, routes in reversed(candidates):   # longest literal prefix first
+        for regex, converters, fn in routes:
+            m = regex.fullmatch(data, end)
+            if m:
+                return fn, tuple(conv(v) for conv, v in zip(converters, m.groups())), data[:end]
+    return None, (), None
+
+def dispatch_callback(c):
+    fn, args, route = match_callback(c.data)
+    if fn is None:
+        logger.warning(f"[CALLBACK] No route for {c.data!r}")
+        c.answer()
+        return
+    fn(c, *args)
 
-    elif data == "do_set_global_group_start_reply":
-        edit("✏️ Send the new global reply for /start@AllMusicShazamandlyrics_bot in groups:")
-        bot.register_next_step_handler(call.message, process_global_group_start_reply)
-        answer()
+@bot.callback_query_handler(func=lambda call: True)
+def callback(call):
+    if call.from_user.id != OWNER_ID:
+        bot.answer_callback_query(call.id, "⛔ Only owner can use this bot.")
+        return
+    dispatch_callback(CallbackContext(call))
 
-    elif data == "reset_global_group_start_reply":
-        r.delete('global_group_start_reply')
-        r.set('global_group_start_reply_enabled', 'False')
-        markup = types.InlineKeyboardMarkup(row_width=1)
-        markup.row(
-            types.InlineKeyboardButton("✅ ON (Override All)", callback_data="global_group_start_reply_on"),
-            types.InlineKeyboardButton("❌ OFF", callback_data="global_group_start_reply_off"),
-        )
-        markup.add(
-            types.InlineKeyboardButton("✏️ Set / Edit Reply", callback_data="do_set_global_group_start_reply"),
-            types.InlineKeyboardButton("🗑 Remove Reply", callback_data="reset_global_group_start_reply"),
-            types.InlineKeyboardButton("🔙 Go Back", callback_data="back"),
-        )
-        menu_text = (
-            f"📝 Global /start@ Group Reply\n\n"
-            f"Status: ❌ OFF\n\n"
-            f"Current Reply:\nNot set\n\n"
-            f"ℹ️ When ON, this overrides all group-specific /start@ replies.\n"
-            f"Groups you set individually will run independently.\n"
-            f"Turning OFF then ON again resets all groups back under global control."
-        )
+# ── MAIN MENU ────────────────────────────────────────────────────────────────
+@callback_route("back")
+def _cb_back(c):
+    show_main_menu(c.cid, "🏠 Main menu:", c.mid)
+    c.answer()
+
+# ── BOT STATS ────────────────────────────────────────────────────────────────
+@callback_route("bot_stats")
+def _cb_bot_stats(c):
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="back"))
+    c.edit(_render_user_stats(), markup, parse_mode='Markdown')
+    c.answer()
+
+# ── GLOBAL /start REPLY ──────────────────────────────────────────────────────
+@callback_route("set_global_start_reply")
+def _cb_set_global_start_reply(c):
+    c.edit("✏️ Send new custom reply for private /start.\nSend 'reset' to remove.")
+    bot.register_next_step_handler(c.call.message, process_global_start_reply)
+    c.answer()
+
+# ── GLOBAL /start@ GROUP REPLY ───────────────────────────────────────────────
+@callback_route("set_global_group_start_reply")
+def _cb_set_global_group_start_reply(c):
+    current = r.get('global_group_start_reply') or "Not set"
+    enabled = r.get('global_group_start_reply_enabled') == 'True'
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    markup.row(
+        types.InlineKeyboardButton("✅ ON (Override All)", callback_data="global_group_start_reply_on"),
+        types.InlineKeyboardButton("❌ OFF", callback_data="global_group_start_reply_off"),
+    )
+    markup.add(
+        types.InlineKeyboardButton("✏️ Set / Edit Reply", callback_data="do_set_global_group_start_reply"),
+        types.InlineKeyboardButton("🗑 Remove Reply", callback_data="reset_global_group_start_reply"),
+        types.InlineKeyboardButton("🔙 Go Back", callback_data="back"),
+    )
+    status_text = "✅ ON (overrides all groups)" if enabled else "❌ OFF"
+    menu_text = (
+        f"📝 Global /start@ Group Reply\n\n"
+        f"Status: {status_text}\n\n"
+        f"Current Reply:\n{current}\n\n"
+        f"ℹ️ When ON, this overrides all group-specific /start@ replies.\n"
+        f"Groups you set individually will run independently.\n"
+        f"Turning OFF then ON again resets all groups back under global control."
+    )
+    try:
+        edit_menu(menu_text, c.cid, c.mid, reply_markup=markup)
+    except Exception:
         try:
-            bot.edit_message_text(menu_text, cid, mid, reply_markup=markup)
+            bot.send_message(c.cid, menu_text, reply_markup=markup)
         except Exception:
-            bot.send_message(cid, menu_text, reply_markup=markup)
-        answer("✅ Global group /start@ reply removed and turned OFF.")
+            pass
+    c.answer()
 
-    # ── BROADCAST TO ALL GROUPS ───────────────────────────────────────────────
-    elif data == "broadcast_all":
-        _clear_pending_buttons(OWNER_ID)
-        markup = types.InlineKeyboardMarkup(row_width=2)
-        markup.row(
-            types.InlineKeyboardButton("✅ Yes — Add Buttons", callback_data="ibtn_add:broadcast_all"),
-            types.InlineKeyboardButton("❌ No Buttons", callback_data="ibtn_skip:broadcast_all"),
-        )
-        edit("📢 Do you want to add inline buttons to this broadcast?", markup)
-        answer()
+@callback_route("global_group_start_reply_on")
+def _cb_global_group_start_reply_on(c):
+    for g in get_groups():
+        r.delete(f'group_start_reply_independent:{g}')
+    r.set('global_group_start_reply_enabled', 'True')
+    current = r.get('global_group_start_reply') or "Not set"
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    markup.row(
+        types.InlineKeyboardButton("✅ ON (Override All)", callback_data="global_group_start_reply_on"),
+        types.InlineKeyboardButton("❌ OFF", callback_data="global_group_start_reply_off"),
+    )
+    markup.add(
+        types.InlineKeyboardButton("✏️ Set / Edit Reply", callback_data="do_set_global_group_start_reply"),
+        types.InlineKeyboardButton("🗑 Remove Reply", callback_data="reset_global_group_start_reply"),
+        types.InlineKeyboardButton("🔙 Go Back", callback_data="back"),
+    )
+    menu_text = (
+        f"📝 Global /start@ Group Reply\n\n"
+        f"Status: ✅ ON (overrides all groups)\n\n"
+        f"Current Reply:\n{current}\n\n"
+        f"ℹ️ When ON, this overrides all group-specific /start@ replies.\n"
+        f"Groups you set individually will run independently.\n"
+        f"Turning OFF then ON again resets all groups back under global control."
+    )
+    try:
+        edit_menu(menu_text, c.cid, c.mid, reply_markup=markup)
+    except Exception:
+        bot.send_message(c.cid, menu_text, reply_markup=markup)
+    c.answer("✅ Global /start@ reply is ON — overrides all groups.")
 
-    # ── TOGGLE GLOBAL LINK-ONLY ───────────────────────────────────────────────
-    elif data == "toggle_global":
-        current = r.get('link_only_global') == 'True'
-        r.set('link_only_global', 'False' if current else 'True')
-        _invalidate_global_cache('link_only_global')
-        status = "OFF" if current else "ON"
-        answer(f"🔗 Global link-only → {status}")
-        show_main_menu(cid, f"🔗 Global link-only now {status}", mid)
-
-    # ── MY GROUPS / SEND TO GROUP ─────────────────────────────────────────────
-    elif data in ["my_groups", "my_groups_send"]:
-        groups = get_groups()
-        if not groups:
-            markup = types.InlineKeyboardMarkup()
-            markup.add(
-                types.InlineKeyboardButton("🔄 Refresh", callback_data="refresh_groups"),
-                types.InlineKeyboardButton("🔙 Go Back", callback_data="back"),
-            )
-            edit("❌ No groups added yet.\nAdd the bot to groups first!", markup)
-            answer("No groups")
-            return
+@callback_route("global_group_start_reply_off")
+def _cb_global_group_start_reply_off(c):
+    r.set('global_group_start_reply_enabled', 'False')
+    current = r.get('global_group_start_reply') or "Not set"
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    markup.row(
+        types.InlineKeyboardButton("✅ ON (Override All)", callback_data="global_group_start_reply_on"),
+        types.InlineKeyboardButton("❌ OFF", callback_data="global_group_start_reply_off"),
+    )
+    markup.add(
+        types.InlineKeyboardButton("✏️ Set / Edit Reply", callback_data="do_set_global_group_start_reply"),
+        types.InlineKeyboardButton("🗑 Remove Reply", callback_data="reset_global_group_start_reply"),
+        types.InlineKeyboardButton("🔙 Go Back", callback_data="back"),
+    )
+    menu_text = (
+        f"📝 Global /start@ Group Reply\n\n"
+        f"Status: ❌ OFF\n\n"
+        f"Current Reply:\n{current}\n\n"
+        f"ℹ️ When ON, this overrides all group-specific /start@ replies.\n"
+        f"Groups you set individually will run independently.\n"
+        f"Turning OFF then ON again resets all groups back under global control."
+    )
+    try:
+        edit_menu(menu_text, c.cid, c.mid, reply_markup=markup)
+    except Exception:
+        bot.send_message(c.cid, menu_text, reply_markup=markup)
+    c.answer("✅ Global /start@ reply is OFF.")
+
+@callback_route("do_set_global_group_start_reply")
+def _cb_do_set_global_group_start_reply(c):
+    c.edit("✏️ Send the new global reply for /start@AllMusicShazamandlyrics_bot in groups:")
+    bot.register_next_step_handler(c.call.message, process_global_group_start_reply)
+    c.answer()
+
+@callback_route("reset_global_group_start_reply")
+def _cb_reset_global_group_start_reply(c):
+    r.delete('global_group_start_reply')
+    r.set('global_group_start_reply_enabled', 'False')
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    markup.row(
+        types.InlineKeyboardButton("✅ ON (Override All)", callback_data="global_group_start_reply_on"),
+        types.InlineKeyboardButton("❌ OFF", callback_data="global_group_start_reply_off"),
+    )
+    markup.add(
+        types.InlineKeyboardButton("✏️ Set / Edit Reply", callback_data="do_set_global_group_start_reply"),
+        types.InlineKeyboardButton("🗑 Remove Reply", callback_data="reset_global_group_start_reply"),
+        types.InlineKeyboardButton("🔙 Go Back", callback_data="back"),
+    )
+    menu_text = (
+        f"📝 Global /start@ Group Reply\n\n"
+        f"Status: ❌ OFF\n\n"
+        f"Current Reply:\nNot set\n\n"
+        f"ℹ️ When ON, this overrides all group-specific /start@ replies.\n"
+        f"Groups you set individually will run independently.\n"
+        f"Turning OFF then ON again resets all groups back under global control."
+    )
+    try:
+        edit_menu(menu_text, c.cid, c.mid, reply_markup=markup)
+    except Exception:
+        bot.send_message(c.cid, menu_text, reply_markup=markup)
+    c.answer("✅ Global group /start@ reply removed and turned OFF.")
 
-        markup = types.InlineKeyboardMarkup(row_width=1)
-        for g in groups:
-            title, status = get_group_info(g)
-            btn_text = f"{title} ({status})"
-            btn_data = f"group_menu:{g}" if data == "my_groups" else f"send_to_group:{g}"
-            markup.add(types.InlineKeyboardButton(btn_text, callback_data=btn_data))
-        markup.add(
-            types.InlineKeyboardButton("🔄 Refresh List", callback_data="refresh_groups"),
-            types.InlineKeyboardButton("🔙 Go Back", callback_data="back"),
-        )
-        text = "👥 Your Groups:" if data == "my_groups" else "📨 Select group to send:"
-        edit(text, markup)
-        answer()
-
-    # ── REFRESH GROUPS ────────────────────────────────────────────────────────
-    elif data == "refresh_groups":
-        groups = list(get_groups())
-        removed = 0
-        for g in groups:
-            try:
-                bot.get_chat(g)
-                get_group_info(g, force_refresh=True)
-            except telebot.apihelper.ApiTelegramException as e:
-                if "chat not found" in str(e).lower() or "forbidden" in str(e).lower():
-                    remove_group(g)
-                    removed += 1
-        answer(f"✅ Refreshed. Removed {removed} invalid groups.")
-        _reload("my_groups")
-
-    # ── GROUP MENU ────────────────────────────────────────────────────────────
-    elif data.startswith("group_menu:"):
-        _, chat_id_str = data.split(":", 1)
-        chat_id = int(chat_id_str)
-        title, status = get_group_info(chat_id)
-        is_admin = status == "Admin"
-        link_only_this = is_link_only(chat_id)
-        repeat_on = r.get(f'repeat_task:{chat_id}') == 'True'
-        join_reply_on = r.get(f'join_reply_enabled:{chat_id}') == 'True'
-
-        # Live permission fetch (no cache)
-        PERM_LABELS = [
-            ('can_manage_chat',       'Manage Chat'),
-            ('can_change_info',       'Change Info'),
-            ('can_delete_messages',   'Delete Messages'),
-            ('can_restrict_members',  'Ban Users'),
-            ('can_invite_users',      'Invite Users'),
-            ('can_pin_messages',      'Pin Messages'),
-            ('can_manage_video_chats','Manage Voice Chats'),
-            ('can_promote_members',   'Add Admins'),
-            ('can_post_stories',      'Post Stories'),
-            ('can_edit_stories',      'Edit Stories'),
-            ('can_delete_stories',    'Delete Stories'),
-        ]
+# ── BROADCAST TO ALL GROUPS ──────────────────────────────────────────────────
+@callback_route("broadcast_all")
+def _cb_broadcast_all(c):
+    _clear_pending_buttons(OWNER_ID)
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup.row(
+        types.InlineKeyboardButton("✅ Yes — Add Buttons", callback_data="ibtn_add:broadcast_all"),
+        types.InlineKeyboardButton("❌ No Buttons", callback_data="ibtn_skip:broadcast_all"),
+    )
+    c.edit("📢 Do you want to add inline buttons to this broadcast?", markup)
+    c.answer()
+
+# ── TOGGLE GLOBAL LINK-ONLY ──────────────────────────────────────────────────
+@callback_route("toggle_global")
+def _cb_toggle_global(c):
+    current = r.get('link_only_global') == 'True'
+    r.set('link_only_global', 'False' if current else 'True')
+    _invalidate_global_cache('link_only_global')
+    status = "OFF" if current else "ON"
+    c.answer(f"🔗 Global link-only → {status}")
+    show_main_menu(c.cid, f"🔗 Global link-only now {status}", c.mid)
+
+# ── GROUP PICKERS ────────────────────────────────────────────────────────────
+# Every "pick a group" menu is a registered selector, rendered one page at a
+# time from the title-sorted group index with Prev/Next and a title-prefix
+# search. Only the groups on the page get their title/status (and the
+# selector's own per-group data) loaded. Navigation buttons carry the
+# selector name and its context, e.g. a post draft key:
+#   gsel:{name}:{page}[:{ctx}]   gsel_find:{name}[:{ctx}]   gsel_clear:{name}[:{ctx}]
+_GROUP_PAGE_SIZE = 10
+_GROUP_SEARCH_TTL = 900
+_group_selectors = {}              # name → spec
+_group_selector_pages = {}         # name → last page shown, so Go Back lands there again
+
+def group_selector(name, header, button, back='back', parse_mode=None, load=None, line=None,
+                   footer='', extra=(), empty="❌ No groups available."):
+    """
+    Register a paginated group picker.
+    button(g, title, status, meta, ctx) → (label, callback_data) for one group.
+    load(chat_ids) → {chat_id: meta} fetches a page's extra per-group data;
+    line(g, title, status, meta) adds a text line per group above the buttons.
+    """
+    _group_selectors[name] = {
+        'header': header, 'button': button, 'back': back, 'parse_mode': parse_mode,
+        'load': load, 'line': line, 'footer': footer, 'extra': extra, 'empty': empty,
+    }
+
+def _selector_data(action, name, ctx='', page=None):
+    parts = [action, name] + ([str(page)] if page is not None else []) + ([ctx] if ctx else [])
+    return ':'.join(parts)
+
+def render_group_selector(name, page=None, ctx=''):
+    """(text, markup, parse_mode) for one page of a registered selector."""
+    spec = _group_selectors[name]
+    query = r.get(f'group_search:{name}')
+    if page is None:
+        page = _group_selector_pages.get(name, 0)
+    page = max(page, 0)
+    ids, total = group_index_slice(page * _GROUP_PAGE_SIZE, _GROUP_PAGE_SIZE, query)
+    pages = max(1, -(-total // _GROUP_PAGE_SIZE))
+    if page >= pages:  # the list shrank since this button was drawn
+        page = pages - 1
+        ids, total = group_index_slice(page * _GROUP_PAGE_SIZE, _GROUP_PAGE_SIZE, query)
+    _group_selector_pages[name] = page
+
+    infos = get_group_infos(ids)
+    meta = spec['load'](ids) if spec['load'] and ids else {}
+    markup = types.InlineKeyboardMarkup(row_width=3)
+    lines = [spec['header']]
+    for g in ids:
+        title, status = infos[g]
+        if spec['line']:
+            lines.append(spec['line'](g, title, status, meta.get(g)))
+        label, data = spec['button'](g, title, status, meta.get(g), ctx)
+        markup.add(types.InlineKeyboardButton(label, callback_data=data))
+    if not total:
+        lines = [spec['empty'] if not query else "🔎 No group title starts with that."]
+    else:
+        if spec['footer']:
+            lines.append(spec['footer'])
+        lines.append(f"\n📄 Page {page + 1}/{pages} · {total} group{'s' if total != 1 else ''}"
+                     f"{' found' if query else ''}")
+
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(types.InlineKeyboardButton("◀️ Prev", callback_data=_selector_data('gsel', name, ctx, page - 1)))
+        nav.append(types.InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=_selector_data('gsel', name, ctx, page)))
+        if page < pages - 1:
+            nav.append(types.InlineKeyboardButton("Next ▶️", callback_data=_selector_data('gsel', name, ctx, page + 1)))
+        markup.row(*nav)
+    if total or query:
+        search = [types.InlineKeyboardButton("🔎 Search by Title", callback_data=_selector_data('gsel_find', name, ctx))]
+        if query:
+            search.append(types.InlineKeyboardButton(f"✖️ Clear “{query[:20]}”", callback_data=_selector_data('gsel_clear', name, ctx)))
+        markup.row(*search)
+    for label, data in spec['extra']:
+        markup.add(types.InlineKeyboardButton(label, callback_data=data))
+    markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data=spec['back']))
+    return "\n".join(lines), markup, spec['parse_mode']
+
+@callback_route("gsel:{key}:{int}", "gsel:{key}:{int}:{str}")
+def _cb_gsel(c, name, page, ctx=''):
+    if name not in _group_selectors:
+        c.answer()
+        return
+    c.edit(*render_group_selector(name, page, ctx))
+    c.answer()
+
+@callback_route("gsel_find:{key}", "gsel_find:{key}:{str}")
+def _cb_gsel_find(c, name, ctx=''):
+    if name not in _group_selectors:
+        c.answer()
+        return
+    c.edit("🔎 Send the beginning of the group title.\nSend 'cancel' to go back.")
+    bot.register_next_step_handler(c.call.message, lambda m: process_group_search(m, name, ctx))
+    c.answer()
+
+@callback_route("gsel_clear:{key}", "gsel_clear:{key}:{str}")
+def _cb_gsel_clear(c, name, ctx=''):
+    if name not in _group_selectors:
+        c.answer()
+        return
+    r.delete(f'group_search:{name}')
+    c.edit(*render_group_selector(name, 0, ctx))
+    c.answer("Search cleared")
+
+# ── MY GROUPS / SEND TO GROUP ────────────────────────────────────────────────
+group_selector('groups', "👥 Your Groups:",
+               lambda g, title, status, meta, ctx: (f"{title} ({status})", f"group_menu:{g}"),
+               extra=[("🔄 Refresh List", "refresh_groups")],
+               empty="❌ No groups added yet.\nAdd the bot to groups first!")
+group_selector('send', "📨 Select group to send:",
+               lambda g, title, status, meta, ctx: (f"{title} ({status})", f"send_to_group:{g}"),
+               extra=[("🔄 Refresh List", "refresh_groups")],
+               empty="❌ No groups added yet.\nAdd the bot to groups first!")
+
+@callback_route("my_groups", "my_groups_send")
+def _cb_my_groups(c):
+    c.edit(*render_group_selector('groups' if c.data == "my_groups" else 'send'))
+    c.answer()
+
+# ── REFRESH GROUPS ───────────────────────────────────────────────────────────
+@callback_route("refresh_groups")
+def _cb_refresh_groups(c):
+    # Membership is tracked live via my_chat_member; this is a manual
+    # consistency check, run in parallel rather than one group at a time.
+    groups = list(get_groups())
+
+    def _probe(g):
         try:
-            me = bot.get_chat_member(chat_id, bot.get_me().id)
-            if me.status == 'creator':
-                perms_lines = [f"🟢 {label}" for _, label in PERM_LABELS]
-                perms_block = "\n".join(perms_lines)
-            elif me.status == 'administrator':
-                perms_lines = [
-                    f"{'🟢' if getattr(me, k, False) else '❌'} {label}"
-                    for k, label in PERM_LABELS
-                ]
-                perms_block = "\n".join(perms_lines)
-            else:
-                perms_block = "❌ Bot is not an administrator in this group."
+            chat = bot.get_chat(g)
+            _store_group_info(g, chat.title or f"Group {g}",
+                              _member_status_label(get_bot_member(g, force_refresh=True)))
+            return False
+        except telebot.apihelper.ApiTelegramException as e:
+            return "chat not found" in str(e).lower() or "forbidden" in str(e).lower()
         except Exception:
-            perms_block = "⚠️ Could not fetch permissions."
-
-        text = (
-            f"👥 *Group:* {title}\n"
-            f"🤖 *Bot Status:* {status}\n"
-            f"🔗 *Link-only:* {'✅ ON' if link_only_this else '❌ OFF'}\n"
-            f"🔁 *Repeating:* {'✅ ON' if repeat_on else '❌ OFF'}\n"
-            f"👋 *Join Reply:* {'✅ ON' if join_reply_on else '❌ OFF'}\n\n"
-            f"🔐 *Bot Permissions:*\n{perms_block}\n\n"
-            f"Select an action:"
-        )
+            return False
 
-        markup = types.InlineKeyboardMarkup(row_width=1)
-        markup.add(types.InlineKeyboardButton("📨 Send Message", callback_data=f"send_to_group:{chat_id}"))
-        markup.add(types.InlineKeyboardButton("🔁 Timer / Repeat / Auto-Delete", callback_data=f"setup_repeat:{chat_id}"))
-        markup.add(types.InlineKeyboardButton("👋 Join Reply", callback_data=f"group_join_reply:{chat_id}"))
-        markup.add(types.InlineKeyboardButton("🗑 Delete ALL My Sent Msgs", callback_data=f"purge:{chat_id}"))
-        markup.add(types.InlineKeyboardButton("🗑 Delete Last Bot Message", callback_data=f"delete_last:{chat_id}"))
-        last_id = r.get(f'last_sent:{chat_id}')
-        if last_id and is_admin:
-            markup.add(types.InlineKeyboardButton("📌 Pin Last Message", callback_data=f"pin_last:{chat_id}"))
-        markup.add(types.InlineKeyboardButton("💬 Set /start@ Reply", callback_data=f"set_group_start_reply:{chat_id}"))
-        markup.add(types.InlineKeyboardButton("➕ Add Account to Group", callback_data=f"add_to_group:{chat_id}:choose"))
-        markup.add(types.InlineKeyboardButton(
-            f"{'🔴 Disable' if link_only_this else '🟢 Enable'} Link-Only",
-            callback_data=f"toggle_group:{chat_id}"
-        ))
-        markup.add(types.InlineKeyboardButton("ℹ️ Group Info", callback_data=f"group_info:{chat_id}"))
-        markup.add(types.InlineKeyboardButton("🚫 Ban User", callback_data=f"ban_user_in_group:{chat_id}"))
-        markup.add(types.InlineKeyboardButton("🚪 Leave Group", callback_data=f"leave_group_confirm:{chat_id}"))
-        markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="my_groups"))
-
-        edit(text, markup, parse_mode='Markdown')
-        answer()
-
-    # ── SETUP REPEAT (per group) ──────────────────────────────────────────────
-    elif data.startswith("setup_repeat:"):
-        _, chat_id_str = data.split(":", 1)
-        chat_id = int(chat_id_str)
-        repeat_on = r.get(f'repeat_task:{chat_id}') == 'True'
-        interval = r.get(f'repeat_interval:{chat_id}') or "3600"
-        autodelete = r.get(f'repeat_autodelete:{chat_id}') == 'True'
-        self_del = r.get(f'repeat_self_delete:{chat_id}')
-        current_text = r.get(f'repeat_text:{chat_id}') or "Not set"
-
-        text = (
-            f"⚙️ *Repeat Setup*\n\n"
-            f"Status: {'✅ ON' if repeat_on else '❌ OFF'}\n"
-            f"Interval: {interval}s\n"
-            f"Auto-delete previous: {'✅' if autodelete else '❌'}\n"
-            f"Self-delete after: {self_del + 's' if self_del else '❌ OFF'}\n"
-            f"Message: _{current_text[:80]}_"
-        )
+    removed = 0
+    if groups:
+        with ThreadPoolExecutor(max_workers=min(_GROUP_INFO_FETCH_WORKERS, len(groups))) as pool:
+            for g, gone in zip(groups, pool.map(_probe, groups)):
+                if gone:
+                    remove_group(g)
+                    removed += 1
+    invalidate_group_index()   # titles may have changed
+    c.answer(f"✅ Refreshed. Removed {removed} invalid groups.")
+    c.reload("my_groups")
+
+# ── GROUP MENU ───────────────────────────────────────────────────────────────
+@callback_route("group_menu:{int}")
+def _cb_group_menu(c, chat_id):
+    title, status = get_group_info(chat_id)
+    is_admin = status == "Admin"
+    link_only_this = is_link_only(chat_id)
+    repeat_on = r.get(f'repeat_task:{chat_id}') == 'True'
+    join_reply_on = r.get(f'join_reply_enabled:{chat_id}') == 'True'
+
+    # Bot's own member record — cached, kept current by my_chat_member
+    PERM_LABELS = [
+        ('can_manage_chat',       'Manage Chat'),
+        ('can_change_info',       'Change Info'),
+        ('can_delete_messages',   'Delete Messages'),
+        ('can_restrict_members',  'Ban Users'),
+        ('can_invite_users',      'Invite Users'),
+        ('can_pin_messages',      'Pin Messages'),
+        ('can_manage_video_chats','Manage Voice Chats'),
+        ('can_promote_members',   'Add Admins'),
+        ('can_post_stories',      'Post Stories'),
+        ('can_edit_stories',      'Edit Stories'),
+        ('can_delete_stories',    'Delete Stories'),
+    ]
+    try:
+        me = get_bot_member(chat_id)
+        if me.status == 'creator':
+            perms_lines = [f"🟢 {label}" for _, label in PERM_LABELS]
+            perms_block = "\n".join(perms_lines)
+        elif me.status == 'administrator':
+            perms_lines = [
+                f"{'🟢' if getattr(me, k, False) else '❌'} {label}"
+                for k, label in PERM_LABELS
+            ]
+            perms_block = "\n".join(perms_lines)
+        else:
+            perms_block = "❌ Bot is not an administrator in this group."
+    except Exception:
+        perms_block = "⚠️ Could not fetch permissions."
+
+    text = (
+        f"👥 *Group:* {title}\n"
+        f"🤖 *Bot Status:* {status}\n"
+        f"🔗 *Link-only:* {'✅ ON' if link_only_this else '❌ OFF'}\n"
+        f"🔁 *Repeating:* {'✅ ON' if repeat_on else '❌ OFF'}\n"
+        f"👋 *Join Reply:* {'✅ ON' if join_reply_on else '❌ OFF'}\n\n"
+        f"🔐 *Bot Permissions:*\n{perms_block}\n\n"
+        f"Select an action:"
+    )
 
-        markup = types.InlineKeyboardMarkup(row_width=2)
-        markup.row(
-            types.InlineKeyboardButton("✅ ON", callback_data=f"repeat_on:{chat_id}"),
-            types.InlineKeyboardButton("❌ OFF", callback_data=f"repeat_off:{chat_id}")
-        )
-        markup.add(types.InlineKeyboardButton("✏️ Set / Edit Message", callback_data=f"set_repeat_text:{chat_id}"))
-        markup.row(
-            types.InlineKeyboardButton("⏱ Interval (sec)", callback_data=f"set_interval_sec:{chat_id}"),
-            types.InlineKeyboardButton("⏱ Interval (min)", callback_data=f"set_interval_min:{chat_id}")
-        )
-        markup.add(types.InlineKeyboardButton(
-            f"🗑 Auto-del prev: {'✅ ON' if autodelete else '❌ OFF'}",
-            callback_data=f"toggle_autodelete:{chat_id}"
-        ))
-        markup.add(types.InlineKeyboardButton(
-            f"💣 Self-delete: {'✅ ' + self_del + 's' if self_del else '❌ OFF'}",
-            callback_data=f"set_self_delete:{chat_id}"
-        ))
-        if self_del:
-            markup.add(types.InlineKeyboardButton("❌ Remove Self-Delete", callback_data=f"remove_self_delete:{chat_id}"))
-        markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data=f"group_menu:{chat_id}"))
-
-        edit(text, markup, parse_mode='Markdown')
-        answer()
-
-    elif data.startswith("set_repeat_text:"):
-        _, chat_id_str = data.split(":", 1)
-        chat_id = int(chat_id_str)
-        edit("✏️ Send the message you want to repeat:")
-        bot.register_next_step_handler(call.message, lambda m: process_set_repeat_text(m, chat_id))
-        answer()
-
-    elif data.startswith("set_self_delete:"):
-        _, chat_id_str = data.split(":", 1)
-        chat_id = int(chat_id_str)
-        edit("💣 Send self-delete delay in seconds (e.g. 30):")
-        bot.register_next_step_handler(call.message, lambda m: process_self_delete(m, chat_id))
-        answer()
-
-    elif data.startswith("remove_self_delete:"):
-        _, chat_id_str = data.split(":", 1)
-        chat_id = int(chat_id_str)
-        r.delete(f'repeat_self_delete:{chat_id}')
-        _invalidate_group_config_cache(chat_id)
-        answer("✅ Self-delete removed.")
-        _reload(f"setup_repeat:{chat_id}")
-
-    elif data.startswith("repeat_on:"):
-        _, chat_id_str = data.split(":", 1)
-        chat_id = int(chat_id_str)
-        if not r.get(f'repeat_text:{chat_id}'):
-            answer("⚠️ Set a repeat message first!", alert=True)
-            return
-        r.set(f'repeat_task:{chat_id}', 'True')
-        _invalidate_group_config_cache(chat_id)
-        start_repeat_thread(chat_id)
-        answer("✅ Repeating ON")
-        _reload(f"setup_repeat:{chat_id}")
-
-    elif data.startswith("repeat_off:"):
-        _, chat_id_str = data.split(":", 1)
-        chat_id = int(chat_id_str)
-        r.set(f'repeat_task:{chat_id}', 'False')
-        _invalidate_group_config_cache(chat_id)
-        # Remove from active threads dict so thread exits on next config check
-        with _repeat_thread_lock:
-            active_repeat_threads.pop(chat_id, None)
-        answer("✅ Repeating OFF")
-        _reload(f"setup_repeat:{chat_id}")
-
-    elif data.startswith("set_interval_sec:") or data.startswith("set_interval_min:"):
-        _, chat_id_str = data.split(":", 1)
-        chat_id = int(chat_id_str)
-        unit = "sec" if "sec" in data else "min"
-        edit(f"⏱ Send interval in {unit} (number only):")
-        bot.register_next_step_handler(call.message, lambda m: process_interval(m, chat_id, unit))
-        answer()
-
-    elif data.startswith("toggle_autodelete:"):
-        _, chat_id_str = data.split(":", 1)
-        chat_id = int(chat_id_str)
-        current = r.get(f'repeat_autodelete:{chat_id}') == 'True'
-        r.set(f'repeat_autodelete:{chat_id}', 'False' if current else 'True')
-        _invalidate_group_config_cache(chat_id)
-        answer(f"🗑 Auto-delete prev now {'❌ OFF' if current else '✅ ON'}")
-        _reload(f"setup_repeat:{chat_id}")
-
-    # ── DELETE ALL MY SENT MESSAGES IN GROUP ──────────────────────────────────
-    elif data.startswith("purge:"):
-        _, chat_id_str = data.split(":", 1)
-        chat_id = int(chat_id_str)
-        msg_ids = get_sent_messages(chat_id)
-        if not msg_ids:
-            answer("❌ No tracked messages to delete.", alert=True)
-            return
-        deleted = 0
-        failed = 0
-        for m_id in msg_ids:
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    markup.add(types.InlineKeyboardButton("📨 Send Message", callback_data=f"send_to_group:{chat_id}"))
+    markup.add(types.InlineKeyboardButton("🔁 Timer / Repeat / Auto-Delete", callback_data=f"setup_repeat:{chat_id}"))
+    markup.add(types.InlineKeyboardButton("👋 Join Reply", callback_data=f"group_join_reply:{chat_id}"))
+    markup.add(types.InlineKeyboardButton("🗑 Delete ALL My Sent Msgs", callback_data=f"purge:{chat_id}"))
+    markup.add(types.InlineKeyboardButton("🗑 Delete Last Bot Message", callback_data=f"delete_last:{chat_id}"))
+    last_id = r.get(f'last_sent:{chat_id}')
+    if last_id and is_admin:
+        markup.add(types.InlineKeyboardButton("📌 Pin Last Message", callback_data=f"pin_last:{chat_id}"))
+    markup.add(types.InlineKeyboardButton("💬 Set /start@ Reply", callback_data=f"set_group_start_reply:{chat_id}"))
+    markup.add(types.InlineKeyboardButton("➕ Add Account to Group", callback_data=f"add_to_group:{chat_id}:choose"))
+    markup.add(types.InlineKeyboardButton(
+        f"{'🔴 Disable' if link_only_this else '🟢 Enable'} Link-Only",
+        callback_data=f"toggle_group:{chat_id}"
+    ))
+    markup.add(types.InlineKeyboardButton("ℹ️ Group Info", callback_data=f"group_info:{chat_id}"))
+    markup.add(types.InlineKeyboardButton("🚫 Ban User", callback_data=f"ban_user_in_group:{chat_id}"))
+    markup.add(types.InlineKeyboardButton("🚪 Leave Group", callback_data=f"leave_group_confirm:{chat_id}"))
+    markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="my_groups"))
+
+    c.edit(text, markup, parse_mode='Markdown')
+    c.answer()
+
+# ── SETUP REPEAT (per group) ─────────────────────────────────────────────────
+@callback_route("setup_repeat:{int}")
+def _cb_setup_repeat(c, chat_id):
+    repeat_on = r.get(f'repeat_task:{chat_id}') == 'True'
+    interval = r.get(f'repeat_interval:{chat_id}') or "3600"
+    autodelete = r.get(f'repeat_autodelete:{chat_id}') == 'True'
+    self_del = r.get(f'repeat_self_delete:{chat_id}')
+    current_text = r.get(f'repeat_text:{chat_id}') or "Not set"
+
+    text = (
+        f"⚙️ *Repeat Setup*\n\n"
+        f"Status: {'✅ ON' if repeat_on else '❌ OFF'}\n"
+        f"Interval: {interval}s\n"
+        f"Auto-delete previous: {'✅' if autodelete else '❌'}\n"
+        f"Self-delete after: {self_del + 's' if self_del else '❌ OFF'}\n"
+        f"Message: _{current_text[:80]}_"
+    )
+
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup.row(
+        types.InlineKeyboardButton("✅ ON", callback_data=f"repeat_on:{chat_id}"),
+        types.InlineKeyboardButton("❌ OFF", callback_data=f"repeat_off:{chat_id}")
+    )
+    markup.add(types.InlineKeyboardButton("✏️ Set / Edit Message", callback_data=f"set_repeat_text:{chat_id}"))
+    markup.row(
+        types.InlineKeyboardButton("⏱ Interval (sec)", callback_data=f"set_interval_sec:{chat_id}"),
+        types.InlineKeyboardButton("⏱ Interval (min)", callback_data=f"set_interval_min:{chat_id}")
+    )
+    markup.add(types.InlineKeyboardButton(
+        f"🗑 Auto-del prev: {'✅ ON' if autodelete else '❌ OFF'}",
+        callback_data=f"toggle_autodelete:{chat_id}"
+    ))
+    markup.add(types.InlineKeyboardButton(
+        f"💣 Self-delete: {'✅ ' + self_del + 's' if self_del else '❌ OFF'}",
+        callback_data=f"set_self_delete:{chat_id}"
+    ))
+    if self_del:
+        markup.add(types.InlineKeyboardButton("❌ Remove Self-Delete", callback_data=f"remove_self_delete:{chat_id}"))
+    markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data=f"group_menu:{chat_id}"))
+
+    c.edit(text, markup, parse_mode='Markdown')
+    c.answer()
+
+@callback_route("set_repeat_text:{int}")
+def _cb_set_repeat_text(c, chat_id):
+    c.edit("✏️ Send the message you want to repeat:")
+    bot.register_next_step_handler(c.call.message, lambda m: process_set_repeat_text(m, chat_id))
+    c.answer()
+
+@callback_route("set_self_delete:{int}")
+def _cb_set_self_delete(c, chat_id):
+    c.edit("💣 Send self-delete delay in seconds (e.g. 30):")
+    bot.register_next_step_handler(c.call.message, lambda m: process_self_delete(m, chat_id))
+    c.answer()
+
+@callback_route("remove_self_delete:{int}")
+def _cb_remove_self_delete(c, chat_id):
+    r.delete(f'repeat_self_delete:{chat_id}')
+    _invalidate_group_config_cache(chat_id)
+    c.answer("✅ Self-delete removed.")
+    c.reload(f"setup_repeat:{chat_id}")
+
+@callback_route("repeat_on:{int}")
+def _cb_repeat_on(c, chat_id):
+    if not r.get(f'repeat_text:{chat_id}'):
+        c.answer("⚠️ Set a repeat message first!", alert=True)
+        return
+    r.set(f'repeat_task:{chat_id}', 'True')
+    _invalidate_group_config_cache(chat_id)
+    start_repeat_thread(chat_id)
+    c.answer("✅ Repeating ON")
+    c.reload(f"setup_repeat:{chat_id}")
+
+@callback_route("repeat_off:{int}")
+def _cb_repeat_off(c, chat_id):
+    r.set(f'repeat_task:{chat_id}', 'False')
+    _invalidate_group_config_cache(chat_id)
+    # Remove from active threads dict so thread exits on next config check
+    with _repeat_thread_lock:
+        active_repeat_threads.pop(chat_id, None)
+    c.answer("✅ Repeating OFF")
+    c.reload(f"setup_repeat:{chat_id}")
+
+@callback_route("set_interval_sec:{int}", "set_interval_min:{int}")
+def _cb_set_interval(c, chat_id):
+    unit = "sec" if "sec" in c.data else "min"
+    c.edit(f"⏱ Send interval in {unit} (number only):")
+    bot.register_next_step_handler(c.call.message, lambda m: process_interval(m, chat_id, unit))
+    c.answer()
+
+@callback_route("toggle_autodelete:{int}")
+def _cb_toggle_autodelete(c, chat_id):
+    current = r.get(f'repeat_autodelete:{chat_id}') == 'True'
+    r.set(f'repeat_autodelete:{chat_id}', 'False' if current else 'True')
+    _invalidate_group_config_cache(chat_id)
+    c.answer(f"🗑 Auto-delete prev now {'❌ OFF' if current else '✅ ON'}")
+    c.reload(f"setup_repeat:{chat_id}")
+
+# ── DELETE ALL MY SENT MESSAGES IN GROUP ─────────────────────────────────────
+@callback_route("purge:{int}")
+def _cb_purge(c, chat_id):
+    msg_ids = get_sent_messages(chat_id)
+    if not msg_ids:
+        c.answer("❌ No tracked messages to delete.", alert=True)
+        return
+    deleted = 0
+    failed = 0
+    for m_id in msg_ids:
+        try:
+            bot.delete_message(chat_id, m_id)
+            deleted += 1
+        except Exception:
+            failed += 1
+    clear_sent_messages(chat_id)
+    c.answer(f"✅ Deleted {deleted} msgs. {failed} failed (too old or already gone).", alert=True)
+    c.reload(f"group_menu:{chat_id}")
+
+# ── DELETE LAST BOT MESSAGE IN GROUP ─────────────────────────────────────────
+@callback_route("delete_last:{int}")
+def _cb_delete_last(c, chat_id):
+    last_id = r.get(f'last_sent:{chat_id}')
+    if not last_id:
+        c.answer("❌ No last message tracked.", alert=True)
+        return
+    try:
+        bot.delete_message(chat_id, int(last_id))
+        r.delete(f'last_sent:{chat_id}')
+        c.answer("✅ Last message deleted!", alert=True)
+    except Exception as e:
+        c.answer(f"❌ Failed: {str(e)}", alert=True)
+    c.reload(f"group_menu:{chat_id}")
+
+# ── DELETE ALL PRIVATE SENT MESSAGES ─────────────────────────────────────────
+@callback_route("delete_all_private")
+def _cb_delete_all_private(c):
+    deleted = 0
+    failed = 0
+    for uid in iter_users():
+        for m_id in get_private_sent(uid):
             try:
-                bot.delete_message(chat_id, m_id)
+                bot.delete_message(uid, m_id)
                 deleted += 1
             except Exception:
                 failed += 1
-        clear_sent_messages(chat_id)
-        answer(f"✅ Deleted {deleted} msgs. {failed} failed (too old or already gone).", alert=True)
-        _reload(f"group_menu:{chat_id}")
-
-    # ── DELETE LAST BOT MESSAGE IN GROUP ──────────────────────────────────────
-    elif data.startswith("delete_last:"):
-        _, chat_id_str = data.split(":", 1)
-        chat_id = int(chat_id_str)
-        last_id = r.get(f'last_sent:{chat_id}')
-        if not last_id:
-            answer("❌ No last message tracked.", alert=True)
-            return
-        try:
-            bot.delete_message(chat_id, int(last_id))
-            r.delete(f'last_sent:{chat_id}')
-            answer("✅ Last message deleted!", alert=True)
-        except Exception as e:
-            answer(f"❌ Failed: {str(e)}", alert=True)
-        _reload(f"group_menu:{chat_id}")
+        clear_private_sent(uid)
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="back"))
+    c.edit(f"🗑 Done!\n✅ Deleted: {deleted}\n❌ Failed: {failed}", markup)
+    c.answer()
 
-    # ── DELETE ALL PRIVATE SENT MESSAGES ─────────────────────────────────────
-    elif data == "delete_all_private":
-        users = get_all_users()
-        deleted = 0
-        failed = 0
-        for uid in users:
-            for m_id in get_private_sent(uid):
-                try:
-                    bot.delete_message(uid, m_id)
-                    deleted += 1
-                except Exception:
-                    failed += 1
-            clear_private_sent(uid)
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="back"))
-        edit(f"🗑 Done!\n✅ Deleted: {deleted}\n❌ Failed: {failed}", markup)
-        answer()
+# ── SEND TO GROUP ────────────────────────────────────────────────────────────
+@callback_route("send_to_group:{int}")
+def _cb_send_to_group(c, chat_id):
+    _clear_pending_buttons(OWNER_ID)
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup.row(
+        types.InlineKeyboardButton("✅ Yes — Add Buttons", callback_data=f"ibtn_add:group:{chat_id}"),
+        types.InlineKeyboardButton("❌ No Buttons", callback_data=f"ibtn_skip:group:{chat_id}"),
+    )
+    c.edit("📨 Do you want to add inline buttons to this message?", markup)
+    c.answer()
+
+# ── PIN LAST ─────────────────────────────────────────────────────────────────
+@callback_route("pin_last:{int}")
+def _cb_pin_last(c, chat_id):
+    msg_id = r.get(f'last_sent:{chat_id}')
+    if not msg_id:
+        c.answer("❌ No last message tracked.", alert=True)
+        return
+    if not bot_can_pin(chat_id):
+        c.answer("❌ Bot does not have permission to pin in this group.", alert=True)
+        return
+    try:
+        bot.pin_chat_message(chat_id, int(msg_id))
+        c.answer("✅ Message pinned!", alert=True)
+    except Exception as e:
+        c.answer(f"❌ Pin failed: {str(e)}", alert=True)
+
+# ── TOGGLE GROUP LINK-ONLY ───────────────────────────────────────────────────
+@callback_route("toggle_group:{int}")
+def _cb_toggle_group(c, chat_id):
+    current = is_link_only(chat_id)
+    set_link_only(chat_id, not current)
+    c.answer(f"🔗 Link-only now {'❌ OFF' if current else '✅ ON'}")
+    c.reload(f"group_menu:{chat_id}")
+
+# ── GROUP /start@ REPLY ──────────────────────────────────────────────────────
+@callback_route("set_group_start_reply:{int}")
+def _cb_set_group_start_reply(c, chat_id):
+    current = r.get(f'group_start_reply:{chat_id}') or "Not set"
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    markup.add(
+        types.InlineKeyboardButton("✏️ Set / Edit Reply", callback_data=f"do_set_group_start_reply:{chat_id}"),
+        types.InlineKeyboardButton("🗑 Remove Reply", callback_data=f"reset_group_start_reply:{chat_id}"),
+        types.InlineKeyboardButton("🔙 Go Back", callback_data=f"group_menu:{chat_id}"),
+    )
+    c.edit(f"💬 */start@ Reply for this group*\n\nCurrent:\n_{current}_", markup, parse_mode='Markdown')
+    c.answer()
 
-    # ── SEND TO GROUP ─────────────────────────────────────────────────────────
-    elif data.startswith("send_to_group:"):
-        _, chat_id_str = data.split(":", 1)
-        chat_id = int(chat_id_str)
-        _clear_pending_buttons(OWNER_ID)
-        markup = types.InlineKeyboardMarkup(row_width=2)
-        markup.row(
-            types.InlineKeyboardButton("✅ Yes — Add Buttons", callback_data=f"ibtn_add:group:{chat_id}"),
-            types.InlineKeyboardButton("❌ No Buttons", callback_data=f"ibtn_skip:group:{chat_id}"),
-        )
-        edit("📨 Do you want to add inline buttons to this message?", markup)
-        answer()
-
-    # ── PIN LAST ──────────────────────────────────────────────────────────────
-    elif data.startswith("pin_last:"):
-        _, chat_id_str = data.split(":", 1)
-        chat_id = int(chat_id_str)
-        msg_id = r.get(f'last_sent:{chat_id}')
-        if not msg_id:
-            answer("❌ No last message tracked.", alert=True)
-            return
-        if not bot_can_pin(chat_id):
-            answer("❌ Bot does not have permission to pin in this group.", alert=True)
-            return
-        try:
-            bot.pin_chat_message(chat_id, int(msg_id))
-            answer("✅ Message pinned!", alert=True)
-        except Exception as e:
-            answer(f"❌ Pin failed: {str(e)}", alert=True)
-
-    # ── TOGGLE GROUP LINK-ONLY ────────────────────────────────────────────────
-    elif data.startswith("toggle_group:"):
-        _, chat_id_str = data.split(":", 1)
-        chat_id = int(chat_id_str)
-        current = is_link_only(chat_id)
-        set_link_only(chat_id, not current)
-        answer(f"🔗 Link-only now {'❌ OFF' if current else '✅ ON'}")
-        _reload(f"group_menu:{chat_id}")
-
-    # ── GROUP /start@ REPLY ───────────────────────────────────────────────────
-    elif data.startswith("set_group_start_reply:"):
-        _, chat_id_str = data.split(":", 1)
-        chat_id = int(chat_id_str)
-        current = r.get(f'group_start_reply:{chat_id}') or "Not set"
-        markup = types.InlineKeyboardMarkup(row_width=1)
-        markup.add(
-            types.InlineKeyboardButton("✏️ Set / Edit Reply", callback_data=f"do_set_group_start_reply:{chat_id}"),
-            types.InlineKeyboardButton("🗑 Remove Reply", callback_data=f"reset_group_start_reply:{chat_id}"),
-            types.InlineKeyboardButton("🔙 Go Back", callback_data=f"group_menu:{chat_id}"),
-        )
-        edit(f"💬 */start@ Reply for this group*\n\nCurrent:\n_{current}_", markup, parse_mode='Markdown')
-        answer()
-
-    elif data.startswith("do_set_group_start_reply:"):
-        _, chat_id_str = data.split(":", 1)
-        chat_id = int(chat_id_str)
-        edit("✏️ Send the new /start@ reply for this group:")
-        bot.register_next_step_handler(call.message, lambda m: process_group_start_reply(m, chat_id))
-        answer()
-
-    elif data.startswith("reset_group_start_reply:"):
-        _, chat_id_str = data.split(":", 1)
-        chat_id = int(chat_id_str)
-        r.delete(f'group_start_reply:{chat_id}')
-        answer("✅ Group /start@ reply removed.", alert=True)
-        _reload(f"set_group_start_reply:{chat_id}")
-
-    # ── GLOBAL JOIN REPLY ─────────────────────────────────────────────────────
-    elif data == "global_join_reply_menu":
-        enabled     = r.get('global_join_reply_enabled') == 'True'
-        autodelete  = r.get('global_join_reply_autodelete') == 'True'
-        current_text = r.get('global_join_reply_text') or "Welcome!"
-        markup = types.InlineKeyboardMarkup(row_width=2)
-        markup.row(
-            types.InlineKeyboardButton("✅ ON", callback_data="global_join_reply_on"),
-            types.InlineKeyboardButton("❌ OFF", callback_data="global_join_reply_off")
-        )
-        markup.add(types.InlineKeyboardButton("✏️ Set / Edit Reply", callback_data="set_global_join_reply"))
-        markup.add(types.InlineKeyboardButton("🗑 Reset to Default", callback_data="reset_global_join_reply"))
-        markup.add(types.InlineKeyboardButton(
-            f"🗑 Delete Previous: {'✅ ON' if autodelete else '❌ OFF'}",
-            callback_data="toggle_global_join_autodelete"
-        ))
+@callback_route("do_set_group_start_reply:{int}")
+def _cb_do_set_group_start_reply(c, chat_id):
+    c.edit("✏️ Send the new /start@ reply for this group:")
+    bot.register_next_step_handler(c.call.message, lambda m: process_group_start_reply(m, chat_id))
+    c.answer()
+
+@callback_route("reset_group_start_reply:{int}")
+def _cb_reset_group_start_reply(c, chat_id):
+    r.delete(f'group_start_reply:{chat_id}')
+    c.answer("✅ Group /start@ reply removed.", alert=True)
+    c.reload(f"set_group_start_reply:{chat_id}")
+
+# ── GLOBAL JOIN REPLY ────────────────────────────────────────────────────────
+@callback_route("global_join_reply_menu")
+def _cb_global_join_reply_menu(c):
+    enabled     = r.get('global_join_reply_enabled') == 'True'
+    autodelete  = r.get('global_join_reply_autodelete') == 'True'
+    current_text = r.get('global_join_reply_text') or "Welcome!"
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup.row(
+        types.InlineKeyboardButton("✅ ON", callback_data="global_join_reply_on"),
+        types.InlineKeyboardButton("❌ OFF", callback_data="global_join_reply_off")
+    )
+    markup.add(types.InlineKeyboardButton("✏️ Set / Edit Reply", callback_data="set_global_join_reply"))
+    markup.add(types.InlineKeyboardButton("🗑 Reset to Default", callback_data="reset_global_join_reply"))
+    markup.add(types.InlineKeyboardButton(
+        f"🗑 Delete Previous: {'✅ ON' if autodelete else '❌ OFF'}",
+        callback_data="toggle_global_join_autodelete"
+    ))
+    markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="back"))
+    c.edit(
+        f"👋 *Global Join Reply*\n\n"
+        f"Status: {'✅ ON' if enabled else '❌ OFF'}\n"
+        f"Delete previous reply: {'✅ ON' if autodelete else '❌ OFF'}\n"
+        f"Message:\n_{current_text}_",
+        markup, parse_mode='Markdown'
+    )
+    c.answer()
+
+@callback_route("global_join_reply_on")
+def _cb_global_join_reply_on(c):
+    r.set('global_join_reply_enabled', 'True')
+    c.answer("✅ Global join reply ON")
+    c.reload("global_join_reply_menu")
+
+@callback_route("global_join_reply_off")
+def _cb_global_join_reply_off(c):
+    r.set('global_join_reply_enabled', 'False')
+    c.answer("✅ Global join reply OFF")
+    c.reload("global_join_reply_menu")
+
+@callback_route("set_global_join_reply")
+def _cb_set_global_join_reply(c):
+    c.edit("✏️ Send the new global join reply message:")
+    bot.register_next_step_handler(c.call.message, process_global_join_reply)
+    c.answer()
+
+@callback_route("reset_global_join_reply")
+def _cb_reset_global_join_reply(c):
+    r.set('global_join_reply_text', 'Welcome!')
+    c.answer("✅ Reset to default: 'Welcome!'", alert=True)
+    c.reload("global_join_reply_menu")
+
+@callback_route("toggle_global_join_autodelete")
+def _cb_toggle_global_join_autodelete(c):
+    current = r.get('global_join_reply_autodelete') == 'True'
+    r.set('global_join_reply_autodelete', 'False' if current else 'True')
+    c.answer(f"🗑 Delete previous join reply: {'❌ OFF' if current else '✅ ON'}")
+    c.reload("global_join_reply_menu")
+
+# ── GROUP JOIN REPLY ─────────────────────────────────────────────────────────
+@callback_route("group_join_reply:{int}")
+def _cb_group_join_reply(c, chat_id):
+    enabled      = r.get(f'join_reply_enabled:{chat_id}') == 'True'
+    current_text = r.get(f'join_reply_text:{chat_id}') or "Not set (uses global)"
+    # Per-group autodelete: if not set, show global fallback state
+    group_ad_raw = r.get(f'join_reply_autodelete:{chat_id}')
+    global_ad    = r.get('global_join_reply_autodelete') == 'True'
+    if group_ad_raw is not None:
+        autodelete     = group_ad_raw == 'True'
+        autodelete_src = ""
+    else:
+        autodelete     = global_ad
+        autodelete_src = " (global)"
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup.row(
+        types.InlineKeyboardButton("✅ ON", callback_data=f"group_join_on:{chat_id}"),
+        types.InlineKeyboardButton("❌ OFF", callback_data=f"group_join_off:{chat_id}")
+    )
+    markup.add(types.InlineKeyboardButton("✏️ Set / Edit Reply", callback_data=f"set_group_join_reply:{chat_id}"))
+    markup.add(types.InlineKeyboardButton("🗑 Reset Reply", callback_data=f"reset_group_join_reply:{chat_id}"))
+    markup.add(types.InlineKeyboardButton(
+        f"🗑 Delete Previous: {'✅ ON' if autodelete else '❌ OFF'}{autodelete_src}",
+        callback_data=f"toggle_group_join_autodelete:{chat_id}"
+    ))
+    markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data=f"group_menu:{chat_id}"))
+    c.edit(
+        f"👋 *Group Join Reply*\n\n"
+        f"Status: {'✅ ON' if enabled else '❌ OFF'}\n"
+        f"Delete previous reply: {'✅ ON' if autodelete else '❌ OFF'}{autodelete_src}\n"
+        f"Message:\n_{current_text}_",
+        markup, parse_mode='Markdown'
+    )
+    c.answer()
+
+@callback_route("group_join_on:{int}")
+def _cb_group_join_on(c, chat_id):
+    r.set(f'join_reply_enabled:{chat_id}', 'True')
+    c.answer("✅ Group join reply ON")
+    c.reload(f"group_join_reply:{chat_id}")
+
+@callback_route("group_join_off:{int}")
+def _cb_group_join_off(c, chat_id):
+    r.set(f'join_reply_enabled:{chat_id}', 'False')
+    c.answer("✅ Group join reply OFF")
+    c.reload(f"group_join_reply:{chat_id}")
+
+@callback_route("set_group_join_reply:{int}")
+def _cb_set_group_join_reply(c, chat_id):
+    c.edit("✏️ Send the join reply message for this group:")
+    bot.register_next_step_handler(c.call.message, lambda m: process_group_join_reply(m, chat_id))
+    c.answer()
+
+@callback_route("reset_group_join_reply:{int}")
+def _cb_reset_group_join_reply(c, chat_id):
+    r.delete(f'join_reply_text:{chat_id}')
+    c.answer("✅ Group join reply text reset (will use global).", alert=True)
+    c.reload(f"group_join_reply:{chat_id}")
+
+@callback_route("toggle_group_join_autodelete:{int}")
+def _cb_toggle_group_join_autodelete(c, chat_id):
+    current_raw = r.get(f'join_reply_autodelete:{chat_id}')
+    # If not set yet, first toggle sets it explicitly (opposite of current effective state)
+    if current_raw is None:
+        global_ad = r.get('global_join_reply_autodelete') == 'True'
+        new_val = 'False' if global_ad else 'True'
+    else:
+        new_val = 'False' if current_raw == 'True' else 'True'
+    r.set(f'join_reply_autodelete:{chat_id}', new_val)
+    c.answer(f"🗑 Delete previous join reply: {'✅ ON' if new_val == 'True' else '❌ OFF'}")
+    c.reload(f"group_join_reply:{chat_id}")
+
+# ── ADD ACCOUNT TO GROUP (main menu) ─────────────────────────────────────────
+@callback_route("add_account_menu")
+def _cb_add_account_menu(c):
+    groups = get_groups()
+    eligible = []
+    for g in groups:
+        can_add, can_promote = bot_can_add_members(g)
+        if can_add or can_promote:
+            eligible.append((g, can_add, can_promote))
+
+    if not eligible:
+        markup = types.InlineKeyboardMarkup()
         markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="back"))
-        edit(
-            f"👋 *Global Join Reply*\n\n"
-            f"Status: {'✅ ON' if enabled else '❌ OFF'}\n"
-            f"Delete previous reply: {'✅ ON' if autodelete else '❌ OFF'}\n"
-            f"Message:\n_{current_text}_",
-            markup, parse_mode='Markdown'
-        )
-        answer()
-
-    elif data == "global_join_reply_on":
-        r.set('global_join_reply_enabled', 'True')
-        answer("✅ Global join reply ON")
-        _reload("global_join_reply_menu")
-
-    elif data == "global_join_reply_off":
-        r.set('global_join_reply_enabled', 'False')
-        answer("✅ Global join reply OFF")
-        _reload("global_join_reply_menu")
-
-    elif data == "set_global_join_reply":
-        edit("✏️ Send the new global join reply message:")
-        bot.register_next_step_handler(call.message, process_global_join_reply)
-        answer()
-
-    elif data == "reset_global_join_reply":
-        r.set('global_join_reply_text', 'Welcome!')
-        answer("✅ Reset to default: 'Welcome!'", alert=True)
-        _reload("global_join_reply_menu")
-
-    elif data == "toggle_global_join_autodelete":
-        current = r.get('global_join_reply_autodelete') == 'True'
-        r.set('global_join_reply_autodelete', 'False' if current else 'True')
-        answer(f"🗑 Delete previous join reply: {'❌ OFF' if current else '✅ ON'}")
-        _reload("global_join_reply_menu")
-
-    # ── GROUP JOIN REPLY ──────────────────────────────────────────────────────
-    elif data.startswith("group_join_reply:"):
-        _, chat_id_str = data.split(":", 1)
-        chat_id = int(chat_id_str)
-        enabled      = r.get(f'join_reply_enabled:{chat_id}') == 'True'
-        current_text = r.get(f'join_reply_text:{chat_id}') or "Not set (uses global)"
-        # Per-group autodelete: if not set, show global fallback state
-        group_ad_raw = r.get(f'join_reply_autodelete:{chat_id}')
-        global_ad    = r.get('global_join_reply_autodelete') == 'True'
-        if group_ad_raw is not None:
-            autodelete     = group_ad_raw == 'True'
-            autodelete_src = ""
-        else:
-            autodelete     = global_ad
-            autodelete_src = " (global)"
-        markup = types.InlineKeyboardMarkup(row_width=2)
-        markup.row(
-            types.InlineKeyboardButton("✅ ON", callback_data=f"group_join_on:{chat_id}"),
-            types.InlineKeyboardButton("❌ OFF", callback_data=f"group_join_off:{chat_id}")
-        )
-        markup.add(types.InlineKeyboardButton("✏️ Set / Edit Reply", callback_data=f"set_group_join_reply:{chat_id}"))
-        markup.add(types.InlineKeyboardButton("🗑 Reset Reply", callback_data=f"reset_group_join_reply:{chat_id}"))
-        markup.add(types.InlineKeyboardButton(
-            f"🗑 Delete Previous: {'✅ ON' if autodelete else '❌ OFF'}{autodelete_src}",
-            callback_data=f"toggle_group_join_autodelete:{chat_id}"
-        ))
-        markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data=f"group_menu:{chat_id}"))
-        edit(
-            f"👋 *Group Join Reply*\n\n"
-            f"Status: {'✅ ON' if enabled else '❌ OFF'}\n"
-            f"Delete previous reply: {'✅ ON' if autodelete else '❌ OFF'}{autodelete_src}\n"
-            f"Message:\n_{current_text}_",
-            markup, parse_mode='Markdown'
+        c.edit(
+            "❌ No groups where bot has the necessary permissions.\n\n"
+            "ℹ️ Bot must be admin with 'Add Members' or 'Promote Members' rights.",
+            markup
         )
-        answer()
-
-    elif data.startswith("group_join_on:"):
-        _, chat_id_str = data.split(":", 1)
-        chat_id = int(chat_id_str)
-        r.set(f'join_reply_enabled:{chat_id}', 'True')
-        answer("✅ Group join reply ON")
-        _reload(f"group_join_reply:{chat_id}")
-
-    elif data.startswith("group_join_off:"):
-        _, chat_id_str = data.split(":", 1)
-        chat_id = int(chat_id_str)
-        r.set(f'join_reply_enabled:{chat_id}', 'False')
-        answer("✅ Group join reply OFF")
-        _reload(f"group_join_reply:{chat_id}")
-
-    elif data.startswith("set_group_join_reply:"):
-        _, chat_id_str = data.split(":", 1)
-        chat_id = int(chat_id_str)
-        edit("✏️ Send the join reply message for this group:")
-        bot.register_next_step_handler(call.message, lambda m: process_group_join_reply(m, chat_id))
-        answer()
-
-    elif data.startswith("reset_group_join_reply:"):
-        _, chat_id_str = data.split(":", 1)
-        chat_id = int(chat_id_str)
-        r.delete(f'join_reply_text:{chat_id}')
-        answer("✅ Group join reply text reset (will use global).", alert=True)
-        _reload(f"group_join_reply:{chat_id}")
-
-    elif data.startswith("toggle_group_join_autodelete:"):
-        _, chat_id_str = data.split(":", 1)
-        chat_id = int(chat_id_str)
-        current_raw = r.get(f'join_reply_autodelete:{chat_id}')
-        # If not set yet, first toggle sets it explicitly (opposite of current effective state)
-        if current_raw is None:
-            global_ad = r.get('global_join_reply_autodelete') == 'True'
-            new_val = 'False' if global_ad else 'True'
-        else:
-            new_val = 'False' if current_raw == 'True' else 'True'
-        r.set(f'join_reply_autodelete:{chat_id}', new_val)
-        answer(f"🗑 Delete previous join reply: {'✅ ON' if new_val == 'True' else '❌ OFF'}")
-        _reload(f"group_join_reply:{chat_id}")
-
-    # ── ADD ACCOUNT TO GROUP (main menu) ──────────────────────────────────────
-    elif data == "add_account_menu":
-        groups = get_groups()
-        eligible = []
-        for g in groups:
-            can_add, can_promote = bot_can_add_members(g)
-            if can_add or can_promote:
-                eligible.append((g, can_add, can_promote))
-
-        if not eligible:
-            markup = types.InlineKeyboardMarkup()
-            markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="back"))
-            edit(
-                "❌ No groups where bot has the necessary permissions.\n\n"
-                "ℹ️ Bot must be admin with 'Add Members' or 'Promote Members' rights.",
-                markup
-            )
-            answer()
-            return
+        c.answer()
+        return
 
-        markup = types.InlineKeyboardMarkup(row_width=1)
-        for g, can_add, can_promote in eligible:
-            title, _ = get_group_info(g)
-            perms = []
-            if can_promote:
-                perms.append("Can Promote")
-            if can_add:
-                perms.append("Can Invite")
-            markup.add(types.InlineKeyboardButton(
-                f"{title} ({', '.join(perms)})",
-                callback_data=f"add_to_group:{g}:choose"
-            ))
-        markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="back"))
-        edit("➕ *Select a group:*", markup, parse_mode='Markdown')
-        answer()
-
-    # ── ADD TO GROUP: CHOOSE ROLE ─────────────────────────────────────────────
-    elif data.startswith("add_to_group:") and data.endswith(":choose"):
-        parts = data.split(":")
-        chat_id = int(parts[1])
-        can_add, can_promote = bot_can_add_members(chat_id)
-        title, _ = get_group_info(chat_id)
-        markup = types.InlineKeyboardMarkup(row_width=1)
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    infos = get_group_infos([g for g, _, _ in eligible])
+    for g, can_add, can_promote in eligible:
+        title, _ = infos[g]
+        perms = []
         if can_promote:
-            markup.add(types.InlineKeyboardButton(
-                "👑 Promote to Admin (user must already be in group)",
-                callback_data=f"add_to_group:{chat_id}:admin"
-            ))
+            perms.append("Can Promote")
         if can_add:
-            markup.add(types.InlineKeyboardButton(
-                "🔗 Generate Invite Link (to add as member)",
-                callback_data=f"add_to_group:{chat_id}:invite"
-            ))
-        markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="add_account_menu"))
-        edit(
-            f"➕ *Add to:* {title}\n\n"
-            f"⚠️ *How it works:*\n"
-            f"• *Promote to Admin* — user must already be in the group.\n"
-            f"• *Invite Link* — generates a link anyone can use to join.\n\n"
-            f"Choose an option:",
-            markup, parse_mode='Markdown'
-        )
-        answer()
-
-    # ── ADD TO GROUP: PROMOTE TO ADMIN ────────────────────────────────────────
-    elif data.startswith("add_to_group:") and data.endswith(":admin"):
-        parts = data.split(":")
-        chat_id = int(parts[1])
-        title, _ = get_group_info(chat_id)
-        bot_perms = get_bot_admin_permissions(chat_id)
-        perm_map = {
-            'can_manage_chat': 'Manage Chat',
-            'can_change_info': 'Change Info',
-            'can_delete_messages': 'Delete Messages',
-            'can_restrict_members': 'Restrict Members',
-            'can_invite_users': 'Invite Users',
-            'can_pin_messages': 'Pin Messages',
-            'can_manage_video_chats': 'Manage Video Chats',
-            'can_promote_members': 'Add New Admins',
-            'can_post_stories': 'Post Stories',
-            'can_edit_stories': 'Edit Stories',
-            'can_delete_stories': 'Delete Stories',
-        }
-        perm_lines = [f"  ✅ {label}" for key, label in perm_map.items() if bot_perms.get(key)]
-        perms_info = "\n".join(perm_lines) if perm_lines else "  ⚠️ Bot has no grantable permissions"
-        edit(
-            f"👑 *Promote to Admin in:* {title}\n\n"
-            f"Send the user ID(s) of people *already in the group*.\n"
-            f"Separate multiple IDs with spaces or commas.\n\n"
-            f"📋 *Permissions the bot can grant:*\n{perms_info}\n\n"
-            f"⚠️ Only works if the user is already a member.",
-            markup=None
-        )
-        bot.register_next_step_handler(call.message, lambda m: process_promote_to_admin(m, chat_id))
-        answer()
-
-    # ── ADD TO GROUP: GENERATE INVITE LINK ────────────────────────────────────
-    elif data.startswith("add_to_group:") and data.endswith(":invite"):
-        parts = data.split(":")
-        chat_id = int(parts[1])
-        title, _ = get_group_info(chat_id)
-        try:
-            link = bot.create_chat_invite_link(chat_id)
-            markup = types.InlineKeyboardMarkup()
-            markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data=f"add_to_group:{chat_id}:choose"))
-            edit(
-                f"🔗 *Invite link for:* {title}\n\n"
-                f"`{link.invite_link}`\n\n"
-                f"Share this link with anyone you want to add to the group.",
-                markup, parse_mode='Markdown'
-            )
-        except Exception as e:
-            markup = types.InlineKeyboardMarkup()
-            markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data=f"add_to_group:{chat_id}:choose"))
-            edit(f"❌ Could not generate invite link:\n{str(e)}", markup)
-        answer()
-
-    # ── GLOBAL REPEAT MENU ────────────────────────────────────────────────────
-    elif data == "global_repeat_menu":
-        repeat_on = r.get('global_repeat_task') == 'True'
-        interval = r.get('global_repeat_interval') or "3600"
-        autodelete = r.get('global_repeat_autodelete') == 'True'
-        self_del = r.get('global_repeat_self_delete')
-        current_text = r.get('global_repeat_text') or "Not set"
-
-        text = (
-            f"🔁 *Global Broadcast Repeat*\n\n"
-            f"Status: {'✅ ON' if repeat_on else '❌ OFF'}\n"
-            f"Interval: {interval}s\n"
-            f"Auto-delete previous: {'✅' if autodelete else '❌'}\n"
-            f"Self-delete after: {self_del + 's' if self_del else '❌ OFF'}\n"
-            f"Message: _{current_text[:80]}_"
-        )
-
-        markup = types.InlineKeyboardMarkup(row_width=2)
-        markup.add(types.InlineKeyboardButton("⏸ Pause All Group Repeats", callback_data="pause_all_group_repeats"))
-        markup.row(
-            types.InlineKeyboardButton("✅ ON", callback_data="global_repeat_on"),
-            types.InlineKeyboardButton("❌ OFF", callback_data="global_repeat_off")
-        )
-        markup.add(types.InlineKeyboardButton("✏️ Set / Edit Message", callback_data="set_global_repeat_text"))
-        markup.row(
-            types.InlineKeyboardButton("⏱ Interval (sec)", callback_data="set_global_interval_sec"),
-            types.InlineKeyboardButton("⏱ Interval (min)", callback_data="set_global_interval_min")
-        )
+            perms.append("Can Invite")
         markup.add(types.InlineKeyboardButton(
-            f"🗑 Auto-del prev: {'✅ ON' if autodelete else '❌ OFF'}",
-            callback_data="toggle_global_autodelete"
+            f"{title} ({', '.join(perms)})",
+            callback_data=f"add_to_group:{g}:choose"
         ))
+    markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="back"))
+    c.edit("➕ *Select a group:*", markup, parse_mode='Markdown')
+    c.answer()
+
+# ── ADD TO GROUP: CHOOSE ROLE ────────────────────────────────────────────────
+@callback_route("add_to_group:{int}:choose")
+def _cb_add_to_group_choose(c, chat_id):
+    can_add, can_promote = bot_can_add_members(chat_id)
+    title, _ = get_group_info(chat_id)
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    if can_promote:
         markup.add(types.InlineKeyboardButton(
-            f"💣 Self-delete: {'✅ ' + self_del + 's' if self_del else '❌ OFF'}",
-            callback_data="set_global_self_delete"
+            "👑 Promote to Admin (user must already be in group)",
+            callback_data=f"add_to_group:{chat_id}:admin"
         ))
-        if self_del:
-            markup.add(types.InlineKeyboardButton("❌ Remove Self-Delete", callback_data="remove_global_self_delete"))
-        markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="back"))
-
-        edit(text, markup, parse_mode='Markdown')
-        answer()
+    if can_add:
+        markup.add(types.InlineKeyboardButton(
+            "🔗 Generate Invite Link (to add as member)",
+            callback_data=f"add_to_group:{chat_id}:invite"
+        ))
+    markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="add_account_menu"))
+    c.edit(
+        f"➕ *Add to:* {title}\n\n"
+        f"⚠️ *How it works:*\n"
+        f"• *Promote to Admin* — user must already be in the group.\n"
+        f"• *Invite Link* — generates a link anyone can use to join.\n\n"
+        f"Choose an option:",
+        markup, parse_mode='Markdown'
+    )
+    c.answer()
 
-    elif data == "pause_all_group_repeats":
-        for g in get_groups():
-            r.set(f'repeat_task:{g}', 'False')
-        answer("⏸ All individual group repeats paused.", alert=True)
-        _reload("global_repeat_menu")
+# ── ADD TO GROUP: PROMOTE TO ADMIN ───────────────────────────────────────────
+@callback_route("add_to_group:{int}:admin")
+def _cb_add_to_group_admin(c, chat_id):
+    title, _ = get_group_info(chat_id)
+    bot_perms = get_bot_admin_permissions(chat_id)
+    perm_map = {
+        'can_manage_chat': 'Manage Chat',
+        'can_change_info': 'Change Info',
+        'can_delete_messages': 'Delete Messages',
+        'can_restrict_members': 'Restrict Members',
+        'can_invite_users': 'Invite Users',
+        'can_pin_messages': 'Pin Messages',
+        'can_manage_video_chats': 'Manage Video Chats',
+        'can_promote_members': 'Add New Admins',
+        'can_post_stories': 'Post Stories',
+        'can_edit_stories': 'Edit Stories',
+        'can_delete_stories': 'Delete Stories',
+    }
+    perm_lines = [f"  ✅ {label}" for key, label in perm_map.items() if bot_perms.get(key)]
+    perms_info = "\n".join(perm_lines) if perm_lines else "  ⚠️ Bot has no grantable permissions"
+    c.edit(
+        f"👑 *Promote to Admin in:* {title}\n\n"
+        f"Send the user ID(s) of people *already in the group*.\n"
+        f"Separate multiple IDs with spaces or commas.\n\n"
+        f"📋 *Permissions the bot can grant:*\n{perms_info}\n\n"
+        f"⚠️ Only works if the user is already a member.",
+        markup=None
+    )
+    bot.register_next_step_handler(c.call.message, lambda m: process_promote_to_admin(m, chat_id))
+    c.answer()
 
-    elif data == "global_repeat_on":
-        if not r.get('global_repeat_text'):
-            answer("⚠️ Set a repeat message first!", alert=True)
-            return
-        r.set('global_repeat_task', 'True')
-        _invalidate_global_cache('global_repeat_task')
-        reset_global_repeat_schedule()  # Clear schedules so all groups fire immediately
-        start_global_repeat_thread()
-        answer("✅ Global repeat ON")
-        _reload("global_repeat_menu")
-
-    elif data == "global_repeat_off":
-        stop_global_repeat()
-        _invalidate_global_cache('global_repeat_task')
-        answer("✅ Global repeat OFF")
-        _reload("global_repeat_menu")
-
-    elif data == "set_global_repeat_text":
-        edit("✏️ Send the message for global repeat broadcast:")
-        bot.register_next_step_handler(call.message, process_global_repeat_text)
-        answer()
-
-    elif data in ["set_global_interval_sec", "set_global_interval_min"]:
-        unit = "sec" if "sec" in data else "min"
-        edit(f"⏱ Send global repeat interval in {unit} (number only):")
-        bot.register_next_step_handler(call.message, lambda m: process_global_interval(m, unit))
-        answer()
-
-    elif data == "toggle_global_autodelete":
-        current = r.get('global_repeat_autodelete') == 'True'
-        r.set('global_repeat_autodelete', 'False' if current else 'True')
-        _invalidate_global_cache('global_repeat_autodelete')
-        answer(f"🗑 Global auto-delete prev now {'❌ OFF' if current else '✅ ON'}")
-        _reload("global_repeat_menu")
-
-    elif data == "set_global_self_delete":
-        edit("💣 Send self-delete delay in seconds for global repeat (e.g. 30):")
-        bot.register_next_step_handler(call.message, process_global_self_delete)
-        answer()
-
-    elif data == "remove_global_self_delete":
-        r.delete('global_repeat_self_delete')
-        _invalidate_global_cache('global_repeat_self_delete')
-        answer("✅ Global self-delete removed.")
-        _reload("global_repeat_menu")
-
-    # ── LEAVE GROUP ───────────────────────────────────────────────────────────
-    elif data.startswith("leave_group_confirm:"):
-        lv_chat_id = int(data.split(":", 1)[1])
-        lv_title, _ = get_group_info(lv_chat_id)
-        markup = types.InlineKeyboardMarkup(row_width=2)
-        markup.row(
-            types.InlineKeyboardButton("✅ Confirm Leave", callback_data=f"leave_group_do:{lv_chat_id}"),
-            types.InlineKeyboardButton("❌ Cancel", callback_data=f"group_menu:{lv_chat_id}"),
+# ── ADD TO GROUP: GENERATE INVITE LINK ───────────────────────────────────────
+@callback_route("add_to_group:{int}:invite")
+def _cb_add_to_group_invite(c, chat_id):
+    title, _ = get_group_info(chat_id)
+    try:
+        link = bot.create_chat_invite_link(chat_id)
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data=f"add_to_group:{chat_id}:choose"))
+        c.edit(
+            f"🔗 *Invite link for:* {title}\n\n"
+            f"`{link.invite_link}`\n\n"
+            f"Share this link with anyone you want to add to the group.",
+            markup, parse_mode='Markdown'
         )
-        edit(f"⚠️ Are you sure you want the bot to leave *{lv_title}*?\n\nThis will stop all repeat tasks and remove the group from all records.", markup, parse_mode='Markdown')
-        answer()
-
-    elif data.startswith("leave_group_do:"):
-        lv_chat_id = int(data.split(":", 1)[1])
-        r.set(f'repeat_task:{lv_chat_id}', 'False')
-        _invalidate_group_config_cache(lv_chat_id)
-        with _repeat_thread_lock:
-            active_repeat_threads.pop(lv_chat_id, None)
-        remove_group(lv_chat_id)
-        try:
-            bot.leave_chat(lv_chat_id)
-        except Exception as e:
-            logger.error(f"Failed to leave group {lv_chat_id}: {e}")
-        edit(f"✅ Bot has left the group and it has been removed from all records.", _back_markup("my_groups"))
-        answer("✅ Left group.")
+    except Exception as e:
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data=f"add_to_group:{chat_id}:choose"))
+        c.edit(f"❌ Could not generate invite link:\n{str(e)}", markup)
+    c.answer()
+
+# ── GLOBAL REPEAT MENU ───────────────────────────────────────────────────────
+@callback_route("global_repeat_menu")
+def _cb_global_repeat_menu(c):
+    repeat_on = r.get('global_repeat_task') == 'True'
+    interval = r.get('global_repeat_interval') or "3600"
+    autodelete = r.get('global_repeat_autodelete') == 'True'
+    self_del = r.get('global_repeat_self_delete')
+    current_text = r.get('global_repeat_text') or "Not set"
+
+    text = (
+        f"🔁 *Global Broadcast Repeat*\n\n"
+        f"Status: {'✅ ON' if repeat_on else '❌ OFF'}\n"
+        f"Interval: {interval}s\n"
+        f"Auto-delete previous: {'✅' if autodelete else '❌'}\n"
+        f"Self-delete after: {self_del + 's' if self_del else '❌ OFF'}\n"
+        f"Message: _{current_text[:80]}_"
+    )
 
-    # ── GROUP INFO ────────────────────────────────────────────────────────────
-    elif data.startswith("group_info:"):
-        gi_chat_id = int(data.split(":", 1)[1])
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup.add(types.InlineKeyboardButton("⏸ Pause All Group Repeats", callback_data="pause_all_group_repeats"))
+    markup.row(
+        types.InlineKeyboardButton("✅ ON", callback_data="global_repeat_on"),
+        types.InlineKeyboardButton("❌ OFF", callback_data="global_repeat_off")
+    )
+    markup.add(types.InlineKeyboardButton("✏️ Set / Edit Message", callback_data="set_global_repeat_text"))
+    markup.row(
+        types.InlineKeyboardButton("⏱ Interval (sec)", callback_data="set_global_interval_sec"),
+        types.InlineKeyboardButton("⏱ Interval (min)", callback_data="set_global_interval_min")
+    )
+    markup.add(types.InlineKeyboardButton(
+        f"🗑 Auto-del prev: {'✅ ON' if autodelete else '❌ OFF'}",
+        callback_data="toggle_global_autodelete"
+    ))
+    markup.add(types.InlineKeyboardButton(
+        f"💣 Self-delete: {'✅ ' + self_del + 's' if self_del else '❌ OFF'}",
+        callback_data="set_global_self_delete"
+    ))
+    if self_del:
+        markup.add(types.InlineKeyboardButton("❌ Remove Self-Delete", callback_data="remove_global_self_delete"))
+    markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="back"))
+
+    c.edit(text, markup, parse_mode='Markdown')
+    c.answer()
+
+@callback_route("pause_all_group_repeats")
+def _cb_pause_all_group_repeats(c):
+    for g in get_groups():
+        r.set(f'repeat_task:{g}', 'False')
+    c.answer("⏸ All individual group repeats paused.", alert=True)
+    c.reload("global_repeat_menu")
+
+@callback_route("global_repeat_on")
+def _cb_global_repeat_on(c):
+    if not r.get('global_repeat_text'):
+        c.answer("⚠️ Set a repeat message first!", alert=True)
+        return
+    r.set('global_repeat_task', 'True')
+    _invalidate_global_cache('global_repeat_task')
+    reset_global_repeat_schedule()  # Clear schedules so all groups fire immediately
+    start_global_repeat_thread()
+    c.answer("✅ Global repeat ON")
+    c.reload("global_repeat_menu")
+
+@callback_route("global_repeat_off")
+def _cb_global_repeat_off(c):
+    stop_global_repeat()
+    _invalidate_global_cache('global_repeat_task')
+    c.answer("✅ Global repeat OFF")
+    c.reload("global_repeat_menu")
+
+@callback_route("set_global_repeat_text")
+def _cb_set_global_repeat_text(c):
+    c.edit("✏️ Send the message for global repeat broadcast:")
+    bot.register_next_step_handler(c.call.message, process_global_repeat_text)
+    c.answer()
+
+@callback_route("set_global_interval_sec", "set_global_interval_min")
+def _cb_set_global_interval_sec(c):
+    unit = "sec" if "sec" in c.data else "min"
+    c.edit(f"⏱ Send global repeat interval in {unit} (number only):")
+    bot.register_next_step_handler(c.call.message, lambda m: process_global_interval(m, unit))
+    c.answer()
+
+@callback_route("toggle_global_autodelete")
+def _cb_toggle_global_autodelete(c):
+    current = r.get('global_repeat_autodelete') == 'True'
+    r.set('global_repeat_autodelete', 'False' if current else 'True')
+    _invalidate_global_cache('global_repeat_autodelete')
+    c.answer(f"🗑 Global auto-delete prev now {'❌ OFF' if current else '✅ ON'}")
+    c.reload("global_repeat_menu")
+
+@callback_route("set_global_self_delete")
+def _cb_set_global_self_delete(c):
+    c.edit("💣 Send self-delete delay in seconds for global repeat (e.g. 30):")
+    bot.register_next_step_handler(c.call.message, process_global_self_delete)
+    c.answer()
+
+@callback_route("remove_global_self_delete")
+def _cb_remove_global_self_delete(c):
+    r.delete('global_repeat_self_delete')
+    _invalidate_global_cache('global_repeat_self_delete')
+    c.answer("✅ Global self-delete removed.")
+    c.reload("global_repeat_menu")
+
+# ── LEAVE GROUP ──────────────────────────────────────────────────────────────
+@callback_route("leave_group_confirm:{int}")
+def _cb_leave_group_confirm(c, lv_chat_id):
+    lv_title, _ = get_group_info(lv_chat_id)
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup.row(
+        types.InlineKeyboardButton("✅ Confirm Leave", callback_data=f"leave_group_do:{lv_chat_id}"),
+        types.InlineKeyboardButton("❌ Cancel", callback_data=f"group_menu:{lv_chat_id}"),
+    )
+    c.edit(f"⚠️ Are you sure you want the bot to leave *{lv_title}*?\n\nThis will stop all repeat tasks and remove the group from all records.", markup, parse_mode='Markdown')
+    c.answer()
+
+@callback_route("leave_group_do:{int}")
+def _cb_leave_group_do(c, lv_chat_id):
+    r.set(f'repeat_task:{lv_chat_id}', 'False')
+    _invalidate_group_config_cache(lv_chat_id)
+    with _repeat_thread_lock:
+        active_repeat_threads.pop(lv_chat_id, None)
+    remove_group(lv_chat_id)
+    try:
+        bot.leave_chat(lv_chat_id)
+    except Exception as e:
+        logger.error(f"Failed to leave group {lv_chat_id}: {e}")
+    c.edit(f"✅ Bot has left the group and it has been removed from all records.", _back_markup("my_groups"))
+    c.answer("✅ Left group.")
+
+# ── GROUP INFO ───────────────────────────────────────────────────────────────
+@callback_route("group_info:{int}")
+def _cb_group_info(c, gi_chat_id):
+    try:
+        gi_chat = bot.get_chat(gi_chat_id)
+        gi_title = gi_chat.title or f"Group {gi_chat_id}"
+        gi_link = gi_chat.invite_link or "N/A"
         try:
-            gi_chat = bot.get_chat(gi_chat_id)
-            gi_title = gi_chat.title or f"Group {gi_chat_id}"
-            gi_link = gi_chat.invite_link or "N/A"
-            try:
-                gi_count = bot.get_chat_member_count(gi_chat_id)
-            except Exception:
-                gi_count = "N/A"
-            try:
-                gi_me = bot.get_chat_member(gi_chat_id, bot.get_me().id)
-                gi_bot_role = "Admin" if gi_me.status in ['administrator', 'creator'] else "Member"
-            except Exception:
-                gi_bot_role = "Unknown"
-            # Fetch admins live (no caching)
-            try:
-                gi_admins = bot.get_chat_administrators(gi_chat_id)
-                gi_admin_lines = []
-                gi_owner = "Unknown"
-                for a in gi_admins:
-                    u = a.user
-                    name = u.full_name
-                    username = f" @{u.username}" if u.username else ""
-                    if a.status == 'creator':
-                        gi_owner = f"{name}{username}"
-                        gi_admin_lines.append(f"👑 {name}{username} (Owner)")
-                    else:
-                        gi_admin_lines.append(f"🛡 {name}{username}")
-                admins_str = "\n".join(gi_admin_lines) if gi_admin_lines else "None visible"
-            except Exception as e:
-                gi_owner = "N/A"
-                admins_str = f"Could not fetch ({e})"
-            info_text = (
-                f"ℹ️ <b>Group Info</b>\n\n"
-                f"📌 <b>Name:</b> {gi_title}\n"
-                f"🆔 <b>ID:</b> <code>{gi_chat_id}</code>\n"
-                f"🔗 <b>Link:</b> {gi_link}\n"
-                f"👑 <b>Owner:</b> {gi_owner}\n"
-                f"👥 <b>Members:</b> {gi_count}\n"
-                f"🤖 <b>Bot Role:</b> {gi_bot_role}\n\n"
-                f"<b>Admins:</b>\n{admins_str}"
-            )
-        except Exception as e:
-            info_text = f"❌ Could not fetch group info:\n{e}"
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data=f"group_menu:{gi_chat_id}"))
+            gi_count = bot.get_chat_member_count(gi_chat_id)
+        except Exception:
+            gi_count = "N/A"
         try:
-            bot.edit_message_text(info_text, cid, mid, reply_markup=markup, parse_mode='HTML')
+            gi_me = get_bot_member(gi_chat_id)
+            gi_bot_role = "Admin" if gi_me.status in ['administrator', 'creator'] else "Member"
         except Exception:
-            bot.send_message(cid, info_text, reply_markup=markup, parse_mode='HTML')
-        answer()
-
-    # ── SUSPICIOUS GROUP: LEAVE / STAY ───────────────────────────────────────
-    elif data.startswith("sus_leave:"):
-        sus_chat_id = int(data.split(":", 1)[1])
-        r.set(f'repeat_task:{sus_chat_id}', 'False')
-        _invalidate_group_config_cache(sus_chat_id)
-        with _repeat_thread_lock:
-            active_repeat_threads.pop(sus_chat_id, None)
-        remove_group(sus_chat_id)
+            gi_bot_role = "Unknown"
+        # Fetch admins live (no caching)
         try:
-            bot.leave_chat(sus_chat_id)
-        except Exception as e:
-            logger.error(f"Failed to leave suspicious group {sus_chat_id}: {e}")
-        edit(f"✅ Bot has left the suspicious group (`{sus_chat_id}`) and it has been removed from all records.", _back_markup("back"), parse_mode='Markdown')
-        answer("✅ Left suspicious group.")
-
-    elif data.startswith("sus_stay:"):
-        sus_chat_id = int(data.split(":", 1)[1])
-        edit(f"🟢 Staying in group `{sus_chat_id}`. It remains registered normally.", _back_markup("back"), parse_mode='Markdown')
-        answer("🟢 Staying in group.")
-
-    # ── UPDATES & GROUP HEALTH ────────────────────────────────────────────────
-    elif data in ["updates_menu", "updates_refresh"]:
-        groups = get_groups()
-        total = len(groups)
-        working = []
-        api_errors = []
-        perm_errors = []
-        recently_removed = list(r.smembers('recently_removed_groups'))
-
-        for g in groups:
-            err = r.get(f'group_error:{g}')
-            if err:
-                err_low = err.lower()
-                if 'forbidden' in err_low or 'kicked' in err_low or 'not a member' in err_low or '403' in err_low:
-                    perm_errors.append((g, err))
+            gi_admins = bot.get_chat_administrators(gi_chat_id)
+            gi_admin_lines = []
+            gi_owner = "Unknown"
+            for a in gi_admins:
+                u = a.user
+                name = u.full_name
+                username = f" @{u.username}" if u.username else ""
+                if a.status == 'creator':
+                    gi_owner = f"{name}{username}"
+                    gi_admin_lines.append(f"👑 {name}{username} (Owner)")
                 else:
-                    api_errors.append((g, err))
-            else:
-                working.append(g)
+                    gi_admin_lines.append(f"🛡 {name}{username}")
+            admins_str = "\n".join(gi_admin_lines) if gi_admin_lines else "None visible"
+        except Exception as e:
+            gi_owner = "N/A"
+            admins_str = f"Could not fetch ({e})"
+        info_text = (
+            f"ℹ️ <b>Group Info</b>\n\n"
+            f"📌 <b>Name:</b> {gi_title}\n"
+            f"🆔 <b>ID:</b> <code>{gi_chat_id}</code>\n"
+            f"🔗 <b>Link:</b> {gi_link}\n"
+            f"👑 <b>Owner:</b> {gi_owner}\n"
+            f"👥 <b>Members:</b> {gi_count}\n"
+            f"🤖 <b>Bot Role:</b> {gi_bot_role}\n\n"
+            f"<b>Admins:</b>\n{admins_str}"
+        )
+    except Exception as e:
+        info_text = f"❌ Could not fetch group info:\n{e}"
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data=f"group_menu:{gi_chat_id}"))
+    try:
+        edit_menu(info_text, c.cid, c.mid, reply_markup=markup, parse_mode='HTML')
+    except Exception:
+        bot.send_message(c.cid, info_text, reply_markup=markup, parse_mode='HTML')
+    c.answer()
+
+# ── SUSPICIOUS GROUP: LEAVE / STAY ───────────────────────────────────────────
+@callback_route("sus_leave:{int}")
+def _cb_sus_leave(c, sus_chat_id):
+    r.set(f'repeat_task:{sus_chat_id}', 'False')
+    _invalidate_group_config_cache(sus_chat_id)
+    with _repeat_thread_lock:
+        active_repeat_threads.pop(sus_chat_id, None)
+    remove_group(sus_chat_id)
+    try:
+        bot.leave_chat(sus_chat_id)
+    except Exception as e:
+        logger.error(f"Failed to leave suspicious group {sus_chat_id}: {e}")
+    c.edit(f"✅ Bot has left the suspicious group (`{sus_chat_id}`) and it has been removed from all records.", _back_markup("back"), parse_mode='Markdown')
+    c.answer("✅ Left suspicious group.")
 
-        error_set = r.smembers('groups_with_errors')
-        for g_str in error_set:
-            try:
-                g = int(g_str)
-            except Exception:
-                continue
-            if g not in [x[0] for x in api_errors] and g not in [x[0] for x in perm_errors]:
-                err = r.get(f'group_error:{g}') or 'Unknown error'
-                api_errors.append((g, err))
-                if g in working:
-                    working.remove(g)
-
-        # Monitoring stats
-        with _repeat_thread_lock:
-            active_repeats = sum(1 for t in active_repeat_threads.values() if t.is_alive())
-        with _flood_wait_lock:
-            flood_count = _flood_wait_counter
-        try:
-            proc = psutil.Process()
-            mem_mb = proc.memory_info().rss / 1024 / 1024
-            mem_str = f"{mem_mb:.1f} MB"
-        except Exception:
-            mem_str = "N/A"
-        try:
-            r.ping()
-            redis_ok = "✅ Connected"
-        except Exception:
-            redis_ok = "❌ ERROR"
+@callback_route("sus_stay:{int}")
+def _cb_sus_stay(c, sus_chat_id):
+    c.edit(f"🟢 Staying in group `{sus_chat_id}`. It remains registered normally.", _back_markup("back"), parse_mode='Markdown')
+    c.answer("🟢 Staying in group.")
 
-        lines = ["📡 <b>Group Health &amp; Monitor Report</b>\n"]
-        lines.append(f"📊 Total groups: {total}")
-        lines.append(f"✅ Working normally: {len(working)}")
-        lines.append(f"❌ API / send errors: {len(api_errors)}")
-        lines.append(f"🚫 Permission / access errors: {len(perm_errors)}")
-        lines.append(f"🗑 Recently removed: {len(recently_removed)}")
+# ── UPDATES & GROUP HEALTH ───────────────────────────────────────────────────
+_HEALTH_TOP = 5                    # offenders shown on the report itself
+_HEALTH_PAGE_SIZE = 8              # groups per drill-down page
 
-        with _send_queue_lock:
-            q_depth = len(_send_queue)
-        lines.append(f"📬 Send queue depth: {q_depth} pending")
+def _ago(ts):
+    ago = max(0, int(time.time() - ts))
+    return f"{ago // 86400}d" if ago >= 86400 else f"{ago // 3600}h" if ago >= 3600 else f"{ago // 60}m"
 
-        lines.append(f"\n🖥 <b>Monitor Stats</b>")
-        lines.append(f"🔁 Active repeat tasks: {active_repeats}")
-        lines.append(f"⚡ FloodWait hits (session): {flood_count}")
-        lines.append(f"💾 Memory usage: {mem_str}")
-        lines.append(f"🗄 Redis: {redis_ok}")
+@callback_route("updates_menu", "updates_refresh")
+def _cb_updates_menu(c):
+    with _group_rate_lock:
+        now_ts = time.time()
+        cooling_groups = [(gid, int(until - now_ts)) for gid, until in _group_cooldown_until.items() if until > now_ts]
 
-        # ── Restore status banner ─────────────────────────────────────────────
+    # Round trip 1: every count, the top offenders and a few removed groups
+    try:
+        pipe = r.pipeline()
+        pipe.scard('groups')
+        pipe.hlen('group_health')
+        for cls, _ in _HEALTH_CLASSES:
+            pipe.scard(f'group_health:{cls}')
+        pipe.zrevrange('group_health_offenders', 0, _HEALTH_TOP - 1, withscores=True)
+        pipe.scard('recently_removed_groups')
+        pipe.srandmember('recently_removed_groups', 5)
+        pipe.mget('last_restore_time', 'last_restore_backup_ts')
+        res = pipe.execute()
+        redis_ok = "✅ Connected"
+    except Exception as e:
+        logger.error(f"[HEALTH] Report query failed: {e}")
+        res = [0, 0] + [0] * len(_HEALTH_CLASSES) + [[], 0, [], [None, None]]
+        redis_ok = "❌ ERROR"
+    total, failing = res[0], res[1]
+    class_counts = dict(zip([cls for cls, _ in _HEALTH_CLASSES], res[2:2 + len(_HEALTH_CLASSES)]))
+    offenders, removed_count, removed_sample, (last_restore, last_restore_bk) = res[2 + len(_HEALTH_CLASSES):]
+    offender_ids = [int(g) for g, _ in offenders]
+
+    # Round trip 2: status and titles for just the groups named below
+    titled = offender_ids + [int(g) for g in removed_sample] + [g for g, _ in cooling_groups[:5]]
+    statuses, titles = [], {}
+    if titled and redis_ok.startswith("✅"):
         try:
-            last_restore = r.get('last_restore_time')
-            last_restore_bk = r.get('last_restore_backup_ts')
-            if last_restore:
-                lines.append(
-                    f"\n🔁 <b>Last Restore:</b> {last_restore}\n"
-                    f"   📦 Backup used: {last_restore_bk or 'unknown'}\n"
-                    f"   ✅ Bot is running on restored backup data"
-                )
-        except Exception:
-            pass
+            pipe = r.pipeline()
+            pipe.mget([f'cache_group_title:{g}' for g in titled])
+            if offender_ids:
+                pipe.hmget('group_health', offender_ids)
+            res2 = pipe.execute()
+            title_values, statuses = res2[0], res2[1] if offender_ids else []
+            titles = {g: t or f"Group {g}" for g, t in zip(titled, title_values)}
+        except Exception as e:
+            logger.error(f"[HEALTH] Report query failed: {e}")
 
-        # Show per-group cooldowns
-        with _group_rate_lock:
-            now_ts = time.time()
-            cooling_groups = [(cid, int(until - now_ts)) for cid, until in _group_cooldown_until.items() if until > now_ts]
-        if cooling_groups:
-            lines.append(f"\n🌡 Groups in 429 cooldown: {len(cooling_groups)}")
-            for cid, secs in cooling_groups[:5]:
-                title = r.get(f'cache_group_title:{cid}') or f"Group {cid}"
-                lines.append(f"  • {title}: {secs}s remaining")
-        else:
-            lines.append("✅ No groups in rate-limit cooldown")
-
-        # --- Advanced per-group error display with expandable blockquote ---
-        all_error_groups = list(dict.fromkeys([g for g, _ in api_errors] + [g for g, _ in perm_errors]))
-        if all_error_groups:
-            lines.append("\n⚠️ <b>Per-Group Errors:</b>")
-            for g in all_error_groups[:10]:
-                g_title = r.get(f'cache_group_title:{g}') or f"Group {g}"
-                # Collect errors: redis error + runtime errors
-                error_lines = []
-                redis_err = r.get(f'group_error:{g}')
-                if redis_err:
-                    error_lines.append(redis_err[:100])
-                with _runtime_errors_lock:
-                    rt_errs = _runtime_errors.get(g, [])
-                for e_line in rt_errs[-5:]:
-                    if e_line[:100] not in error_lines:
-                        error_lines.append(e_line[:100])
-                errors_text = "\n".join(error_lines) if error_lines else "Unknown error"
-                lines.append(f"\n<b>Group: {g_title}</b>")
-                lines.append(f"<blockquote expandable>{errors_text}</blockquote>")
-            if len(all_error_groups) > 10:
-                lines.append(f"...and {len(all_error_groups) - 10} more groups with errors")
-
-        if recently_removed:
-            lines.append("\n🗑 Recently removed groups:")
-            for g_str in list(recently_removed)[:5]:
-                title = r.get(f'cache_group_title:{g_str}') or f"Group {g_str}"
-                lines.append(f"  • {title}")
-            if len(recently_removed) > 5:
-                lines.append(f"  ...and {len(recently_removed) - 5} more")
+    # Monitoring stats
+    with _repeat_thread_lock:
+        active_repeats = sum(1 for t in active_repeat_threads.values() if t.is_alive())
+    with _flood_wait_lock:
+        flood_count = _flood_wait_counter
+    try:
+        proc = psutil.Process()
+        mem_mb = proc.memory_info().rss / 1024 / 1024
+        mem_str = f"{mem_mb:.1f} MB"
+    except Exception:
+        mem_str = "N/A"
 
-        markup = types.InlineKeyboardMarkup(row_width=1)
-        markup.add(
-            types.InlineKeyboardButton("🔄 Refresh", callback_data="updates_refresh"),
-            types.InlineKeyboardButton("🧹 Clear Error Log", callback_data="updates_clear_errors"),
-            types.InlineKeyboardButton("🔙 Go Back", callback_data="back"),
-        )
-        report_text = "\n".join(lines)
-        # Always edit in place — never send a new message (prevents duplication on refresh)
-        try:
-            bot.edit_message_text(report_text, cid, mid, reply_markup=markup, parse_mode='HTML')
-        except telebot.apihelper.ApiTelegramException as e:
-            if 'message is not modified' in str(e).lower():
-                pass  # content unchanged — not an error
-            else:
-                # If message is too long, truncate and edit
-                try:
-                    bot.edit_message_text(report_text[:4000] + "\n...truncated", cid, mid, reply_markup=markup, parse_mode='HTML')
-                except Exception:
-                    pass
-        except Exception:
-            pass
-        answer("🔄 Refreshed" if data == "updates_refresh" else "")
-
-    elif data == "updates_clear_errors":
-        error_groups = list(r.smembers('groups_with_errors'))
-        for g_str in error_groups:
-            r.delete(f'group_error:{g_str}')
-        r.delete('groups_with_errors')
-        r.delete('recently_removed_groups')
-        answer("✅ Error log cleared.", alert=True)
-        try:
-            bot.edit_message_text(
-                "📡 Group Health Report\n\nError log cleared. Press Refresh to re-scan.",
-                cid, mid,
-                reply_markup=types.InlineKeyboardMarkup().add(
-                    types.InlineKeyboardButton("🔄 Refresh", callback_data="updates_refresh"),
-                    types.InlineKeyboardButton("🔙 Go Back", callback_data="back")
-                )
-            )
-        except Exception:
-            pass
+    lines = ["📡 <b>Group Health &amp; Monitor Report</b>\n"]
+    lines.append(f"📊 Total groups: {total}")
+    lines.append(f"✅ Working normally: {max(total - failing, 0)}")
+    lines.append(f"⚠️ Failing: {failing}")
+    for cls, label in _HEALTH_CLASSES:
+        if class_counts.get(cls):
+            lines.append(f"   {label}: {class_counts[cls]}")
+    lines.append(f"🗑 Recently removed: {removed_count}")
 
-    # ── ADDED TO GROUP MESSAGE ────────────────────────────────────────────────
-    elif data == "added_to_group_menu":
-        enabled = r.get('added_to_group_msg_enabled') == 'True'
-        current_msg = r.get('added_to_group_msg') or "Not set"
-        markup = types.InlineKeyboardMarkup(row_width=1)
-        markup.row(
-            types.InlineKeyboardButton("✅ ON", callback_data="added_to_group_on"),
-            types.InlineKeyboardButton("❌ OFF", callback_data="added_to_group_off"),
-        )
-        markup.add(
-            types.InlineKeyboardButton("✏️ Set / Edit Message", callback_data="set_added_to_group_msg"),
-            types.InlineKeyboardButton("🔄 Reset to Default", callback_data="reset_added_to_group_msg"),
-            types.InlineKeyboardButton("🔙 Go Back", callback_data="back"),
-        )
-        preview = current_msg[:200] + ("..." if len(current_msg) > 200 else "")
-        edit(
-            f"📩 *'Added to Group' Reply Message*\n\n"
-            f"Status: {'✅ ON' if enabled else '❌ OFF'}\n\n"
-            f"Current Message:\n`{preview}`\n\n"
-            f"ℹ️ This is what the bot sends in the group chat when it is added.\n"
-            f"Different from your private notification.",
-            markup, parse_mode='Markdown'
-        )
-        answer()
-
-    elif data == "added_to_group_on":
-        r.set('added_to_group_msg_enabled', 'True')
-        answer("✅ 'Added to Group' message is now ON.", alert=True)
-        _reload("added_to_group_menu")
-
-    elif data == "added_to_group_off":
-        r.set('added_to_group_msg_enabled', 'False')
-        answer("✅ 'Added to Group' message is now OFF.", alert=True)
-        _reload("added_to_group_menu")
-
-    elif data == "set_added_to_group_msg":
-        edit(
-            "✏️ Send the new message for when the bot is added to a group.\n\n"
-            "You can use plain text or links.\n"
-            "For embedded links use Markdown like: [Click here](https://example.com)"
-        )
-        bot.register_next_step_handler(call.message, process_added_to_group_msg)
-        answer()
-
-    elif data == "reset_added_to_group_msg":
-        default = ('https://t.me/AllMusicShazamandlyrics_bot?startgroup=true&admin='
-                   'change_info+delete_messages+restrict_members+invite_users+'
-                   'pin_messages+manage_video_chats+anonymous+manage_chat+'
-                   'post_stories+edit_stories+delete_stories')
-        r.set('added_to_group_msg', default)
-        answer("✅ Reset to default invite link.", alert=True)
-        _reload("added_to_group_menu")
-
-    # ── GLOBAL BROADCAST EMBEDDED LINKS ──────────────────────────────────────
-    elif data == "broadcast_embedded_links":
-        edit(
-            "🔗 *Global Broadcast Embedded Links*\n\n"
-            "Send the message text you want to broadcast.\n"
-            "After that you'll be able to embed links into specific words.",
-            _back_markup("back"), parse_mode='Markdown'
-        )
-        bot.register_next_step_handler(call.message, process_embedded_links_text)
-        answer()
-
-    elif data.startswith("embedded_confirm_broadcast:"):
-        key = data.split(":", 1)[1]
-        html_text = r.get(f'embedded_draft:{key}')
-        if not html_text:
-            answer("❌ Session expired. Please start over.", alert=True)
-            return
-        r.delete(f'embedded_draft:{key}')
-        groups = get_groups()
-        if not groups:
-            edit("❌ No groups to broadcast to.", _back_markup("back"))
-            answer()
-            return
-        bot.send_message(
-            cid,
-            f"📢 Broadcasting embedded links message to {len(groups)} groups...\n"
-            f"⏱ Estimated time: ~{int(len(groups) * _INTER_MSG_DELAY)}s\n"
-            f"📡 You'll get a report when done.",
-            reply_markup=_back_markup("back")
+    with _send_queue_lock:
+        q_depth = len(_send_queue)
+    lines.append(f"📬 Send queue depth: {q_depth} pending")
+
+    lines.append(f"\n🖥 <b>Monitor Stats</b>")
+    lines.append(f"🔁 Active repeat tasks: {active_repeats}")
+    lines.append(f"⚡ FloodWait hits (session): {flood_count}")
+    lines.append(f"💾 Memory usage: {mem_str}")
+    lines.append(f"🗄 Redis: {redis_ok}")
+    if _diag_last_results:
+        lines.append("\n🩺 <b>Diagnostics</b>")
+        for check, ok, detail in _diag_last_results:
+            lines.append(f"{'✅' if ok else '🚨'} {detail}")
+
+    # ── Restore status banner ─────────────────────────────────────────────
+    if last_restore:
+        lines.append(
+            f"\n🔁 <b>Last Restore:</b> {last_restore}\n"
+            f"   📦 Backup used: {last_restore_bk or 'unknown'}\n"
+            f"   ✅ Bot is running on restored backup data"
         )
-        def _do_embedded_broadcast(text=html_text, grps=groups):
-            sent_count = 0
-            failed_count = 0
-            for group in grps:
-                try:
-                    sent = bot.send_message(group, text, parse_mode='HTML')
-                    if sent:
-                        r.set(f'last_sent:{group}', str(sent.message_id))
-                        save_last_sent(group, sent.message_id)
-                        sent_count += 1
-                    else:
-                        failed_count += 1
-                except Exception as e:
-                    _log_runtime_error(group, 'embedded_broadcast', str(e)[:200])
-                    failed_count += 1
-                time.sleep(_INTER_MSG_DELAY)
-            try:
-                bot.send_message(
-                    OWNER_ID,
-                    f"✅ Embedded broadcast complete!\n"
-                    f"👥 Sent to: {sent_count} groups\n"
-                    f"❌ Failed: {failed_count}",
-                    reply_markup=_back_markup("back")
-                )
-            except Exception:
-                pass
-        threading.Thread(target=_do_embedded_broadcast, daemon=True).start()
-        answer()
 
-    elif data.startswith("embedded_cancel:"):
-        key = data.split(":", 1)[1]
-        r.delete(f'embedded_draft:{key}')
-        edit("❌ Broadcast cancelled.", _back_markup("back"))
-        answer("Cancelled.")
+    if cooling_groups:
+        lines.append(f"\n🌡 Groups in 429 cooldown: {len(cooling_groups)}")
+        for gid, secs in cooling_groups[:5]:
+            lines.append(f"  • {html.escape(titles.get(gid, f'Group {gid}'))}: {secs}s remaining")
+    else:
+        lines.append("✅ No groups in rate-limit cooldown")
+
+    signatures = runtime_error_signatures()
+    if signatures:
+        lines.append("\n🧬 <b>Error Signatures</b> (this session)")
+        for sig, total_n, group_n, last_ts in signatures:
+            lines.append(f"  • <code>{html.escape(sig[:90])}</code> ×{total_n} in {group_n} group(s), last {_ago(last_ts)} ago")
+
+    if offenders:
+        lines.append("\n🔥 <b>Top Offenders</b>")
+        for (g, fails), raw in zip(offenders, statuses or [None] * len(offenders)):
+            g = int(g)
+            st = _parse_group_health(raw)
+            detail = f"{_HEALTH_CLASS_LABELS.get(st['class'], st['class'])}: {st['error'][:80]}" if st else "cleared"
+            lines.append(f"  • <b>{html.escape(titles.get(g, f'Group {g}'))}</b> ×{int(fails)} — {html.escape(detail)}")
+
+    if removed_sample:
+        lines.append("\n🗑 Recently removed groups:")
+        for g_str in removed_sample:
+            lines.append(f"  • {html.escape(titles.get(int(g_str), f'Group {g_str}'))}")
+        if removed_count > len(removed_sample):
+            lines.append(f"  ...and {removed_count - len(removed_sample)} more")
 
-    # ── BROADCAST TO BOT USERS ────────────────────────────────────────────────
-    elif data == "broadcast_users":
-        markup = types.InlineKeyboardMarkup(row_width=1)
-        markup.add(
-            types.InlineKeyboardButton("📣 Send Broadcast", callback_data="do_broadcast_users"),
-            types.InlineKeyboardButton("📌 Send & Pin", callback_data="do_broadcast_users_pin"),
-            types.InlineKeyboardButton("🔘 Send Message With Button", callback_data="do_broadcast_users_with_button"),
-            types.InlineKeyboardButton("🔙 Go Back", callback_data="back"),
-        )
-        edit("📣 *Broadcast to Bot Users*\n\nSend a message to everyone who has ever started the bot.", markup, parse_mode='Markdown')
-        answer()
-
-    elif data in ["do_broadcast_users", "do_broadcast_users_pin"]:
-        pin = data == "do_broadcast_users_pin"
-        edit(f"✏️ Send the message to broadcast to all bot users{' (will also be pinned)' if pin else ''}:")
-        bot.register_next_step_handler(call.message, lambda m: process_broadcast_users(m, pin))
-        answer()
-
-    elif data == "do_broadcast_users_with_button":
-        edit("✏️ Send the broadcast message text:")
-        bot.register_next_step_handler(call.message, process_broadcast_users_btn_text)
-        answer()
-
-
-    elif data.startswith("add_inline_btn:"):
-        btn_key = data.split(":", 1)[1]
-        edit("✏️ Send the Button Text (label):")
-        bot.register_next_step_handler(call.message, lambda m: process_broadcast_users_btn_label(m, btn_key))
-        answer()
-
-    elif data.startswith("no_inline_btn:"):
-        btn_key = data.split(":", 1)[1]
-        btext = r.get(f'btn_broadcast_text:{btn_key}')
-        r.delete(f'btn_broadcast_text:{btn_key}')
-        if not btext:
-            answer("❌ Session expired.", alert=True)
-            return
-        users = get_all_users()
-        bot.send_message(cid, f"📣 Broadcasting to {len(users)} users (no button)...", reply_markup=_back_markup("back"))
-        def _do_no_btn(text=btext, ulist=users):
-            sent_count = 0
-            failed_count = 0
-            for uid in ulist:
-                sent = safe_send(uid, text)
-                if sent:
-                    save_private_sent(uid, sent.message_id)
-                    sent_count += 1
-                else:
-                    failed_count += 1
-            try:
-                bot.send_message(OWNER_ID, f"✅ Broadcast done!\n✅ Sent: {sent_count}\n❌ Failed: {failed_count}", reply_markup=_back_markup("back"))
-            except Exception:
-                pass
-        threading.Thread(target=_do_no_btn, daemon=True).start()
-        answer()
-
-    elif data.startswith("confirm_broadcast_btn:"):
-        btn_key = data.split(":", 1)[1]
-        btext = r.get(f'btn_broadcast_text:{btn_key}')
-        bbtn_text = r.get(f'btn_broadcast_btn_text:{btn_key}')
-        bbtn_url = r.get(f'btn_broadcast_btn_url:{btn_key}')
-        if not btext or not bbtn_text or not bbtn_url:
-            answer("❌ Session expired. Please start over.", alert=True)
-            return
-        r.delete(f'btn_broadcast_text:{btn_key}')
-        r.delete(f'btn_broadcast_btn_text:{btn_key}')
-        r.delete(f'btn_broadcast_btn_url:{btn_key}')
-        users = get_all_users()
-        bot.send_message(cid, f"📣 Broadcasting to {len(users)} users...", reply_markup=_back_markup("back"))
-        def _do_btn_broadcast(text=btext, btn_t=bbtn_text, btn_u=bbtn_url, ulist=users):
-            sent_count = 0
-            failed_count = 0
-            for uid in ulist:
-                try:
-                    btn_markup = types.InlineKeyboardMarkup()
-                    btn_markup.add(types.InlineKeyboardButton(btn_t, url=btn_u))
-                    sent = safe_send(uid, text, reply_markup=btn_markup, priority=3)
-                    if sent:
-                        save_private_sent(uid, sent.message_id)
-                        sent_count += 1
-                    else:
-                        failed_count += 1
-                except Exception:
-                    failed_count += 1
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup.add(types.InlineKeyboardButton("🔄 Refresh", callback_data="updates_refresh"))
+    if failing:
+        markup.add(types.InlineKeyboardButton(f"⚠️ All Failing Groups ({failing})", callback_data="health_errors:all:0"))
+        markup.add(*[
+            types.InlineKeyboardButton(f"{label.split(' ', 1)[0]} {class_counts[cls]}", callback_data=f"health_errors:{cls}:0")
+            for cls, label in _HEALTH_CLASSES if class_counts.get(cls)
+        ])
+    markup.add(types.InlineKeyboardButton("📈 Trends & Rate Budget", callback_data="metrics_trends"))
+    markup.add(types.InlineKeyboardButton("🧹 Clear Error Log", callback_data="updates_clear_errors"))
+    markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="back"))
+    report_text = "\n".join(lines)
+    # Always edit in place — never send a new message (prevents duplication on refresh)
+    try:
+        edit_menu(report_text, c.cid, c.mid, reply_markup=markup, parse_mode='HTML')
+    except telebot.apihelper.ApiTelegramException as e:
+        if 'message is not modified' in str(e).lower():
+            pass  # content unchanged — not an error
+        else:
+            # If message is too long, drop whole lines so no HTML tag is cut
+            kept, size = [], 0
+            for line in lines:
+                size += len(line) + 1
+                if size > 3980:
+                    break
+                kept.append(line)
             try:
-                bot.send_message(OWNER_ID, f"✅ Button broadcast done!\n✅ Sent: {sent_count}\n❌ Failed: {failed_count}", reply_markup=_back_markup("back"))
+                edit_menu("\n".join(kept) + "\n...truncated", c.cid, c.mid, reply_markup=markup, parse_mode='HTML')
             except Exception:
                 pass
-        threading.Thread(target=_do_btn_broadcast, daemon=True).start()
-        answer()
-
-    elif data.startswith("cancel_broadcast_btn:"):
-        btn_key = data.split(":", 1)[1]
-        r.delete(f'btn_broadcast_text:{btn_key}')
-        r.delete(f'btn_broadcast_btn_text:{btn_key}')
-        r.delete(f'btn_broadcast_btn_url:{btn_key}')
-        edit("❌ Broadcast with button cancelled.", _back_markup("back"))
-        answer("Cancelled.")
-
-
-    # ── AAWM MENU ─────────────────────────────────────────────────────────────
-    elif data == "aawm_menu":
-        enabled = r.get('aawm_enabled') == 'True'
-        current_text = r.get('aawm_text') or "Welcome to the group! Please read the rules."
-        btns_raw = r.get('aawm_buttons_global')
-        btns_count = len(json.loads(btns_raw)) if btns_raw else 0
-        markup = types.InlineKeyboardMarkup(row_width=1)
-        markup.row(
-            types.InlineKeyboardButton("✅ ON (Global)", callback_data="aawm_on"),
-            types.InlineKeyboardButton("❌ OFF", callback_data="aawm_off"),
-        )
-        markup.add(
-            types.InlineKeyboardButton("✏️ Set Welcome Text", callback_data="aawm_set_text"),
-            types.InlineKeyboardButton(f"🔘 Manage Buttons ({btns_count}/5)", callback_data="aawm_manage_buttons"),
-            types.InlineKeyboardButton("🔙 Go Back", callback_data="back"),
-        )
-        edit(
-            f"🤖 <b>Auto Approve Welcome Message (AAWM)</b>\n\n"
-            f"Status: {'✅ ON' if enabled else '❌ OFF'}\n\n"
-            f"Welcome Text:\n{current_text[:200]}\n\n"
-            f"Inline Buttons: {btns_count} configured\n\n"
-            f"When ON, the bot auto-approves join requests and sends a private welcome message.",
-            markup, parse_mode='HTML'
+    except Exception:
+        pass
+    c.answer("🔄 Refreshed" if c.data == "updates_refresh" else "")
+
+@callback_route("health_errors:{key}:{int}")
+def _cb_health_errors(c, cls, page):
+    """Failing groups, worst first ('all') or one error class, a page at a time."""
+    page = max(page, 0)
+    start = page * _HEALTH_PAGE_SIZE
+    if cls == 'all':
+        pipe = r.pipeline()
+        pipe.zrevrange('group_health_offenders', start, start + _HEALTH_PAGE_SIZE - 1, withscores=True)
+        pipe.zcard('group_health_offenders')
+        rows, total = pipe.execute()
+        ids = [int(g) for g, _ in rows]
+        fails = {int(g): int(n) for g, n in rows}
+        heading = "⚠️ <b>All Failing Groups</b>"
+    else:
+        members = sorted(int(g) for g in r.smembers(f'group_health:{cls}'))
+        total = len(members)
+        ids = members[start:start + _HEALTH_PAGE_SIZE]
+        fails = None
+        heading = _HEALTH_CLASS_LABELS.get(cls, cls)
+    pages = max(1, -(-total // _HEALTH_PAGE_SIZE))
+
+    statuses, title_values, scores = [], [], []
+    if ids:
+        pipe = r.pipeline()
+        pipe.hmget('group_health', ids)
+        pipe.mget([f'cache_group_title:{g}' for g in ids])
+        if fails is None:
+            for g in ids:
+                pipe.zscore('group_health_offenders', g)
+        res = pipe.execute()
+        statuses, title_values, scores = res[0], res[1], res[2:]
+        if fails is None:
+            fails = {g: int(n or 0) for g, n in zip(ids, scores)}
+
+    lines = [f"{heading} — page {page + 1}/{pages} ({total})"]
+    if not ids:
+        lines.append("\n✅ Nothing failing here.")
+    for g, raw, title in zip(ids, statuses, title_values):
+        st = _parse_group_health(raw)
+        lines.append(f"\n<b>{html.escape(title or f'Group {g}')}</b> <code>{g}</code>")
+        if not st:
+            lines.append("Recovered since this page was built.")
+            continue
+        lines.append(f"{_HEALTH_CLASS_LABELS.get(st['class'], st['class'])} · ×{fails.get(g, 0)} "
+                     f"· failing for {_ago(st['first'])}, last {_ago(st['last'])} ago")
+        error_lines = [st['error'][:100]]
+        for sig, msg, count, first_ts, _ in get_runtime_errors(g)[-3:]:
+            line = msg[:100] if count == 1 else f"{msg[:100]} ×{count}"
+            if msg[:100] not in error_lines:
+                error_lines.append(line)
+        lines.append(f"<blockquote expandable>{html.escape(chr(10).join(error_lines))}</blockquote>")
+
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    nav = []
+    if page > 0:
+        nav.append(types.InlineKeyboardButton("◀️ Prev", callback_data=f"health_errors:{cls}:{page - 1}"))
+    if page < pages - 1:
+        nav.append(types.InlineKeyboardButton("Next ▶️", callback_data=f"health_errors:{cls}:{page + 1}"))
+    if nav:
+        markup.row(*nav)
+    markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="updates_menu"))
+    c.edit("\n".join(lines), markup, parse_mode='HTML')
+    c.answer()
+
+@callback_route("updates_clear_errors")
+def _cb_updates_clear_errors(c):
+    reset_group_health()
+    r.delete('recently_removed_groups')
+    clear_runtime_errors()
+    c.answer("✅ Error log cleared.", alert=True)
+    try:
+        edit_menu(
+            "📡 Group Health Report\n\nError log cleared. Press Refresh to re-scan.",
+            c.cid, c.mid,
+            reply_markup=types.InlineKeyboardMarkup().add(
+                types.InlineKeyboardButton("🔄 Refresh", callback_data="updates_refresh"),
+                types.InlineKeyboardButton("🔙 Go Back", callback_data="back")
+            )
         )
-        answer()
-
-    elif data == "aawm_on":
-        r.set('aawm_enabled', 'True')
-        answer("✅ AAWM is ON")
-        _reload("aawm_menu")
-
-    elif data == "aawm_off":
-        r.set('aawm_enabled', 'False')
-        answer("❌ AAWM is OFF")
-        _reload("aawm_menu")
-
-    elif data == "aawm_set_text":
-        edit("✏️ Send the welcome message text for AAWM:")
-        bot.register_next_step_handler(call.message, process_aawm_text)
-        answer()
-
-    elif data == "aawm_manage_buttons":
-        btns_raw = r.get('aawm_buttons_global')
-        btns = json.loads(btns_raw) if btns_raw else []
-        lines = [f"🔘 <b>AAWM Inline Buttons</b> ({len(btns)}/5)\n"]
-        for i, b in enumerate(btns):
-            lines.append(f"{i+1}. {b['text']} → {b['url']}")
-        markup = types.InlineKeyboardMarkup(row_width=1)
-        if len(btns) < 5:
-            markup.add(types.InlineKeyboardButton("➕ Add Button", callback_data="aawm_add_button"))
-        if btns:
-            markup.add(types.InlineKeyboardButton("🗑 Clear All Buttons", callback_data="aawm_clear_buttons"))
-        markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="aawm_menu"))
-        edit("\n".join(lines) if len(lines) > 1 else "🔘 No buttons set yet.", markup, parse_mode='HTML')
-        answer()
-
-    elif data == "aawm_add_button":
-        edit("✏️ Send the button label text:")
-        bot.register_next_step_handler(call.message, process_aawm_btn_text)
-        answer()
-
-    elif data == "aawm_clear_buttons":
-        r.delete('aawm_buttons_global')
-        answer("🗑 All AAWM buttons cleared.", alert=True)
-        _reload("aawm_manage_buttons")
-
-    # ── INLINE BUTTON COLLECTION FLOW (for broadcast / single send) ───────────
-    elif data.startswith("ibtn_add:"):
-        # ibtn_add:{context_key}  — user wants to add a button
-        ctx = data.split(":", 1)[1]
-        edit("✏️ Send the button label text:")
-        bot.register_next_step_handler(call.message, lambda m: _process_ibtn_text(m, ctx))
-        answer()
-
-    elif data.startswith("ibtn_another:"):
-        ctx = data.split(":", 1)[1]
-        btns = _get_pending_buttons(OWNER_ID)
-        if len(btns) >= 5:
-            answer("⚠️ Maximum 5 buttons reached.", alert=True)
-            _reload(f"ibtn_done:{ctx}")
-            return
-        edit("✏️ Send the next button label text:")
-        bot.register_next_step_handler(call.message, lambda m: _process_ibtn_text(m, ctx))
-        answer()
-
-    elif data.startswith("ibtn_done:"):
-        ctx = data.split(":", 1)[1]
-        # Context tells us where to go next
-        # ctx format: "broadcast_all" | "broadcast_users" | "group:{chat_id}"
-        btns = _get_pending_buttons(OWNER_ID)
-        if not btns:
-            answer("No buttons — sending without buttons.", alert=True)
-        # Route to the actual send handler
-        if ctx == "broadcast_all":
-            edit("📢 Send the message to broadcast to all groups:")
-            bot.register_next_step_handler(call.message, process_broadcast_all)
-        elif ctx == "broadcast_users":
-            edit("📣 Send the message to broadcast to all users:")
-            bot.register_next_step_handler(call.message, process_broadcast_users)
-        else:
-            try:
-                grp_id = int(ctx.replace("group:", ""))
-                edit("📨 Send your message now:")
-                bot.register_next_step_handler(call.message, lambda m: process_single_message(m, grp_id))
-            except Exception:
-                edit("📨 Send your message now:")
-        answer()
+    except Exception:
+        pass
 
-    elif data.startswith("ibtn_skip:"):
-        ctx = data.split(":", 1)[1]
-        _clear_pending_buttons(OWNER_ID)
-        if ctx == "broadcast_all":
-            edit("📢 Send the message to broadcast to all groups:")
-            bot.register_next_step_handler(call.message, process_broadcast_all)
-        elif ctx == "broadcast_users":
-            edit("📣 Send the message to broadcast to all users:")
-            bot.register_next_step_handler(call.message, process_broadcast_users)
-        else:
-            try:
-                grp_id = int(ctx.replace("group:", ""))
-                edit("📨 Send your message now:")
-                bot.register_next_step_handler(call.message, lambda m: process_single_message(m, grp_id))
-            except Exception:
-                edit("📨 Send your message now:")
-        answer()
+@callback_route("metrics_trends")
+def _cb_metrics_trends(c):
+    lines = ["📈 <b>Trends</b>\n", "<b>Last 24h (hourly)</b>"]
+    for metric, label in _METRIC_LABELS.items():
+        series = metrics_series(metric, 'h', 24)
+        lines.append(f"{label}: {sum(series)}\n<code>{_sparkline(series)}</code>")
+    minute_sends = metrics_series('send_ok', 'm', 60)
+    minute_429 = metrics_series('rate_limited', 'm', 60)
+    lines.append("\n<b>Last 60 min</b>")
+    lines.append(f"✅ Sends: {sum(minute_sends)}  <code>{_sparkline(minute_sends)}</code>")
+    lines.append(f"⚡ 429s: {sum(minute_429)}  <code>{_sparkline(minute_429)}</code>")
+    q_sum = metrics_series('queue_depth_sum', 'm', 60)
+    q_n = metrics_series('queue_samples', 'm', 60)
+    q_avg = [s_ // n if n else 0 for s_, n in zip(q_sum, q_n)]
+    lines.append(f"📬 Avg queue depth: <code>{_sparkline(q_avg)}</code> (peak {max(q_avg)})")
+
+    top_429 = metrics_top_groups('rate_limited', 'h', 24)
+    top_sends = metrics_top_groups('send_ok', 'h', 24)
+    titles = get_group_infos({g for g, _ in top_429 + top_sends})
+    lines.append("\n🔥 <b>Rate budget burners (24h, 429s)</b>")
+    lines += [f"  • {html.escape(titles[g][0])}: {n}" for g, n in top_429] or ["  None 🎉"]
+    lines.append("\n📤 <b>Busiest groups (24h, sends)</b>")
+    lines += [f"  • {html.escape(titles[g][0])}: {n}" for g, n in top_sends] or ["  No sends yet"]
 
-    # ── CREATE POST ───────────────────────────────────────────────────────────
-    elif data == "create_post_menu":
-        _clear_pending_buttons(OWNER_ID)
-        markup = types.InlineKeyboardMarkup(row_width=1)
-        markup.add(
-            types.InlineKeyboardButton("📝 Write Post", callback_data="create_post_write"),
-            types.InlineKeyboardButton("🔙 Go Back", callback_data="back"),
-        )
-        edit("📝 *Create Post*\n\nWrite your post then choose where to send it.", markup, parse_mode='Markdown')
-        answer()
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    markup.add(
+        types.InlineKeyboardButton("🔄 Refresh", callback_data="metrics_trends"),
+        types.InlineKeyboardButton("🔙 Go Back", callback_data="updates_menu"),
+    )
+    c.edit("\n".join(lines), markup, parse_mode='HTML')
+    c.answer()
+
+# ── ADDED TO GROUP MESSAGE ───────────────────────────────────────────────────
+@callback_route("added_to_group_menu")
+def _cb_added_to_group_menu(c):
+    enabled = r.get('added_to_group_msg_enabled') == 'True'
+    current_msg = r.get('added_to_group_msg') or "Not set"
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    markup.row(
+        types.InlineKeyboardButton("✅ ON", callback_data="added_to_group_on"),
+        types.InlineKeyboardButton("❌ OFF", callback_data="added_to_group_off"),
+    )
+    markup.add(
+        types.InlineKeyboardButton("✏️ Set / Edit Message", callback_data="set_added_to_group_msg"),
+        types.InlineKeyboardButton("🔄 Reset to Default", callback_data="reset_added_to_group_msg"),
+        types.InlineKeyboardButton("🔙 Go Back", callback_data="back"),
+    )
+    preview = current_msg[:200] + ("..." if len(current_msg) > 200 else "")
+    c.edit(
+        f"📩 *'Added to Group' Reply Message*\n\n"
+        f"Status: {'✅ ON' if enabled else '❌ OFF'}\n\n"
+        f"Current Message:\n`{preview}`\n\n"
+        f"ℹ️ This is what the bot sends in the group chat when it is added.\n"
+        f"Different from your private notification.",
+        markup, parse_mode='Markdown'
+    )
+    c.answer()
 
-    elif data == "create_post_write":
-        _clear_pending_buttons(OWNER_ID)
-        edit("📝 Send your post message now:")
-        bot.register_next_step_handler(call.message, process_create_post_text)
-        answer()
-
-    elif data.startswith("post_add_buttons:"):
-        post_key = data.split(":", 1)[1]
-        edit("✏️ Send the button label text:")
-        bot.register_next_step_handler(call.message, lambda m: process_post_btn_text(m, post_key))
-        answer()
-
-    elif data.startswith("post_skip_buttons:"):
-        post_key = data.split(":", 1)[1]
-        # Show destination selector with no buttons
-        _show_post_destination(cid, mid, post_key, answer)
-
-    elif data.startswith("post_another_btn:"):
-        post_key = data.split(":", 1)[1]
-        btns = _get_pending_buttons(OWNER_ID)
-        if len(btns) >= 5:
-            answer("⚠️ Maximum 5 buttons reached.", alert=True)
-            _show_post_destination(cid, mid, post_key, answer)
-            return
-        edit("✏️ Send the next button label text:")
-        bot.register_next_step_handler(call.message, lambda m: process_post_btn_text(m, post_key))
-        answer()
-
-    elif data.startswith("post_done_buttons:"):
-        post_key = data.split(":", 1)[1]
-        _show_post_destination(cid, mid, post_key, answer)
-
-    elif data.startswith("post_to_all:"):
-        post_key = data.split(":", 1)[1]
-        post_text = r.get(f'post_draft:{post_key}')
-        if not post_text:
-            answer("❌ Session expired. Please start over.", alert=True)
-            return
-        r.delete(f'post_draft:{post_key}')
-        groups = get_groups()
-        if not groups:
-            edit("❌ No groups to send to.", _back_markup("create_post_menu"))
-            answer()
-            return
-        reply_markup = _build_keyboard_from_pending(OWNER_ID)
-        _clear_pending_buttons(OWNER_ID)
-        bot.send_message(
-            cid,
-            f"📝 Sending post to {len(groups)} groups...\n"
-            f"⏱ Estimated time: ~{int(len(groups) * _INTER_MSG_DELAY)}s\n"
-            f"📡 You'll get a report when done.",
-            reply_markup=_back_markup("back"),
-            disable_web_page_preview=True
-        )
-        def _do_post_all(text=post_text, grps=groups, kb=reply_markup):
-            sent_count = 0
-            failed_count = 0
-            for group in grps:
-                sent = safe_send(group, text, reply_markup=kb)
-                if sent:
-                    r.set(f'last_sent:{group}', str(sent.message_id))
-                    save_last_sent(group, sent.message_id)
-                    sent_count += 1
-                else:
-                    failed_count += 1
-            try:
-                bot.send_message(
-                    OWNER_ID,
-                    f"✅ Post sent!\n👥 Sent to: {sent_count} groups\n❌ Failed: {failed_count}",
-                    reply_markup=_back_markup("back"),
-                    disable_web_page_preview=True
-                )
-            except Exception:
-                pass
-        threading.Thread(target=_do_post_all, daemon=True).start()
-        answer()
-
-    elif data.startswith("post_select_groups:"):
-        post_key = data.split(":", 1)[1]
-        groups = get_groups()
-        if not groups:
-            edit("❌ No groups available.", _back_markup("create_post_menu"))
-            answer()
-            return
-        markup = types.InlineKeyboardMarkup(row_width=1)
-        for g in groups:
-            title, _ = get_group_info(g)
-            markup.add(types.InlineKeyboardButton(
-                f"📤 {title}", callback_data=f"post_to_one:{post_key}:{g}"
-            ))
-        markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="create_post_menu"))
-        edit("📤 Select a group to send the post to:", markup)
-        answer()
-
-    elif data.startswith("post_to_one:"):
-        parts = data.split(":")
-        post_key = parts[1]
-        group_id = int(parts[2])
-        post_text = r.get(f'post_draft:{post_key}')
-        if not post_text:
-            answer("❌ Session expired. Please start over.", alert=True)
-            return
-        r.delete(f'post_draft:{post_key}')
-        reply_markup = _build_keyboard_from_pending(OWNER_ID)
-        _clear_pending_buttons(OWNER_ID)
-        sent = safe_send(group_id, post_text, reply_markup=reply_markup)
-        if sent:
-            r.set(f'last_sent:{group_id}', str(sent.message_id))
-            save_last_sent(group_id, sent.message_id)
-            edit("✅ Post sent to group!", _back_markup("create_post_menu"))
-        else:
-            edit("❌ Failed to send post.", _back_markup("create_post_menu"))
-        answer()
-
-    # ── BOT DETECTION MENU ────────────────────────────────────────────────────
-    elif data in ['bot_detection_menu', 'bot_detection_refresh']:
-        global_on    = _botdet_is_enabled_global()
-        total_kicked = int(r.get('bot_kick_count') or 0)
-        log_size     = r.llen('bot_kick_log')
-        wl_size      = r.scard('bot_kick_whitelist')
-        groups       = get_groups()
-        perm_ok = perm_no = perm_member = 0
-        for g in groups:
-            np = r.get(f'bot_kick_no_perm:{g}')
-            if np == 'no_admin':
-                perm_member += 1
-            elif np in ('no_perm', 'kick_failed'):
-                perm_no += 1
-            else:
-                perm_ok += 1
+@callback_route("added_to_group_on")
+def _cb_added_to_group_on(c):
+    r.set('added_to_group_msg_enabled', 'True')
+    c.answer("✅ 'Added to Group' message is now ON.", alert=True)
+    c.reload("added_to_group_menu")
+
+@callback_route("added_to_group_off")
+def _cb_added_to_group_off(c):
+    r.set('added_to_group_msg_enabled', 'False')
+    c.answer("✅ 'Added to Group' message is now OFF.", alert=True)
+    c.reload("added_to_group_menu")
+
+@callback_route("set_added_to_group_msg")
+def _cb_set_added_to_group_msg(c):
+    c.edit(
+        "✏️ Send the new message for when the bot is added to a group.\n\n"
+        "You can use plain text or links.\n"
+        "For embedded links use Markdown like: [Click here](https://example.com)"
+    )
+    bot.register_next_step_handler(c.call.message, process_added_to_group_msg)
+    c.answer()
+
+@callback_route("reset_added_to_group_msg")
+def _cb_reset_added_to_group_msg(c):
+    default = ('https://t.me/AllMusicShazamandlyrics_bot?startgroup=true&admin='
+               'change_info+delete_messages+restrict_members+invite_users+'
+               'pin_messages+manage_video_chats+anonymous+manage_chat+'
+               'post_stories+edit_stories+delete_stories')
+    r.set('added_to_group_msg', default)
+    c.answer("✅ Reset to default invite link.", alert=True)
+    c.reload("added_to_group_menu")
+
+# ── GLOBAL BROADCAST EMBEDDED LINKS ──────────────────────────────────────────
+@callback_route("broadcast_embedded_links")
+def _cb_broadcast_embedded_links(c):
+    c.edit(
+        "🔗 *Global Broadcast Embedded Links*\n\n"
+        "Send the message text you want to broadcast.\n"
+        "After that you'll be able to embed links into specific words.",
+        _back_markup("back"), parse_mode='Markdown'
+    )
+    bot.register_next_step_handler(c.call.message, process_embedded_links_text)
+    c.answer()
+
+@callback_route("embedded_confirm_broadcast:{str}")
+def _cb_embedded_confirm_broadcast(c, key):
+    html_text = r.get(f'embedded_draft:{key}')
+    if not html_text:
+        c.answer("❌ Session expired. Please start over.", alert=True)
+        return
+    r.delete(f'embedded_draft:{key}')
+    groups = get_groups()
+    if not groups:
+        c.edit("❌ No groups to broadcast to.", _back_markup("back"))
+        c.answer()
+        return
+    bot.send_message(
+        c.cid,
+        f"📢 Broadcasting embedded links message to {len(groups)} groups...\n"
+        f"⏱ Estimated time: ~{int(len(groups) * _INTER_MSG_DELAY)}s\n"
+        f"📡 You'll get a report when done.",
+        reply_markup=_back_markup("back")
+    )
+    start_broadcast_job('groups', html_text, OWNER_ID, "Embedded broadcast",
+                        group_ids=groups, parse_mode='HTML', direct=True)
+    c.answer()
+
+@callback_route("embedded_cancel:{str}")
+def _cb_embedded_cancel(c, key):
+    r.delete(f'embedded_draft:{key}')
+    c.edit("❌ Broadcast cancelled.", _back_markup("back"))
+    c.answer("Cancelled.")
+
+# ── BROADCAST TO BOT USERS ───────────────────────────────────────────────────
+@callback_route("broadcast_users")
+def _cb_broadcast_users(c):
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    markup.add(
+        types.InlineKeyboardButton("📣 Send Broadcast", callback_data="do_broadcast_users"),
+        types.InlineKeyboardButton("📌 Send & Pin", callback_data="do_broadcast_users_pin"),
+        types.InlineKeyboardButton("🔘 Send Message With Button", callback_data="do_broadcast_users_with_button"),
+        types.InlineKeyboardButton("🔙 Go Back", callback_data="back"),
+    )
+    c.edit("📣 *Broadcast to Bot Users*\n\nSend a message to everyone who has ever started the bot.", markup, parse_mode='Markdown')
+    c.answer()
+
+@callback_route("do_broadcast_users", "do_broadcast_users_pin")
+def _cb_do_broadcast_users(c):
+    pin = c.data == "do_broadcast_users_pin"
+    c.edit(f"✏️ Send the message to broadcast to all bot users{' (will also be pinned)' if pin else ''}:")
+    bot.register_next_step_handler(c.call.message, lambda m: process_broadcast_users(m, pin))
+    c.answer()
+
+@callback_route("do_broadcast_users_with_button")
+def _cb_do_broadcast_users_with_button(c):
+    c.edit("✏️ Send the broadcast message text:")
+    bot.register_next_step_handler(c.call.message, process_broadcast_users_btn_text)
+    c.answer()
+
+@callback_route("add_inline_btn:{str}")
+def _cb_add_inline_btn(c, btn_key):
+    c.edit("✏️ Send the Button Text (label):")
+    bot.register_next_step_handler(c.call.message, lambda m: process_broadcast_users_btn_label(m, btn_key))
+    c.answer()
+
+@callback_route("no_inline_btn:{str}")
+def _cb_no_inline_btn(c, btn_key):
+    btext = r.get(f'btn_broadcast_text:{btn_key}')
+    r.delete(f'btn_broadcast_text:{btn_key}')
+    if not btext:
+        c.answer("❌ Session expired.", alert=True)
+        return
+    bot.send_message(c.cid, f"📣 Broadcasting to {count_users()} users (no button)...", reply_markup=_back_markup("back"))
+    start_broadcast_job('users', btext, OWNER_ID, "Broadcast")
+    c.answer()
+
+@callback_route("confirm_broadcast_btn:{str}")
+def _cb_confirm_broadcast_btn(c, btn_key):
+    btext = r.get(f'btn_broadcast_text:{btn_key}')
+    bbtn_text = r.get(f'btn_broadcast_btn_text:{btn_key}')
+    bbtn_url = r.get(f'btn_broadcast_btn_url:{btn_key}')
+    if not btext or not bbtn_text or not bbtn_url:
+        c.answer("❌ Session expired. Please start over.", alert=True)
+        return
+    r.delete(f'btn_broadcast_text:{btn_key}')
+    r.delete(f'btn_broadcast_btn_text:{btn_key}')
+    r.delete(f'btn_broadcast_btn_url:{btn_key}')
+    bot.send_message(c.cid, f"📣 Broadcasting to {count_users()} users...", reply_markup=_back_markup("back"))
+    btn_markup = types.InlineKeyboardMarkup()
+    btn_markup.add(types.InlineKeyboardButton(bbtn_text, url=bbtn_url))
+    start_broadcast_job('users', btext, OWNER_ID, "Button broadcast", reply_markup=btn_markup)
+    c.answer()
+
+@callback_route("cancel_broadcast_btn:{str}")
+def _cb_cancel_broadcast_btn(c, btn_key):
+    r.delete(f'btn_broadcast_text:{btn_key}')
+    r.delete(f'btn_broadcast_btn_text:{btn_key}')
+    r.delete(f'btn_broadcast_btn_url:{btn_key}')
+    c.edit("❌ Broadcast with button cancelled.", _back_markup("back"))
+    c.answer("Cancelled.")
+
+# ── AAWM MENU ────────────────────────────────────────────────────────────────
+@callback_route("aawm_menu")
+def _cb_aawm_menu(c):
+    enabled = r.get('aawm_enabled') == 'True'
+    current_text = r.get('aawm_text') or "Welcome to the group! Please read the rules."
+    btns_raw = r.get('aawm_buttons_global')
+    btns_count = len(json_loads(btns_raw)) if btns_raw else 0
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    markup.row(
+        types.InlineKeyboardButton("✅ ON (Global)", callback_data="aawm_on"),
+        types.InlineKeyboardButton("❌ OFF", callback_data="aawm_off"),
+    )
+    markup.add(
+        types.InlineKeyboardButton("✏️ Set Welcome Text", callback_data="aawm_set_text"),
+        types.InlineKeyboardButton(f"🔘 Manage Buttons ({btns_count}/5)", callback_data="aawm_manage_buttons"),
+        types.InlineKeyboardButton("🔙 Go Back", callback_data="back"),
+    )
+    c.edit(
+        f"🤖 <b>Auto Approve Welcome Message (AAWM)</b>\n\n"
+        f"Status: {'✅ ON' if enabled else '❌ OFF'}\n\n"
+        f"Welcome Text:\n{current_text[:200]}\n\n"
+        f"Inline Buttons: {btns_count} configured\n\n"
+        f"When ON, the bot auto-approves join requests and sends a private welcome message.",
+        markup, parse_mode='HTML'
+    )
+    c.answer()
 
-        status_icon = "✅" if global_on else "❌"
-        markup = types.InlineKeyboardMarkup(row_width=2)
-        markup.row(
-            types.InlineKeyboardButton("✅ Enable Global", callback_data="botdet_global_on"),
-            types.InlineKeyboardButton("❌ Disable Global", callback_data="botdet_global_off"),
-        )
-        markup.add(types.InlineKeyboardButton(f"⚪ Whitelist ({wl_size} bots)", callback_data="botdet_whitelist"))
-        markup.add(types.InlineKeyboardButton(f"📋 Kick Log ({log_size} entries)", callback_data="botdet_log:0"))
-        markup.add(types.InlineKeyboardButton("📊 Per-Group Status", callback_data="botdet_groups"))
-        markup.add(types.InlineKeyboardButton("🔍 Scan a Group Now", callback_data="botdet_scan_pick"))
-        markup.add(types.InlineKeyboardButton("🔄 Refresh", callback_data="botdet_groups_refresh" if data == 'bot_detection_refresh' else "bot_detection_refresh"))
-        markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="back"))
-        edit(
-            f"🤖 *Bot Detection & Auto-Kick*\n\n"
-            f"Global Status: {status_icon} {'ON' if global_on else 'OFF'}\n"
-            f"Total bots kicked (all time): *{total_kicked}*\n\n"
-            f"📊 *Group Permission Status:*\n"
-            f"✅ Can kick: {perm_ok}\n"
-            f"⚠️ Admin but no restrict perm: {perm_no}\n"
-            f"🔒 Bot is just a member: {perm_member}\n\n"
-            f"⚠️ *Telegram API Limitation:*\n"
-            f"Only bots that are *admins* can be detected in an existing scan.\n"
-            f"Regular member bots already in the group are *invisible* to the Bot API — "
-            f"they can only be kicked the moment they join or rejoin.\n\n"
-            f"_Requires admin + Restrict Members permission to kick._",
-            markup, parse_mode='Markdown'
-        )
-        answer()
+@callback_route("aawm_on")
+def _cb_aawm_on(c):
+    r.set('aawm_enabled', 'True')
+    c.answer("✅ AAWM is ON")
+    c.reload("aawm_menu")
 
-    elif data == 'botdet_global_on':
-        r.set('bot_kick_enabled', 'True')
-        answer("✅ Bot auto-kick enabled globally.")
-        _reload('bot_detection_menu')
+@callback_route("aawm_off")
+def _cb_aawm_off(c):
+    r.set('aawm_enabled', 'False')
+    c.answer("❌ AAWM is OFF")
+    c.reload("aawm_menu")
 
-    elif data == 'botdet_global_off':
-        r.set('bot_kick_enabled', 'False')
-        answer("❌ Bot auto-kick disabled globally.")
-        _reload('bot_detection_menu')
+@callback_route("aawm_set_text")
+def _cb_aawm_set_text(c):
+    c.edit("✏️ Send the welcome message text for AAWM:")
+    bot.register_next_step_handler(c.call.message, process_aawm_text)
+    c.answer()
 
-    # ── WHITELIST ─────────────────────────────────────────────────────────────
-    elif data == 'botdet_whitelist':
-        wl = sorted(r.smembers('bot_kick_whitelist'))
-        markup = types.InlineKeyboardMarkup(row_width=1)
-        markup.add(types.InlineKeyboardButton("➕ Add Bot to Whitelist", callback_data="botdet_wl_add"))
-        if wl:
-            markup.add(types.InlineKeyboardButton("🗑 Clear Entire Whitelist", callback_data="botdet_wl_clear"))
-        for entry in wl[:20]:
-            markup.add(types.InlineKeyboardButton(f"❌ Remove: {entry}", callback_data=f"botdet_wl_remove:{entry}"))
-        markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="bot_detection_menu"))
-        lines = ["⚪ *Bot Whitelist*\n", "Bots in this list will never be kicked.\n"]
-        if wl:
-            for e in wl:
-                lines.append(f"• `{e}`")
+@callback_route("aawm_manage_buttons")
+def _cb_aawm_manage_buttons(c):
+    btns_raw = r.get('aawm_buttons_global')
+    btns = json_loads(btns_raw) if btns_raw else []
+    lines = [f"🔘 <b>AAWM Inline Buttons</b> ({len(btns)}/5)\n"]
+    for i, b in enumerate(btns):
+        lines.append(f"{i+1}. {b['text']} → {b['url']}")
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    if len(btns) < 5:
+        markup.add(types.InlineKeyboardButton("➕ Add Button", callback_data="aawm_add_button"))
+    if btns:
+        markup.add(types.InlineKeyboardButton("🗑 Clear All Buttons", callback_data="aawm_clear_buttons"))
+    markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="aawm_menu"))
+    c.edit("\n".join(lines) if len(lines) > 1 else "🔘 No buttons set yet.", markup, parse_mode='HTML')
+    c.answer()
+
+@callback_route("aawm_add_button")
+def _cb_aawm_add_button(c):
+    c.edit("✏️ Send the button label text:")
+    bot.register_next_step_handler(c.call.message, process_aawm_btn_text)
+    c.answer()
+
+@callback_route("aawm_clear_buttons")
+def _cb_aawm_clear_buttons(c):
+    r.delete('aawm_buttons_global')
+    c.answer("🗑 All AAWM buttons cleared.", alert=True)
+    c.reload("aawm_manage_buttons")
+
+# ── INLINE BUTTON COLLECTION FLOW (for broadcast / single send) ──────────────
+@callback_route("ibtn_add:{str}")
+def _cb_ibtn_add(c, ctx):
+    # ibtn_add:{context_key}  — user wants to add a button
+    c.edit("✏️ Send the button label text:")
+    bot.register_next_step_handler(c.call.message, lambda m: _process_ibtn_text(m, ctx))
+    c.answer()
+
+@callback_route("ibtn_another:{str}")
+def _cb_ibtn_another(c, ctx):
+    btns = _get_pending_buttons(OWNER_ID)
+    if len(btns) >= 5:
+        c.answer("⚠️ Maximum 5 buttons reached.", alert=True)
+        c.reload(f"ibtn_done:{ctx}")
+        return
+    c.edit("✏️ Send the next button label text:")
+    bot.register_next_step_handler(c.call.message, lambda m: _process_ibtn_text(m, ctx))
+    c.answer()
+
+@callback_route("ibtn_done:{str}")
+def _cb_ibtn_done(c, ctx):
+    # Context tells us where to go next
+    # ctx format: "broadcast_all" | "broadcast_users" | "group:{chat_id}"
+    btns = _get_pending_buttons(OWNER_ID)
+    if not btns:
+        c.answer("No buttons — sending without buttons.", alert=True)
+    # Route to the actual send handler
+    if ctx == "broadcast_all":
+        c.edit("📢 Send the message to broadcast to all groups:")
+        bot.register_next_step_handler(c.call.message, process_broadcast_all)
+    elif ctx == "broadcast_users":
+        c.edit("📣 Send the message to broadcast to all users:")
+        bot.register_next_step_handler(c.call.message, process_broadcast_users)
+    else:
+        try:
+            grp_id = int(ctx.replace("group:", ""))
+            c.edit("📨 Send your message now:")
+            bot.register_next_step_handler(c.call.message, lambda m: process_single_message(m, grp_id))
+        except Exception:
+            c.edit("📨 Send your message now:")
+    c.answer()
+
+@callback_route("ibtn_skip:{str}")
+def _cb_ibtn_skip(c, ctx):
+    _clear_pending_buttons(OWNER_ID)
+    if ctx == "broadcast_all":
+        c.edit("📢 Send the message to broadcast to all groups:")
+        bot.register_next_step_handler(c.call.message, process_broadcast_all)
+    elif ctx == "broadcast_users":
+        c.edit("📣 Send the message to broadcast to all users:")
+        bot.register_next_step_handler(c.call.message, process_broadcast_users)
+    else:
+        try:
+            grp_id = int(ctx.replace("group:", ""))
+            c.edit("📨 Send your message now:")
+            bot.register_next_step_handler(c.call.message, lambda m: process_single_message(m, grp_id))
+        except Exception:
+            c.edit("📨 Send your message now:")
+    c.answer()
+
+# ── CREATE POST ──────────────────────────────────────────────────────────────
+@callback_route("create_post_menu")
+def _cb_create_post_menu(c):
+    _clear_pending_buttons(OWNER_ID)
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    markup.add(
+        types.InlineKeyboardButton("📝 Write Post", callback_data="create_post_write"),
+        types.InlineKeyboardButton("🔙 Go Back", callback_data="back"),
+    )
+    c.edit("📝 *Create Post*\n\nWrite your post then choose where to send it.", markup, parse_mode='Markdown')
+    c.answer()
+
+@callback_route("create_post_write")
+def _cb_create_post_write(c):
+    _clear_pending_buttons(OWNER_ID)
+    c.edit("📝 Send your post message now:")
+    bot.register_next_step_handler(c.call.message, process_create_post_text)
+    c.answer()
+
+@callback_route("post_add_buttons:{str}")
+def _cb_post_add_buttons(c, post_key):
+    c.edit("✏️ Send the button label text:")
+    bot.register_next_step_handler(c.call.message, lambda m: process_post_btn_text(m, post_key))
+    c.answer()
+
+@callback_route("post_skip_buttons:{str}")
+def _cb_post_skip_buttons(c, post_key):
+    # Show destination selector with no buttons
+    _show_post_destination(c.cid, c.mid, post_key, c.answer)
+
+@callback_route("post_another_btn:{str}")
+def _cb_post_another_btn(c, post_key):
+    btns = _get_pending_buttons(OWNER_ID)
+    if len(btns) >= 5:
+        c.answer("⚠️ Maximum 5 buttons reached.", alert=True)
+        _show_post_destination(c.cid, c.mid, post_key, c.answer)
+        return
+    c.edit("✏️ Send the next button label text:")
+    bot.register_next_step_handler(c.call.message, lambda m: process_post_btn_text(m, post_key))
+    c.answer()
+
+@callback_route("post_done_buttons:{str}")
+def _cb_post_done_buttons(c, post_key):
+    _show_post_destination(c.cid, c.mid, post_key, c.answer)
+
+@callback_route("post_to_all:{str}")
+def _cb_post_to_all(c, post_key):
+    post_text = r.get(f'post_draft:{post_key}')
+    if not post_text:
+        c.answer("❌ Session expired. Please start over.", alert=True)
+        return
+    r.delete(f'post_draft:{post_key}')
+    groups = get_groups()
+    if not groups:
+        c.edit("❌ No groups to send to.", _back_markup("create_post_menu"))
+        c.answer()
+        return
+    reply_markup = _build_keyboard_from_pending(OWNER_ID)
+    _clear_pending_buttons(OWNER_ID)
+    bot.send_message(
+        c.cid,
+        f"📝 Sending post to {len(groups)} groups...\n"
+        f"⏱ Estimated time: ~{int(len(groups) * _INTER_MSG_DELAY)}s\n"
+        f"📡 You'll get a report when done.",
+        reply_markup=_back_markup("back"),
+        disable_web_page_preview=True
+    )
+    start_broadcast_job('groups', post_text, OWNER_ID, "Post", reply_markup=reply_markup,
+                        group_ids=groups)
+    c.answer()
+
+group_selector('post', "📤 Select a group to send the post to:",
+               lambda g, title, status, meta, post_key: (f"📤 {title}", f"post_to_one:{post_key}:{g}"),
+               back="create_post_menu")
+
+@callback_route("post_select_groups:{str}")
+def _cb_post_select_groups(c, post_key):
+    c.edit(*render_group_selector('post', 0, post_key))
+    c.answer()
+
+@callback_route("post_to_one:{str}:{int}")
+def _cb_post_to_one(c, post_key, group_id):
+    post_text = r.get(f'post_draft:{post_key}')
+    if not post_text:
+        c.answer("❌ Session expired. Please start over.", alert=True)
+        return
+    r.delete(f'post_draft:{post_key}')
+    reply_markup = _build_keyboard_from_pending(OWNER_ID)
+    _clear_pending_buttons(OWNER_ID)
+    sent = safe_send(group_id, post_text, reply_markup=reply_markup)
+    if sent:
+        r.set(f'last_sent:{group_id}', str(sent.message_id))
+        save_last_sent(group_id, sent.message_id)
+        c.edit("✅ Post sent to group!", _back_markup("create_post_menu"))
+    else:
+        c.edit("❌ Failed to send post.", _back_markup("create_post_menu"))
+    c.answer()
+
+# ── BOT DETECTION MENU ───────────────────────────────────────────────────────
+@callback_route("bot_detection_menu", "bot_detection_refresh")
+def _cb_bot_detection_menu(c):
+    global_on    = _botdet_is_enabled_global()
+    total_kicked = int(r.get('bot_kick_count') or 0)
+    log_size     = r.llen('bot_kick_log')
+    wl_size      = r.scard('bot_kick_whitelist')
+    groups       = get_groups()
+    perm_ok = perm_no = perm_member = 0
+    for g in groups:
+        np = r.get(f'bot_kick_no_perm:{g}')
+        if np == 'no_admin':
+            perm_member += 1
+        elif np in ('no_perm', 'kick_failed'):
+            perm_no += 1
         else:
-            lines.append("_No bots whitelisted yet._")
-        edit("\n".join(lines), markup, parse_mode='Markdown')
-        answer()
-
-    elif data == 'botdet_wl_add':
-        edit("✏️ Send the bot's @username or numeric ID to whitelist:\n\nExamples: `@GroupAnonymousBot` or `123456789`")
-        bot.register_next_step_handler(call.message, _process_botdet_wl_add)
-        answer()
-
-    elif data.startswith('botdet_wl_remove:'):
-        entry = data.split(':', 1)[1]
-        r.srem('bot_kick_whitelist', entry)
-        answer(f"✅ Removed {entry} from whitelist.", alert=True)
-        _reload('botdet_whitelist')
-
-    elif data == 'botdet_wl_clear':
-        r.delete('bot_kick_whitelist')
-        answer("🗑 Whitelist cleared.", alert=True)
-        _reload('botdet_whitelist')
-
-    # ── KICK LOG ──────────────────────────────────────────────────────────────
-    elif data.startswith('botdet_log:'):
+            perm_ok += 1
+
+    status_icon = "✅" if global_on else "❌"
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup.row(
+        types.InlineKeyboardButton("✅ Enable Global", callback_data="botdet_global_on"),
+        types.InlineKeyboardButton("❌ Disable Global", callback_data="botdet_global_off"),
+    )
+    markup.add(types.InlineKeyboardButton(f"⚪ Whitelist ({wl_size} bots)", callback_data="botdet_whitelist"))
+    markup.add(types.InlineKeyboardButton(f"📋 Kick Log ({log_size} entries)", callback_data="botdet_log:0"))
+    markup.add(types.InlineKeyboardButton("📊 Per-Group Status", callback_data="botdet_groups"))
+    markup.add(types.InlineKeyboardButton("🔍 Scan a Group Now", callback_data="botdet_scan_pick"))
+    markup.add(types.InlineKeyboardButton("🔄 Refresh", callback_data="botdet_groups_refresh" if c.data == 'bot_detection_refresh' else "bot_detection_refresh"))
+    markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="back"))
+    c.edit(
+        f"🤖 *Bot Detection & Auto-Kick*\n\n"
+        f"Global Status: {status_icon} {'ON' if global_on else 'OFF'}\n"
+        f"Total bots kicked (all time): *{total_kicked}*\n\n"
+        f"📊 *Group Permission Status:*\n"
+        f"✅ Can kick: {perm_ok}\n"
+        f"⚠️ Admin but no restrict perm: {perm_no}\n"
+        f"🔒 Bot is just a member: {perm_member}\n\n"
+        f"⚠️ *Telegram API Limitation:*\n"
+        f"Only bots that are *admins* can be detected in an existing scan.\n"
+        f"Regular member bots already in the group are *invisible* to the Bot API — "
+        f"they can only be kicked the moment they join or rejoin.\n\n"
+        f"_Requires admin + Restrict Members permission to kick._",
+        markup, parse_mode='Markdown'
+    )
+    c.answer()
+
+@callback_route("botdet_global_on")
+def _cb_botdet_global_on(c):
+    r.set('bot_kick_enabled', 'True')
+    c.answer("✅ Bot auto-kick enabled globally.")
+    c.reload('bot_detection_menu')
+
+@callback_route("botdet_global_off")
+def _cb_botdet_global_off(c):
+    r.set('bot_kick_enabled', 'False')
+    c.answer("❌ Bot auto-kick disabled globally.")
+    c.reload('bot_detection_menu')
+
+# ── WHITELIST ────────────────────────────────────────────────────────────────
+@callback_route("botdet_whitelist")
+def _cb_botdet_whitelist(c):
+    wl = sorted(r.smembers('bot_kick_whitelist'))
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    markup.add(types.InlineKeyboardButton("➕ Add Bot to Whitelist", callback_data="botdet_wl_add"))
+    if wl:
+        markup.add(types.InlineKeyboardButton("🗑 Clear Entire Whitelist", callback_data="botdet_wl_clear"))
+    for entry in wl[:20]:
+        markup.add(types.InlineKeyboardButton(f"❌ Remove: {entry}", callback_data=f"botdet_wl_remove:{entry}"))
+    markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="bot_detection_menu"))
+    lines = ["⚪ *Bot Whitelist*\n", "Bots in this list will never be kicked.\n"]
+    if wl:
+        for e in wl:
+            lines.append(f"• `{e}`")
+    else:
+        lines.append("_No bots whitelisted yet._")
+    c.edit("\n".join(lines), markup, parse_mode='Markdown')
+    c.answer()
+
+@callback_route("botdet_wl_add")
+def _cb_botdet_wl_add(c):
+    c.edit("✏️ Send the bot's @username or numeric ID to whitelist:\n\nExamples: `@GroupAnonymousBot` or `123456789`")
+    bot.register_next_step_handler(c.call.message, _process_botdet_wl_add)
+    c.answer()
+
+@callback_route("botdet_wl_remove:{str}")
+def _cb_botdet_wl_remove(c, entry):
+    r.srem('bot_kick_whitelist', entry)
+    c.answer(f"✅ Removed {entry} from whitelist.", alert=True)
+    c.reload('botdet_whitelist')
+
+@callback_route("botdet_wl_clear")
+def _cb_botdet_wl_clear(c):
+    r.delete('bot_kick_whitelist')
+    c.answer("🗑 Whitelist cleared.", alert=True)
+    c.reload('botdet_whitelist')
+
+# ── KICK LOG ─────────────────────────────────────────────────────────────────
+@callback_route("botdet_log:{int}")
+def _cb_botdet_log(c, page):
+    per_page = 10
+    all_entries = r.lrange('bot_kick_log', 0, -1)
+    all_entries.reverse()   # newest first
+    total = len(all_entries)
+    start = page * per_page
+    chunk = all_entries[start:start + per_page]
+
+    lines = [f"📋 *Kick Log* ({total} total)\n"]
+    if not chunk:
+        lines.append("_No kicks recorded yet._")
+    for raw in chunk:
         try:
-            page = int(data.split(':', 1)[1])
+            e = json_loads(raw)
+            ts  = time.strftime('%m-%d %H:%M', time.gmtime(e.get('ts', 0)))
+            grp = e.get('group', e.get('chat_id', '?'))
+            usr = e.get('username', '?')
+            lines.append(f"🕐 {ts} | 👾 @{usr} | 📌 {grp}")
         except Exception:
-            page = 0
-        per_page = 10
-        all_entries = r.lrange('bot_kick_log', 0, -1)
-        all_entries.reverse()   # newest first
-        total = len(all_entries)
-        start = page * per_page
-        chunk = all_entries[start:start + per_page]
-
-        lines = [f"📋 *Kick Log* ({total} total)\n"]
-        if not chunk:
-            lines.append("_No kicks recorded yet._")
-        for raw in chunk:
-            try:
-                e = json.loads(raw)
-                ts  = time.strftime('%m-%d %H:%M', time.gmtime(e.get('ts', 0)))
-                grp = e.get('group', e.get('chat_id', '?'))
-                usr = e.get('username', '?')
-                lines.append(f"🕐 {ts} | 👾 @{usr} | 📌 {grp}")
-            except Exception:
-                pass
+            pass
 
-        markup = types.InlineKeyboardMarkup(row_width=2)
-        nav_btns = []
-        if page > 0:
-            nav_btns.append(types.InlineKeyboardButton("◀️ Prev", callback_data=f"botdet_log:{page-1}"))
-        if start + per_page < total:
-            nav_btns.append(types.InlineKeyboardButton("Next ▶️", callback_data=f"botdet_log:{page+1}"))
-        if nav_btns:
-            markup.row(*nav_btns)
-        if total > 0:
-            markup.add(types.InlineKeyboardButton("🗑 Clear Log", callback_data="botdet_log_clear"))
-        markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="bot_detection_menu"))
-        edit("\n".join(lines), markup, parse_mode='Markdown')
-        answer()
-
-    elif data == 'botdet_log_clear':
-        r.delete('bot_kick_log')
-        r.set('bot_kick_count', 0)
-        answer("🗑 Kick log cleared.", alert=True)
-        _reload('botdet_log:0')
-
-    # ── PER-GROUP STATUS ──────────────────────────────────────────────────────
-    elif data in ['botdet_groups', 'botdet_groups_refresh']:
-        groups = get_groups()
-        markup = types.InlineKeyboardMarkup(row_width=1)
-        lines  = ["📊 *Per-Group Bot Detection Status*\n"]
-        for g in groups[:30]:
-            title      = _botdet_get_title(g)
-            group_raw  = r.get(f'bot_kick_enabled:{g}')
-            global_on  = _botdet_is_enabled_global()
-            if group_raw is not None:
-                status_icon = "✅" if group_raw == 'True' else "❌"
-                status_src  = ""
-            else:
-                status_icon = "✅" if global_on else "❌"
-                status_src  = " (global)"
-            np = r.get(f'bot_kick_no_perm:{g}')
-            if np == 'no_admin':
-                perm_icon = "🔒"
-            elif np in ('no_perm', 'kick_failed'):
-                perm_icon = "⚠️"
-            else:
-                perm_icon = "✅"
-            kicks = r.get(f'bot_kick_count:{g}') or '0'
-            lines.append(f"{perm_icon} {status_icon} *{title[:30]}*{status_src} — {kicks} kicked")
-            markup.add(types.InlineKeyboardButton(
-                f"{'🔴 Disable' if (group_raw or ('True' if global_on else 'False')) == 'True' else '🟢 Enable'}: {title[:25]}",
-                callback_data=f"botdet_toggle_group:{g}"
-            ))
-        if len(groups) > 30:
-            lines.append(f"\n_...and {len(groups)-30} more groups_")
-        lines.append(
-            f"\n\n🔑 *Legend:*\n"
-            f"✅ = can kick | ⚠️ = admin, no restrict perm | 🔒 = member only\n\n"
-            f"⚠️ *Scan only detects admin bots.*\n"
-            f"Member bots already present are invisible to the Bot API.\n"
-            f"They will be caught automatically when they next join or rejoin."
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    nav_btns = []
+    if page > 0:
+        nav_btns.append(types.InlineKeyboardButton("◀️ Prev", callback_data=f"botdet_log:{page-1}"))
+    if start + per_page < total:
+        nav_btns.append(types.InlineKeyboardButton("Next ▶️", callback_data=f"botdet_log:{page+1}"))
+    if nav_btns:
+        markup.row(*nav_btns)
+    if total > 0:
+        markup.add(types.InlineKeyboardButton("🗑 Clear Log", callback_data="botdet_log_clear"))
+    markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="bot_detection_menu"))
+    c.edit("\n".join(lines), markup, parse_mode='Markdown')
+    c.answer()
+
+@callback_route("botdet_log_clear")
+def _cb_botdet_log_clear(c):
+    r.delete('bot_kick_log')
+    r.set('bot_kick_count', 0)
+    c.answer("🗑 Kick log cleared.", alert=True)
+    c.reload('botdet_log:0')
+
+# ── PER-GROUP STATUS ─────────────────────────────────────────────────────────
+def _botdet_page_meta(chat_ids):
+    """Per-group kick settings for one page: {chat_id: (enabled_raw, no_perm, kicks, global_on)}."""
+    pipe = r.pipeline()
+    for g in chat_ids:
+        pipe.get(f'bot_kick_enabled:{g}')
+        pipe.get(f'bot_kick_no_perm:{g}')
+        pipe.get(f'bot_kick_count:{g}')
+    values = pipe.execute()
+    global_on = _botdet_is_enabled_global()
+    return {g: (*values[i * 3:i * 3 + 2], values[i * 3 + 2] or '0', global_on) for i, g in enumerate(chat_ids)}
+
+def _botdet_group_line(g, title, status, meta):
+    group_raw, np, kicks, global_on = meta
+    if group_raw is not None:
+        status_icon = "✅" if group_raw == 'True' else "❌"
+        status_src  = ""
+    else:
+        status_icon = "✅" if global_on else "❌"
+        status_src  = " (global)"
+    if np == 'no_admin':
+        perm_icon = "🔒"
+    elif np in ('no_perm', 'kick_failed'):
+        perm_icon = "⚠️"
+    else:
+        perm_icon = "✅"
+    return f"{perm_icon} {status_icon} *{title[:30]}*{status_src} — {kicks} kicked"
+
+def _botdet_group_button(g, title, status, meta, ctx):
+    group_raw, _, _, global_on = meta
+    enabled = (group_raw or ('True' if global_on else 'False')) == 'True'
+    return f"{'🔴 Disable' if enabled else '🟢 Enable'}: {title[:25]}", f"botdet_toggle_group:{g}"
+
+group_selector('botdet', "📊 *Per-Group Bot Detection Status*\n", _botdet_group_button,
+               back="bot_detection_menu", parse_mode='Markdown',
+               load=_botdet_page_meta, line=_botdet_group_line,
+               footer=(
+                   f"\n🔑 *Legend:*\n"
+                   f"✅ = can kick | ⚠️ = admin, no restrict perm | 🔒 = member only\n\n"
+                   f"⚠️ *Scan only detects admin bots.*\n"
+                   f"Member bots already present are invisible to the Bot API.\n"
+                   f"They will be caught automatically when they next join or rejoin."
+               ))
+
+@callback_route("botdet_groups", "botdet_groups_refresh")
+def _cb_botdet_groups(c):
+    c.edit(*render_group_selector('botdet'))
+    c.answer()
+
+@callback_route("botdet_toggle_group:{int}")
+def _cb_botdet_toggle_group(c, g):
+    current_raw = r.get(f'bot_kick_enabled:{g}')
+    global_on   = _botdet_is_enabled_global()
+    current_eff = current_raw == 'True' if current_raw is not None else global_on
+    r.set(f'bot_kick_enabled:{g}', 'False' if current_eff else 'True')
+    c.answer(f"{'❌ Disabled' if current_eff else '✅ Enabled'} for this group.")
+    c.reload('botdet_groups')
+
+# ── SCAN GROUP NOW ───────────────────────────────────────────────────────────
+group_selector('scan', "🔍 *Scan a Group Now*\n\nSelect a group to scan and kick all non-whitelisted bots:\n\n⚠️ Only admin bots are detectable via scan.",
+               lambda g, title, status, meta, ctx: (f"🔍 {title[:35]}", f"botdet_scan_do:{g}"),
+               back="bot_detection_menu", parse_mode='Markdown', empty="❌ No groups registered.")
+
+@callback_route("botdet_scan_pick")
+def _cb_botdet_scan_pick(c):
+    c.edit(*render_group_selector('scan'))
+    c.answer()
+
+@callback_route("botdet_scan_do:{int}")
+def _cb_botdet_scan_do(c, g):
+    title = _botdet_get_title(g)
+    c.edit(f"🔍 Scanning *{title}* for bots…\n\nThis may take a few seconds.", parse_mode='Markdown')
+    c.answer()
+
+    def _do_scan(gid=g, t=title):
+        k, wl, np, err, found, err_detail = _botdet_scan_group(gid)
+        err_line = f"\n⚠️ Error detail: `{err_detail}`" if err_detail else ""
+        result = (
+            f"🔍 *Scan Complete: {t}*\n\n"
+            f"🔎 Admin bots checked: {found}\n"
+            f"✅ Bots kicked: {k}\n"
+            f"⚪ Whitelisted (skipped): {wl}\n"
+            f"⚠️ No permission (skipped): {np}\n"
+            f"❌ Errors: {err}{err_line}\n\n"
+            f"ℹ️ *Note:* Only admin bots are visible to this scan.\n"
+            f"Member bots already present cannot be detected by the Telegram Bot API — "
+            f"they will be kicked automatically the next time they join or rejoin this group."
         )
-        markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="bot_detection_menu"))
         try:
-            bot.edit_message_text("\n".join(lines), cid, mid, reply_markup=markup, parse_mode='Markdown')
-        except telebot.apihelper.ApiTelegramException as e:
-            if 'message is not modified' not in str(e).lower():
-                try:
-                    bot.edit_message_text(("\n".join(lines))[:4000], cid, mid, reply_markup=markup, parse_mode='Markdown')
-                except Exception:
-                    pass
+            edit_menu(result, cid_owner, mid_owner, parse_mode='Markdown',
+                reply_markup=_back_markup('bot_detection_menu'))
         except Exception:
-            pass
-        answer()
-
-    elif data.startswith('botdet_toggle_group:'):
-        g = int(data.split(':', 1)[1])
-        current_raw = r.get(f'bot_kick_enabled:{g}')
-        global_on   = _botdet_is_enabled_global()
-        current_eff = current_raw == 'True' if current_raw is not None else global_on
-        r.set(f'bot_kick_enabled:{g}', 'False' if current_eff else 'True')
-        answer(f"{'❌ Disabled' if current_eff else '✅ Enabled'} for this group.")
-        _reload('botdet_groups')
-
-    # ── SCAN GROUP NOW ────────────────────────────────────────────────────────
-    elif data == 'botdet_scan_pick':
-        groups = get_groups()
-        if not groups:
-            answer("❌ No groups registered.", alert=True)
-            return
-        markup = types.InlineKeyboardMarkup(row_width=1)
-        for g in groups:
-            title = _botdet_get_title(g)
-            markup.add(types.InlineKeyboardButton(f"🔍 {title[:35]}", callback_data=f"botdet_scan_do:{g}"))
-        markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="bot_detection_menu"))
-        edit("🔍 *Scan a Group Now*\n\nSelect a group to scan and kick all non-whitelisted bots:\n\n⚠️ Only admin bots are detectable via scan.", markup, parse_mode='Markdown')
-        answer()
-
-    elif data.startswith('botdet_scan_do:'):
-        g = int(data.split(':', 1)[1])
-        title = _botdet_get_title(g)
-        edit(f"🔍 Scanning *{title}* for bots…\n\nThis may take a few seconds.", parse_mode='Markdown')
-        answer()
-
-        def _do_scan(cid=g, t=title):
-            k, wl, np, err, found, err_detail = _botdet_scan_group(cid)
-            err_line = f"\n⚠️ Error detail: `{err_detail}`" if err_detail else ""
-            result = (
-                f"🔍 *Scan Complete: {t}*\n\n"
-                f"🔎 Admin bots checked: {found}\n"
-                f"✅ Bots kicked: {k}\n"
-                f"⚪ Whitelisted (skipped): {wl}\n"
-                f"⚠️ No permission (skipped): {np}\n"
-                f"❌ Errors: {err}{err_line}\n\n"
-                f"ℹ️ *Note:* Only admin bots are visible to this scan.\n"
-                f"Member bots already present cannot be detected by the Telegram Bot API — "
-                f"they will be kicked automatically the next time they join or rejoin this group."
-            )
             try:
-                bot.edit_message_text(result, cid_owner, mid_owner, parse_mode='Markdown',
+                bot.send_message(OWNER_ID, result, parse_mode='Markdown',
                     reply_markup=_back_markup('bot_detection_menu'))
             except Exception:
-                try:
-                    bot.send_message(OWNER_ID, result, parse_mode='Markdown',
-                        reply_markup=_back_markup('bot_detection_menu'))
-                except Exception:
-                    pass
+                pass
 
-        cid_owner = cid
-        mid_owner = mid
-        threading.Thread(target=_do_scan, daemon=True).start()
+    cid_owner = c.cid
+    mid_owner = c.mid
+    threading.Thread(target=_do_scan, daemon=True).start()
 
-    # ── BAN USER ──────────────────────────────────────────────────────────────
-    elif data == "ban_user_menu":
-        groups = get_groups()
-        if not groups:
-            edit("❌ No groups available.", _back_markup("back"))
-            answer()
-            return
-        markup = types.InlineKeyboardMarkup(row_width=1)
-        for g in groups:
-            title, status = get_group_info(g)
-            markup.add(types.InlineKeyboardButton(
-                f"🚫 {title} ({status})", callback_data=f"ban_select_group:{g}"
-            ))
-        markup.add(types.InlineKeyboardButton("🔙 Go Back", callback_data="back"))
-        edit("🚫 *Ban User*\n\nSelect the group to ban from:", markup, parse_mode='Markdown')
-        answer()
-
-    elif data.startswith("ban_user_in_group:"):
-        # Called from individual group menu — skip group selection
-        group_id = int(data.split(":", 1)[1])
-        _reload(f"ban_select_group:{group_id}")
-
-    elif data.startswith("ban_select_group:"):
-        group_id = int(data.split(":", 1)[1])
-        title, _ = get_group_info(group_id)
-        # Check bot permission
-        try:
-            me = bot.get_chat_member(group_id, bot.get_me().id)
-            can_ban = (
-                me.status == 'creator' or
-                (me.status == 'administrator' and getattr(me, 'can_restrict_members', False))
-            )
-        except Exception:
-            can_ban = False
-        if not can_ban:
-            edit(
-                f"❌ Bot does not have *can_restrict_members* permission in *{title}*.\n\n"
-                f"Please grant the bot ban rights first.",
-                _back_markup("ban_user_menu"), parse_mode='Markdown'
-            )
-            answer()
-            return
-        r.setex(f'ban_target_group:{OWNER_ID}', 600, str(group_id))
-        edit(
-            f"🚫 *Ban User in {title}*\n\n"
-            f"Send the user ID to ban.\n"
-            f"You can also forward a message from that user.",
+# ── BAN USER ─────────────────────────────────────────────────────────────────
+group_selector('ban', "🚫 *Ban User*\n\nSelect the group to ban from:",
+               lambda g, title, status, meta, ctx: (f"🚫 {title} ({status})", f"ban_select_group:{g}"),
+               parse_mode='Markdown')
+
+@callback_route("ban_user_menu")
+def _cb_ban_user_menu(c):
+    c.edit(*render_group_selector('ban'))
+    c.answer()
+
+@callback_route("ban_user_in_group:{int}")
+def _cb_ban_user_in_group(c, group_id):
+    # Called from individual group menu — skip group selection
+    c.reload(f"ban_select_group:{group_id}")
+
+@callback_route("ban_select_group:{int}")
+def _cb_ban_select_group(c, group_id):
+    title, _ = get_group_info(group_id)
+    # Check bot permission
+    if not bot_can_restrict(group_id):
+        c.edit(
+            f"❌ Bot does not have *can_restrict_members* permission in *{title}*.\n\n"
+            f"Please grant the bot ban rights first.",
             _back_markup("ban_user_menu"), parse_mode='Markdown'
         )
-        bot.register_next_step_handler(call.message, process_ban_user)
-        answer()
+        c.answer()
+        return
+    r.setex(f'ban_target_group:{OWNER_ID}', 600, str(group_id))
+    c.edit(
+        f"🚫 *Ban User in {title}*\n\n"
+        f"Send the user ID to ban.\n"
+        f"You can also forward a message from that user.",
+        _back_markup("ban_user_menu"), parse_mode='Markdown'
+    )
+    bot.register_next_step_handler(c.call.message, process_ban_user)
+    c.answer()
 
 # ─────────────────────────────────────────────────────────────────────────────
 #  PROCESS FUNCTIONS
 # ─────────────────────────────────────────────────────────────────────────────
 
+def process_group_search(message, name, ctx):
+    if message.from_user.id != OWNER_ID:
+        return
+    query = (message.text or '').strip()
+    if query and query.lower() != 'cancel':
+        r.setex(f'group_search:{name}', _GROUP_SEARCH_TTL, query[:64])
+    text, markup, parse_mode = render_group_selector(name, 0, ctx)
+    bot.send_message(message.chat.id, text, reply_markup=markup, parse_mode=parse_mode)
+
 def process_added_to_group_msg(message):
     if message.from_user.id != OWNER_ID:
         return
@@ -4418,9 +5792,9 @@ def process_aawm_btn_url(message):
         bot.send_message(message.chat.id, "❌ Session expired.", reply_markup=_back_markup("aawm_manage_buttons"))
         return
     btns_raw = r.get('aawm_buttons_global')
-    btns = json.loads(btns_raw) if btns_raw else []
+    btns = json_loads(btns_raw) if btns_raw else []
     btns.append({'text': btn_text, 'url': message.text.strip()})
-    r.set('aawm_buttons_global', json.dumps(btns))
+    r.set('aawm_buttons_global', json_dumps(btns))
     bot.send_message(message.chat.id, f"✅ Button added! ({len(btns)}/5)",
                      reply_markup=_back_markup("aawm_manage_buttons"))
 
@@ -4468,7 +5842,7 @@ def _show_post_destination(cid, mid, post_key, answer_fn):
         types.InlineKeyboardButton("❌ Cancel", callback_data="create_post_menu"),
     )
     try:
-        bot.edit_message_text("📤 Where do you want to send this post?", cid, mid, reply_markup=markup)
+        edit_menu("📤 Where do you want to send this post?", cid, mid, reply_markup=markup)
     except Exception:
         pass
     answer_fn()
@@ -4634,7 +6008,7 @@ def process_embedded_links_text(message):
     )
     # Store the words temporarily
     draft_key = f"emb_words:{message.from_user.id}"
-    r.set(draft_key, json.dumps(words), ex=600)
+    r.set(draft_key, json_dumps(words), ex=600)
     bot.register_next_step_handler(message, process_embedded_word_numbers)
 
 def process_embedded_word_numbers(message):
@@ -4645,7 +6019,7 @@ def process_embedded_word_numbers(message):
     if not raw:
         bot.send_message(message.chat.id, "❌ Session expired. Please start over.", reply_markup=_back_markup("broadcast_embedded_links"))
         return
-    words = json.loads(raw)
+    words = json_loads(raw)
     raw_nums = re.split(r'[\s,]+', message.text.strip())
     try:
         chosen = [int(n) for n in raw_nums if n.isdigit()]
@@ -4655,7 +6029,7 @@ def process_embedded_word_numbers(message):
         bot.send_message(message.chat.id, f"❌ Invalid numbers. Send numbers between 1 and {len(words)}.", reply_markup=_back_markup("broadcast_embedded_links"))
         return
     # Store chosen indices
-    r.set(f"emb_chosen:{message.from_user.id}", json.dumps(chosen), ex=600)
+    r.set(f"emb_chosen:{message.from_user.id}", json_dumps(chosen), ex=600)
     chosen_words = [words[n-1] for n in chosen]
     bot.send_message(
         message.chat.id,
@@ -4675,8 +6049,8 @@ def process_embedded_links_urls(message):
     if not words_raw or not chosen_raw:
         bot.send_message(message.chat.id, "❌ Session expired. Please start over.", reply_markup=_back_markup("broadcast_embedded_links"))
         return
-    words = json.loads(words_raw)
-    chosen = json.loads(chosen_raw)
+    words = json_loads(words_raw)
+    chosen = json_loads(chosen_raw)
     urls = [u.strip() for u in message.text.strip().splitlines() if u.strip()]
     if len(urls) == 1 and len(chosen) > 1:
         urls = urls * len(chosen)  # same URL for all chosen words
@@ -4775,30 +6149,8 @@ def process_broadcast_all(message):
         disable_web_page_preview=True
     )
 
-    def _do_broadcast():
-        sent_count = 0
-        failed_count = 0
-        for group in groups:
-            sent = safe_send(group, text, reply_markup=reply_markup)
-            if sent:
-                r.set(f'last_sent:{group}', str(sent.message_id))
-                save_last_sent(group, sent.message_id)
-                sent_count += 1
-            else:
-                failed_count += 1
-        try:
-            bot.send_message(
-                message.chat.id,
-                f"✅ Broadcast complete!\n"
-                f"👥 Sent to: {sent_count} groups\n"
-                f"❌ Failed: {failed_count}",
-                reply_markup=_back_markup("back"),
-                disable_web_page_preview=True
-            )
-        except Exception:
-            pass
-
-    threading.Thread(target=_do_broadcast, daemon=True).start()
+    start_broadcast_job('groups', text, message.chat.id, "Broadcast", reply_markup=reply_markup,
+                        group_ids=groups)
 
 def process_single_message(message, group_id):
     if message.from_user.id != OWNER_ID:
@@ -4822,7 +6174,7 @@ def process_single_message(message, group_id):
                              reply_markup=_back_markup(f"group_menu:{group_id}"),
                              disable_web_page_preview=True)
     else:
-        err_detail = r.get(f'group_error:{group_id}') or "Unknown error"
+        err_detail = (get_group_health(group_id) or {}).get('error') or "Unknown error"
         bot.send_message(message.chat.id, f"❌ Error sending to group:\n{err_detail}",
                          reply_markup=_back_markup(f"group_menu:{group_id}"),
                          disable_web_page_preview=True)
@@ -4897,36 +6249,155 @@ def process_promote_to_admin(message, chat_id):
 def process_broadcast_users(message, pin=False):
     if message.from_user.id != OWNER_ID:
         return
-    text = message.text
-    users = get_all_users()
-    sent_count = 0
-    failed_count = 0
-    pin_count = 0
-    pin_failed = 0
-
-    for uid in users:
-        sent = safe_send(uid, text)
-        if sent:
-            save_private_sent(uid, sent.message_id)
-            sent_count += 1
-            if pin:
-                try:
-                    bot.pin_chat_message(uid, sent.message_id)
-                    pin_count += 1
-                except Exception:
-                    pin_failed += 1
-        else:
-            failed_count += 1
+    bot.send_message(message.chat.id, f"📣 Broadcasting to {count_users()} users...",
+                     reply_markup=_back_markup("back"))
+    start_broadcast_job('users', message.text, message.chat.id, "Broadcast to users", pin=pin)
 
-    result = (
-        f"📣 Broadcast to users done!\n"
-        f"✅ Sent: {sent_count}\n"
-        f"❌ Failed: {failed_count}"
-    )
-    if pin:
-        result += f"\n📌 Pinned: {pin_count}\n❌ Pin failed: {pin_failed}"
 
-    bot.send_message(message.chat.id, result, reply_markup=_back_markup("back"))
+# ─────────────────────────────────────────────────────────────────────────────
+#  BROADCAST JOBS
+#  Every broadcast is a job checkpointed in Redis:
+#    broadcast_job:{id}   hash — text, markup, options, sent/failed counters
+#    broadcast_done:{id}  set  — targets already claimed
+#    broadcast_jobs       set  — ids still running
+#  A target is claimed (SADD) before it is sent to, so a job resumed by the
+#  next instance after a deploy never messages anyone twice.
+# ─────────────────────────────────────────────────────────────────────────────
+
+def start_broadcast_job(targets, text, report_chat, label, reply_markup=None,
+                        group_ids=None, parse_mode=None, pin=False, direct=False):
+    """targets: 'groups' (group_ids) or 'users' (every bot user).
+    direct=True sends straight through the API (needed for parse_mode)."""
+    job_id = str(int(time.time() * 1000))
+    pipe = r.pipeline()
+    pipe.hset(f'broadcast_job:{job_id}', mapping={
+        'targets': targets, 'text': text, 'label': label,
+        'report_chat': str(report_chat),
+        'markup': reply_markup.to_json() if reply_markup else '',
+        'group_ids': json_dumps(group_ids or []),
+        'parse_mode': parse_mode or '', 'pin': '1' if pin else '',
+        'direct': '1' if direct else '',
+        'sent': 0, 'failed': 0, 'pin_ok': 0, 'pin_failed': 0,
+    })
+    pipe.sadd('broadcast_jobs', job_id)
+    pipe.execute()
+    if _is_leader.is_set():
+        threading.Thread(target=_run_broadcast_job, args=(job_id,), daemon=True).start()
+    else:
+        logger.info(f"[BROADCAST] Job {job_id} queued for the leader process")
+    return job_id
+
+_running_broadcasts = set()        # job ids with a runner thread in this process
+_running_broadcasts_lock = threading.Lock()
+_BROADCAST_OWNER_TTL = 300         # > safe_send's 180s wait, renewed before every target
+
+def _run_broadcast_job(job_id):
+    with _running_broadcasts_lock:
+        if job_id in _running_broadcasts:
+            return
+        _running_broadcasts.add(job_id)
+    try:
+        _run_broadcast_job_inner(job_id)
+    finally:
+        with _running_broadcasts_lock:
+            _running_broadcasts.discard(job_id)
+
+def _run_broadcast_job_inner(job_id):
+    owner_key = f'broadcast_owner:{job_id}'
+    # One runner per job across processes: a second runner (handover window,
+    # or a job started outside the leader) would re-send once the first one
+    # finishes and drops the done set.
+    if not r.set(owner_key, _leader_token, nx=True, ex=_BROADCAST_OWNER_TTL):
+        return
+    try:
+        _broadcast_job_loop(job_id, owner_key)
+    finally:
+        try:
+            _delete_if_owner(keys=[owner_key], args=[_leader_token])
+        except Exception:
+            pass
+
+def _broadcast_job_loop(job_id, owner_key):
+    key = f'broadcast_job:{job_id}'
+    done_key = f'broadcast_done:{job_id}'
+    job = r.hgetall(key)
+    if not job:
+        r.srem('broadcast_jobs', job_id)
+        return
+    to_groups = job['targets'] == 'groups'
+    markup = types.InlineKeyboardMarkup.de_json(job['markup']) if job['markup'] else None
+    targets = json_loads(job['group_ids']) if to_groups else iter_users()
+
+    for target in targets:
+        if (_shutting_down.is_set() or not _is_leader.is_set()
+                or not _expire_if_owner(keys=[owner_key], args=[_leader_token, _BROADCAST_OWNER_TTL])):
+            logger.info(f"[BROADCAST] Job {job_id} checkpointed for the next leader")
+            return
+        if not r.sadd(done_key, str(target)):
+            continue  # claimed before a restart
+        try:
+            if job['direct']:
+                sent = bot.send_message(target, job['text'], parse_mode=job['parse_mode'] or None,
+                                        reply_markup=markup)
+                time.sleep(_INTER_MSG_DELAY)
+            else:
+                sent = safe_send(target, job['text'], reply_markup=markup, park=False)
+        except Exception as e:
+            if to_groups:
+                _log_runtime_error(target, 'broadcast', str(e)[:200])
+            sent = None
+        if not sent and _shutting_down.is_set():
+            # Cut off by the drain, not failed: leave it for the resumed job
+            r.srem(done_key, str(target))
+            logger.info(f"[BROADCAST] Job {job_id} checkpointed for the next leader")
+            return
+        if not sent:
+            r.hincrby(key, 'failed')
+            continue
+        r.hincrby(key, 'sent')
+        if to_groups:
+            r.set(f'last_sent:{target}', str(sent.message_id))
+            save_last_sent(target, sent.message_id)
+        else:
+            save_private_sent(target, sent.message_id)
+        if job['pin']:
+            try:
+                bot.pin_chat_message(target, sent.message_id)
+                r.hincrby(key, 'pin_ok')
+            except Exception:
+                r.hincrby(key, 'pin_failed')
+
+    stats = r.hgetall(key)
+    report = (f"✅ {job['label']} complete!\n"
+              f"{'👥 Sent to' if to_groups else '✅ Sent'}: {stats.get('sent', 0)}"
+              f"{' groups' if to_groups else ''}\n"
+              f"❌ Failed: {stats.get('failed', 0)}")
+    if job['pin']:
+        report += f"\n📌 Pinned: {stats.get('pin_ok', 0)}\n❌ Pin failed: {stats.get('pin_failed', 0)}"
+    try:
+        bot.send_message(int(job['report_chat']), report, reply_markup=_back_markup("back"),
+                         disable_web_page_preview=True)
+    except Exception:
+        pass
+    pipe = r.pipeline()
+    pipe.delete(key, done_key)
+    pipe.srem('broadcast_jobs', job_id)
+    pipe.execute()
+
+def _resume_broadcast_jobs(notify=True):
+    for job_id in r.smembers('broadcast_jobs'):
+        with _running_broadcasts_lock:
+            if job_id in _running_broadcasts:
+                continue
+        label = r.hget(f'broadcast_job:{job_id}', 'label') or 'Broadcast'
+        done = r.scard(f'broadcast_done:{job_id}')
+        logger.info(f"[BROADCAST] Resuming job {job_id} ({label}, {done} already done)")
+        if notify:
+            try:
+                bot.send_message(OWNER_ID, f"▶️ Resuming {label} after restart — {done} target(s) already done.")
+            except Exception:
+                pass
+        threading.Thread(target=_run_broadcast_job, args=(job_id,), daemon=True).start()
 
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -4940,13 +6411,218 @@ def check_message(message):
     if not is_link_only(message.chat.id):
         return
     content = (message.text or "") + (message.caption or "")
-    if not re.search(r'https?://[^\s]+', content):
+    if not _LINK_RE.search(content):
         try:
             bot.delete_message(message.chat.id, message.message_id)
         except Exception:
             pass
 
 
+# ─────────────────────────────────────────────────────────────────────────────
+#  UPDATE TRACING
+#  Every webhook update carries a thread-local trace. Redis commands,
+#  pipelines and Telegram API requests made on that thread add their time to
+#  it, and each registered handler stamps its name, so a finished update
+#  tells us which handler ran and where its time went.
+# ─────────────────────────────────────────────────────────────────────────────
+
+_SLOW_UPDATES_WINDOW = 2000        # recent updates kept for the slowest-N table
+_SLOW_UPDATES_SHOW = 10
+
+_trace_local = threading.local()
+_recent_updates = deque(maxlen=_SLOW_UPDATES_WINDOW)
+_handler_stats = {}                # label → [count, total_s, redis_s, api_s, max_s]
+_handler_stats_lock = threading.Lock()
+
+def _callback_prefix(data):
+    """'group_menu:-100123' → 'group_menu', 'botdet_scan_pick' → 'botdet_scan_pick'."""
+    route = match_callback(data or '')[2]
+    if route:
+        return route.rstrip(':')
+    m = re.match(r'[A-Za-z_]+', data or '')
+    return m.group(0).rstrip('_') if m else '?'
+
+_TRACE_SPANS = os.environ.get('TRACE_SPANS', 'False') == 'True'
+_TRACE_SLOW_MS = float(os.environ.get('TRACE_SLOW_MS', 50))
+_SLOW_SPANS_KEEP = 200
+_NPLUS1_THRESHOLD = 5              # same call site this many times in one update
+
+_slow_spans = deque(maxlen=_SLOW_SPANS_KEEP)  # (ts, ms, kind, op, bytes, site, update label)
+_span_updates = deque(maxlen=50)               # per-update breakdowns when spans are on
+
+def _caller_site():
+    """First frame in this file outside the tracing wrappers: 'func:line'."""
+    f = sys._getframe(2)
+    while f is not None:
+        code = f.f_code
+        if code.co_filename == __file__ and code.co_name not in ('wrapper', 'traced'):
+            return f"{code.co_name}:{f.f_lineno}"
+        f = f.f_back
+    return '?'
+
+def _describe_redis(args, kwargs):
+    return (str(args[0]) if args else '?'), sum(len(str(a)) for a in args[1:])
+
+def _describe_api(args, kwargs):
+    params = kwargs.get('params') if 'params' in kwargs else (args[3] if len(args) > 3 else None)
+    method = kwargs.get('method_name') or (args[1] if len(args) > 1 else '?')
+    return method, len(json_dumps_bytes(params, default=str)) if params else 0
+
+def _timed(kind, fn, describe=None):
+    def wrapper(*args, **kwargs):
+        trace = getattr(_trace_local, 'trace', None)
+        if trace is None and not _TRACE_SPANS:
+            return fn(*args, **kwargs)
+        # Described up front: a pipeline's command stack is gone after execute()
+        desc = describe(args, kwargs) if _TRACE_SPANS and describe is not None else None
+        started = time.time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            elapsed = time.time() - started
+            if trace is not None:
+                trace[kind] += elapsed
+                trace[kind + '_calls'] += 1
+            if desc is not None:
+                op, size = desc
+                site = _caller_site()
+                if trace is not None:
+                    trace['spans'].append((kind, op, site, elapsed))
+                if elapsed * 1000 >= _TRACE_SLOW_MS:
+                    _slow_spans.append((time.time(), elapsed * 1000, kind, op, size, site,
+                                        trace['handler'] if trace else None))
+    return wrapper
+
+def _timed_pipeline(fn):
+    def wrapper(*args, **kwargs):
+        pipe = fn(*args, **kwargs)
+
+        def describe(a, kw):
+            stack = pipe.command_stack
+            ops = {str(c[0][0]) for c in stack if c[0]}
+            return (f"PIPELINE[{len(stack)}] " + ','.join(sorted(ops))[:60],
+                    sum(len(str(x)) for c in stack for x in c[0][1:]))
+        pipe.execute = _timed('redis', pipe.execute, describe)
+        return pipe
+    return wrapper
+
+r.execute_command = _timed('redis', r.execute_command, _describe_redis)
+r.pipeline = _timed_pipeline(r.pipeline)
+telebot.apihelper._make_request = _timed('api', telebot.apihelper._make_request, _describe_api)
+
+def _instrument_handlers():
+    """Wrap every registered handler so the active trace learns its name."""
+    for attr in ('message_handlers', 'edited_message_handlers', 'callback_query_handlers',
+                 'my_chat_member_handlers', 'chat_member_handlers', 'chat_join_request_handlers'):
+        for handler in getattr(bot, attr, []):
+            fn = handler['function']
+            if getattr(fn, '_traced', False):
+                continue
+
+            def traced(obj, *args, _fn=fn, **kwargs):
+                trace = getattr(_trace_local, 'trace', None)
+                if trace is not None:
+                    trace['handler'] = _fn.__name__
+                    if isinstance(obj, types.CallbackQuery):
+                        trace['prefix'] = _callback_prefix(obj.data)
+                return _fn(obj, *args, **kwargs)
+            traced._traced = True
+            traced.__name__ = fn.__name__
+            handler['function'] = traced
+
+def _update_kind(update):
+    for kind in ('callback_query', 'message', 'edited_message', 'my_chat_member',
+                 'chat_member', 'chat_join_request'):
+        if getattr(update, kind, None) is not None:
+            return kind
+    return 'other'
+
+def _begin_update_trace(update):
+    _trace_local.trace = {
+        'started': time.time(), 'kind': _update_kind(update),
+        'handler': None, 'prefix': None,
+        'redis': 0.0, 'redis_calls': 0, 'api': 0.0, 'api_calls': 0,
+        'spans': [],
+    }
+
+def _end_update_trace():
+    trace = getattr(_trace_local, 'trace', None)
+    _trace_local.trace = None
+    if trace is None:
+        return
+    total = time.time() - trace['started']
+    label = trace['handler'] or trace['kind']
+    if trace['prefix']:
+        label = f"{label}:{trace['prefix']}"
+    _recent_updates.append((total, time.time(), label, trace['redis'], trace['redis_calls'],
+                            trace['api'], trace['api_calls']))
+    with _handler_stats_lock:
+        st = _handler_stats.setdefault(label, [0, 0.0, 0.0, 0.0, 0.0])
+        st[0] += 1
+        st[1] += total
+        st[2] += trace['redis']
+        st[3] += trace['api']
+        st[4] = max(st[4], total)
+    observe_latency('update_latency_seconds', total, f'handler="{label}"')
+    if trace['spans']:
+        sites = {}
+        for kind, op, site, elapsed in trace['spans']:
+            entry = sites.setdefault((kind, site), [0, 0.0, op])
+            entry[0] += 1
+            entry[1] += elapsed
+        hot = sorted(sites.items(), key=lambda kv: kv[1][1], reverse=True)[:5]
+        _span_updates.append((time.time(), label, total, trace['redis_calls'], trace['api_calls'],
+                              [(kind, site, n, t, op) for (kind, site), (n, t, op) in hot]))
+
+def _render_slow_updates():
+    recent = sorted(list(_recent_updates), reverse=True)[:_SLOW_UPDATES_SHOW]
+    lines = [f"🐢 *Slowest updates* (last {len(_recent_updates)})\n"]
+    for total, ts, label, redis_s, redis_n, api_s, api_n in recent:
+        when = datetime.datetime.fromtimestamp(ts).strftime('%H:%M:%S')
+        lines.append(f"`{total * 1000:7.0f}ms` {when} `{label}`\n"
+                     f"    redis {redis_s * 1000:.0f}ms/{redis_n} · api {api_s * 1000:.0f}ms/{api_n}")
+    if not recent:
+        lines.append("No updates traced yet.")
+    with _handler_stats_lock:
+        stats = sorted(_handler_stats.items(), key=lambda kv: kv[1][1], reverse=True)[:_SLOW_UPDATES_SHOW]
+    if stats:
+        lines.append("\n⏱ *Time by handler* (since start)")
+        for label, (count, total, redis_s, api_s, peak) in stats:
+            lines.append(f"`{label}` ×{count} avg {total / count * 1000:.0f}ms "
+                         f"max {peak * 1000:.0f}ms (redis {redis_s / total * 100 if total else 0:.0f}% "
+                         f"· api {api_s / total * 100 if total else 0:.0f}%)")
+    return "\n".join(lines)
+
+@bot.message_handler(commands=['slow'], chat_types=['private'])
+def slow_command(message):
+    if message.from_user.id != OWNER_ID:
+        return
+    bot.send_message(message.chat.id, _render_slow_updates(), parse_mode='Markdown')
+
+def _render_spans():
+    if not _TRACE_SPANS:
+        return "Span tracing is off. Set `TRACE_SPANS=True` and redeploy to enable it."
+    lines = [f"🔬 *Slow calls* (≥{_TRACE_SLOW_MS:.0f}ms, last {len(_slow_spans)})\n"]
+    for ts, ms, kind, op, size, site, handler in sorted(_slow_spans, key=lambda x: x[1], reverse=True)[:10]:
+        lines.append(f"`{ms:6.0f}ms` {kind} `{op}` {size}B ← `{site}`" + (f" (`{handler}`)" if handler else ""))
+    lines.append("\n🧾 *Recent updates*")
+    for ts, label, total, redis_n, api_n, hot in list(_span_updates)[-5:]:
+        lines.append(f"`{label}`: {redis_n} Redis ops / {api_n} API calls / {total * 1000:.0f}ms")
+        for kind, site, n, t, op in hot:
+            flag = " ⚠️ N+1" if n >= _NPLUS1_THRESHOLD else ""
+            lines.append(f"    {kind} `{site}` ×{n} {t * 1000:.0f}ms `{op}`{flag}")
+    return "\n".join(lines)
+
+@bot.message_handler(commands=['spans'], chat_types=['private'])
+def spans_command(message):
+    if message.from_user.id != OWNER_ID:
+        return
+    text = _render_spans()
+    bot.send_message(message.chat.id, text[:4000], parse_mode='Markdown')
+
+_instrument_handlers()
+
+
 # ─────────────────────────────────────────────────────────────────────────────
 #  FLASK WEBHOOK
 # ─────────────────────────────────────────────────────────────────────────────
@@ -4955,53 +6631,555 @@ def check_message(message):
 def index():
     return ''
 
+# ─── Update ingestion ────────────────────────────────────────────────────────
+# The webhook only validates, enqueues and acks. Updates are sharded by chat
+# onto UPDATE_WORKERS single-threaded queues: one chat's updates stay in
+# order, different chats run in parallel, and a full shard answers 503 so
+# Telegram retries later instead of the request hanging.
+_UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', 8))
+_UPDATE_QUEUE_SIZE = int(os.environ.get('UPDATE_QUEUE_SIZE', 200))
+_INGEST_PUT_TIMEOUT = 2
+_ingest_queues = [queue.Queue(maxsize=_UPDATE_QUEUE_SIZE) for _ in range(_UPDATE_WORKERS)]
+
+def _update_chat_key(data):
+    for kind in ('message', 'edited_message', 'my_chat_member', 'chat_member', 'chat_join_request'):
+        obj = data.get(kind)
+        if obj and obj.get('chat'):
+            return obj['chat']['id']
+    cq = data.get('callback_query')
+    if cq:
+        chat = (cq.get('message') or {}).get('chat') or {}
+        return chat.get('id') or cq['from']['id']
+    return data.get('update_id', 0)
+
+def _process_update(data):
+    update = telebot.types.Update.de_json(data)
+    _record_webhook_lag(update)
+    _begin_update_trace(update)
+    try:
+        bot.process_new_updates([update])
+    except Exception as e:
+        print(f"Update error: {str(e)}")
+    finally:
+        _end_update_trace()
+
+def _ingest_worker(q):
+    while True:
+        received, data = q.get()
+        observe_latency('update_queue_wait_seconds', time.time() - received)
+        try:
+            _process_update(data)
+        except Exception as e:
+            logger.error(f"[INGEST] Update failed: {e}")
+        finally:
+            q.task_done()
+
+_ingest_threads = [threading.Thread(target=_ingest_worker, args=(q,), daemon=True) for q in _ingest_queues]
+
+def _ingest_pending():
+    return sum(q.unfinished_tasks for q in _ingest_queues)
+
+# ─── Fast-path prefilter ─────────────────────────────────────────────────────
+# Most group traffic is plain chatter no handler acts on. This decides from
+# the raw JSON whether any handler could apply, so those updates never reach
+# Update.de_json, the dedup claim or a worker. Anything unrecognised goes
+# through the full path.
+_LINK_RE = re.compile(r'https?://[^\s]+')
+
+def _needs_dispatch(data):
+    for kind, handlers in (('edited_message', bot.edited_message_handlers),
+                           ('channel_post', bot.channel_post_handlers),
+                           ('edited_channel_post', bot.edited_channel_post_handlers)):
+        if kind in data:
+            return bool(handlers)
+    msg = data.get('message')
+    if not msg or (msg.get('chat') or {}).get('type') not in ('group', 'supergroup'):
+        return True
+    if 'new_chat_members' in msg or 'left_chat_member' in msg:
+        return True
+    text = msg.get('text')
+    if text is None:
+        return False   # group message handlers only take text (and the service messages above)
+    if text.lstrip().startswith('/') or (msg.get('from') or {}).get('id') == OWNER_ID:
+        return True
+    if _LINK_RE.search(text):
+        return False   # has a link — the link-only filter keeps it
+    return is_link_only(msg['chat']['id'])
+
+# ─── Update dedup ────────────────────────────────────────────────────────────
+# Telegram re-delivers an update it thinks timed out. A local LRU answers
+# repeats seen by this process for free; SET NX on update_seen:{id} is the
+# claim shared with other workers and the overlapping instance of a deploy.
+_UPDATE_DEDUP_SIZE = 10000
+_UPDATE_DEDUP_TTL = 3600           # Telegram gives up retrying well within this
+_seen_updates = OrderedDict()
+_seen_updates_lock = threading.Lock()
+
+def _claim_update(update_id):
+    """True if this update is new and ours to handle. A claimed update that
+    then cannot be queued must be handed back with _release_update(), or
+    Telegram's retry would be dropped as a duplicate."""
+    if update_id is None:
+        return True
+    with _seen_updates_lock:
+        if update_id in _seen_updates:
+            return False
+        _seen_updates[update_id] = None
+        if len(_seen_updates) > _UPDATE_DEDUP_SIZE:
+            _seen_updates.popitem(last=False)
+    try:
+        return bool(r.set(f'update_seen:{update_id}', 1, nx=True, ex=_UPDATE_DEDUP_TTL))
+    except Exception:
+        return True  # fail open: a rare duplicate beats a dropped update
+
+def _release_update(update_id):
+    """Undo a claim for an update we could not queue, so its retry gets through."""
+    with _seen_updates_lock:
+        _seen_updates.pop(update_id, None)
+    try:
+        r.delete(f'update_seen:{update_id}')
+    except Exception:
+        pass
+
+def _ingest_update(data, received, block=False):
+    """Prefilter, dedup and queue one raw update (webhook or getUpdates).
+    Returns False only if the update could not be queued."""
+    if not _needs_dispatch(data):
+        record_metric('update_prefiltered')
+        return True
+    update_id = data.get('update_id')
+    if not _claim_update(update_id):
+        record_metric('update_duplicate')
+        return True
+    shard = _ingest_queues[hash(_update_chat_key(data)) % len(_ingest_queues)]
+    try:
+        shard.put((received, data), timeout=None if block else _INGEST_PUT_TIMEOUT)
+    except queue.Full:
+        _release_update(update_id)
+        return False
+    return True
+
 @app.route('/', methods=['POST'])
 def webhook_handler():
     if request.headers.get('content-type') == 'application/json':
-        json_string = request.get_data().decode('utf-8')
-        update = telebot.types.Update.de_json(json_string)
+        if _shutting_down.is_set():
+            return '', 503  # Telegram redelivers to the next instance
+        started = time.time()
         try:
-            bot.process_new_updates([update])
-        except Exception as e:
-            print(f"Update error: {str(e)}")
-        return ''
+            data = json_loads(request.get_data())
+        except ValueError:
+            abort(400)
+        if not _ingest_update(data, started):
+            logger.warning("[INGEST] Update queue full — asking Telegram to retry")
+            return '', 503
+        observe_latency('webhook_latency_seconds', time.time() - started)
+        return ''  # duplicates and prefiltered updates get 200 too, so Telegram stops retrying
     abort(403)
 
+# ─── Long polling ────────────────────────────────────────────────────────────
+# INGEST_MODE selects how updates arrive:
+#   webhook — the default
+#   polling — getUpdates; needs no public URL (local runs, load tests against
+#             a fake Bot API via TELEGRAM_API_URL)
+#   auto    — webhook, switching to polling while getWebhookInfo reports the
+#             endpoint failing; after a hold-off the webhook is set again
+#             and getWebhookInfo judges it the same way
+# Either way updates go through _ingest_update() into the same worker pool.
+# Only the leader process polls; Telegram allows one getUpdates consumer.
+_INGEST_MODE = os.environ.get('INGEST_MODE', 'webhook')
+_POLL_LIMIT = 100
+_POLL_TIMEOUT = 25
+_WEBHOOK_PROBE_INTERVAL = 60
+_WEBHOOK_ERROR_WINDOW = 180        # a delivery error this recent counts as failing
+_WEBHOOK_BACKLOG_LIMIT = 50        # ...while this many updates wait behind it
+_WEBHOOK_FAILBACK_AFTER = 600      # poll this long before retrying the webhook;
+_WEBHOOK_FAILBACK_MAX = 3600       # doubles up to here while retries keep failing
+_INGEST_STATE_KEY = 'ingest_failover'  # hash: mode, failed_over_at, restored_at, failback_after
+_polling_active = threading.Event()
+
+def _polling_worker():
+    offset = None
+    logger.info("[POLLING] getUpdates loop started")
+    while _polling_active.is_set() and not _shutting_down.is_set():
+        if not _is_leader.is_set():
+            time.sleep(5)  # another process holds the lock and does the polling
+            continue
+        try:
+            batch = telebot.apihelper.get_updates(TOKEN, offset, _POLL_LIMIT, timeout=_POLL_TIMEOUT + 10,
+                                                  long_polling_timeout=_POLL_TIMEOUT)
+        except Exception as e:
+            logger.error(f"[POLLING] getUpdates failed: {e}")
+            time.sleep(3)
+            continue
+        if _shutting_down.is_set():
+            break  # leave the batch unconfirmed for the next instance
+        received = time.time()
+        for data in batch:
+            # The next call's offset confirms this batch. Anything fetched but
+            # unconfirmed at a switch or restart is re-delivered and deduped.
+            offset = data['update_id'] + 1
+            _ingest_update(data, received, block=True)
+    logger.info("[POLLING] getUpdates loop stopped")
+
+def start_polling():
+    if _polling_active.is_set():
+        return
+    # getUpdates is refused while a webhook is set; pending updates are kept
+    bot.delete_webhook()
+    _polling_active.set()
+    threading.Thread(target=_polling_worker, daemon=True).start()
+
+def _webhook_failing(since=0):
+    """Telegram's own view of delivery: a recent error with a backlog behind
+    it. Errors from before `since` (the last switch back) are ignored."""
+    info = bot.get_webhook_info()
+    last_error = info.last_error_date or 0
+    recent_error = last_error > since and time.time() - last_error < _WEBHOOK_ERROR_WINDOW
+    return bool(recent_error and info.pending_update_count >= _WEBHOOK_BACKLOG_LIMIT), info
+
+def _ingest_watchdog():
+    """INGEST_MODE=auto: fail over to polling and back. Runs in every process
+    but acts only while leader; the failover state lives in Redis so the next
+    leader carries on where the last one stopped."""
+    while not _shutting_down.is_set():
+        time.sleep(_WEBHOOK_PROBE_INTERVAL)
+        try:
+            if not _is_leader.is_set():
+                if _polling_active.is_set():
+                    # Stop our poller; the webhook is left as it is for the new leader
+                    logger.info("[POLLING] No longer leader — leaving ingestion to the new leader")
+                    _polling_active.clear()
+                continue
+            state = r.hgetall(_INGEST_STATE_KEY)
+            failed_over_at = float(state.get('failed_over_at') or 0)
+            restored_at = float(state.get('restored_at') or 0)
+            failback_after = int(state.get('failback_after') or _WEBHOOK_FAILBACK_AFTER)
+            if state.get('mode') != 'polling':
+                failing, info = _webhook_failing(since=restored_at)
+                if failing:
+                    if restored_at and time.time() - restored_at < failback_after:
+                        failback_after = min(failback_after * 2, _WEBHOOK_FAILBACK_MAX)
+                    else:
+                        failback_after = _WEBHOOK_FAILBACK_AFTER
+                    logger.warning(f"[POLLING] Webhook failing ({info.last_error_message}, "
+                                   f"{info.pending_update_count} pending) — switching to getUpdates "
+                                   f"for {failback_after}s")
+                    start_polling()
+                    r.hset(_INGEST_STATE_KEY, mapping={
+                        'mode': 'polling', 'failed_over_at': time.time(), 'failback_after': failback_after,
+                    })
+                    _diag_alert([('webhook_delivery', False,
+                                  f"Webhook failing ({info.last_error_message}); switched to long polling")])
+            elif time.time() - failed_over_at >= failback_after:
+                logger.info("[POLLING] Hold-off over — setting the webhook again")
+                _polling_active.clear()
+                bot.set_webhook(WEBHOOK_URL)
+                r.hset(_INGEST_STATE_KEY, mapping={'mode': 'webhook', 'restored_at': time.time()})
+                _diag_alert([('webhook_delivery', True, "Webhook set again; long polling stopped")])
+            elif not _polling_active.is_set():
+                logger.info("[POLLING] Taking over the webhook failover from the previous leader")
+                start_polling()
+        except Exception as e:
+            logger.error(f"[POLLING] Watchdog error: {e}")
+
+def _render_prometheus():
+    """Prometheus text exposition (format 0.0.4) of the bot's hot paths."""
+    out = []
+
+    def gauge(name, value, help_text):
+        out.append(f"# HELP minibot_{name} {help_text}")
+        out.append(f"# TYPE minibot_{name} gauge")
+        out.append(f"minibot_{name} {value}")
+
+    with _send_queue_lock:
+        per_priority = {}
+        for item in _send_queue:
+            per_priority[int(item[0])] = per_priority.get(int(item[0]), 0) + 1
+        depth = len(_send_queue)
+    gauge('send_queue_depth', depth, 'Messages waiting in the send queue.')
+    gauge('update_queue_depth', _ingest_pending(), 'Webhook updates received but not yet handled.')
+    gauge('ingest_polling', int(_polling_active.is_set()), '1 while updates arrive via getUpdates.')
+    out.append("# TYPE minibot_send_queue_depth_by_priority gauge")
+    for prio, n in sorted(per_priority.items()):
+        out.append(f'minibot_send_queue_depth_by_priority{{priority="{prio}"}} {n}')
+    gauge('active_repeat_tasks', sum(1 for t in active_repeat_threads.values() if t.is_alive()),
+          'Per-group repeat threads currently alive.')
+    gauge('threads', threading.active_count(), 'Python threads in this process.')
+    out.append("# TYPE minibot_info gauge")
+    out.append(f'minibot_info{{json_codec="{JSON_CODEC}"}} 1')
+    try:
+        gauge('process_rss_bytes', psutil.Process().memory_info().rss, 'Resident set size.')
+    except Exception:
+        pass
+    try:
+        started = time.time()
+        r.ping()
+        gauge('redis_rtt_seconds', round(time.time() - started, 6), 'Redis PING round-trip time.')
+    except Exception:
+        gauge('redis_up', 0, 'Whether the last Redis PING succeeded.')
+    else:
+        gauge('redis_up', 1, 'Whether the last Redis PING succeeded.')
+
+    with _metrics_lock:
+        totals = dict(_metric_totals)
+    out.append("# HELP minibot_events_total Events counted since process start.")
+    out.append("# TYPE minibot_events_total counter")
+    for metric, n in sorted(totals.items()):
+        if not metric.startswith('queue_'):
+            out.append(f'minibot_events_total{{event="{metric}"}} {n}')
+    out.append("# TYPE minibot_flood_wait_total counter")
+    out.append(f"minibot_flood_wait_total {_flood_wait_counter}")
+
+    with _handler_stats_lock:
+        handler_stats = {k: list(v) for k, v in _handler_stats.items()}
+    for metric, idx, help_text in (('handler_redis_seconds_total', 2, 'Redis time inside each handler.'),
+                                   ('handler_api_seconds_total', 3, 'Telegram API time inside each handler.')):
+        out.append(f"# HELP minibot_{metric} {help_text}")
+        out.append(f"# TYPE minibot_{metric} counter")
+        for label, st in sorted(handler_stats.items()):
+            out.append(f'minibot_{metric}{{handler="{label}"}} {round(st[idx], 6)}')
+
+    with _histograms_lock:
+        hists = {k: (list(v[0]), v[1], v[2]) for k, v in _histograms.items()}
+    typed = set()
+    for (name, labels), (buckets, total, count) in sorted(hists.items()):
+        if name not in typed:
+            out.append(f"# TYPE minibot_{name} histogram")
+            typed.add(name)
+        sep = ',' if labels else ''
+        cumulative = 0
+        for bound, n in zip(_LATENCY_BUCKETS, buckets):
+            cumulative += n
+            out.append(f'minibot_{name}_bucket{{{labels}{sep}le="{bound}"}} {cumulative}')
+        out.append(f'minibot_{name}_bucket{{{labels}{sep}le="+Inf"}} {count}')
+        suffix = f'{{{labels}}}' if labels else ''
+        out.append(f"minibot_{name}_sum{suffix} {round(total, 6)}")
+        out.append(f"minibot_{name}_count{suffix} {count}")
+    return "\n".join(out) + "\n"
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    if METRICS_TOKEN:
+        supplied = request.args.get('token') or request.headers.get('Authorization', '').replace('Bearer ', '', 1)
+        if supplied != METRICS_TOKEN:
+            abort(403)
+    return Response(_render_prometheus(), mimetype='text/plain; version=0.0.4')
+
 
 # ─────────────────────────────────────────────────────────────────────────────
 #  STARTUP
 # ─────────────────────────────────────────────────────────────────────────────
 
-if __name__ == '__main__':
-    # CRITICAL: Remove old global flood key that causes freezes
-    r.delete('api_retry_after')
-    r.delete('groups_with_errors')
+_initialized = False
+_init_lock = threading.Lock()
 
-    bot.remove_webhook()
-    time.sleep(1)
-    bot.set_webhook(WEBHOOK_URL)
+def _startup_step(name, fn, attempts=3):
+    """Run one startup step; retry transient failures, never crash startup."""
+    for attempt in range(1, attempts + 1):
+        try:
+            return fn()
+        except Exception as e:
+            logger.error(f"[STARTUP] {name} failed (attempt {attempt}/{attempts}): {e}")
+            if attempt < attempts:
+                time.sleep(2 ** attempt)
 
-    # Register bot command menu (visible when user types /)
-    try:
-        bot.set_my_commands([
-            types.BotCommand('start',   'Open main menu'),
-            types.BotCommand('stats',   'Bot statistics'),
-            types.BotCommand('backup',  'Backup Redis data now'),
-            types.BotCommand('restore', 'Restore Redis from backup file'),
-            types.BotCommand('recover', 'Re-register groups after data wipe'),
-            types.BotCommand('cancel',  'Cancel current operation'),
-        ])
-    except Exception as e:
-        logger.error(f"[STARTUP] set_my_commands failed: {e}")
+def _register_webhook():
+    if _INGEST_MODE == 'polling' or not WEBHOOK_URL:
+        return
+    # set_webhook swaps the URL in place. Removing it first opened a window in
+    # which Telegram had nowhere to deliver updates; left alone, it queues them
+    # until the new instance answers.
+    if bot.get_webhook_info().url != WEBHOOK_URL:
+        bot.set_webhook(WEBHOOK_URL)
 
-    # Restart any active per-group repeat tasks
-    for g in get_groups():
-        start_repeat_thread(g)
+def _register_commands():
+    # Register bot command menu (visible when user types /)
+    bot.set_my_commands([
+        types.BotCommand('start',   'Open main menu'),
+        types.BotCommand('stats',   'Bot statistics'),
+        types.BotCommand('backup',  'Backup Redis data now'),
+        types.BotCommand('restore', 'Restore Redis from backup file'),
+        types.BotCommand('recover', 'Re-register groups after data wipe'),
+        types.BotCommand('slow',    'Slowest recent updates'),
+        types.BotCommand('spans',   'Slow Redis/API calls (TRACE_SPANS)'),
+        types.BotCommand('cancel',  'Cancel current operation'),
+    ])
+
+def _clear_stale_flags():
+    # CRITICAL: Remove old global flood key that causes freezes
+    r.delete('api_retry_after', 'groups_with_errors')
+    _fold_legacy_group_errors()
+    _rebuild_group_health_index()
 
+def _restart_repeats():
+    # Restart any active per-group repeat tasks without a thundering herd
+    _warm_start_repeats()
     # Restart global repeat if it was running before redeploy
     start_global_repeat_thread()
 
+_DRAIN_TIMEOUT = int(os.environ.get('DRAIN_TIMEOUT', 20))
+
+def shutdown():
+    """
+    Graceful drain for deploys. The webhook starts answering 503 and new sends
+    are parked in Redis straight away; already-accepted updates are handled,
+    the queue gets up to DRAIN_TIMEOUT seconds to empty, whatever is left is
+    parked too, and broadcast jobs stop at their checkpoint. Scheduled deletes
+    already live in Redis. init() on the next instance picks all of it up.
+    """
+    if _shutting_down.is_set():
+        return
+    _shutting_down.set()
+    logger.info(f"[SHUTDOWN] Draining updates and send queue (up to {_DRAIN_TIMEOUT}s)")
+    deadline = time.time() + _DRAIN_TIMEOUT
+    while time.time() < deadline and _ingest_pending():
+        time.sleep(0.2)
+    while time.time() < deadline:
+        with _send_queue_lock:
+            if not _send_queue:
+                break
+        time.sleep(0.2)
+
+    _send_worker_stop.set()
+    _send_queue_event.set()
+    if _send_worker_thread.is_alive():
+        _send_worker_stopped.wait(10)
+    with _send_queue_lock:
+        queued = sorted(_send_queue, key=lambda i: i[:2])
+        _send_queue.clear()
+    leftover = [(p, c, t, m) for p, _, c, t, _, m, park in queued if park]
+    for item in queued:
+        if item[4] is not None:
+            item[4].append(None)   # wake callers still waiting on it
+    try:
+        _persist_sends(leftover)
+    except Exception as e:
+        logger.error(f"[SHUTDOWN] Could not park {len(leftover)} queued send(s): {e}")
+    try:
+        _flush_metrics()
+    except Exception:
+        pass
+    _release_leadership()
+    logger.info(f"[SHUTDOWN] {len(leftover)} queued send(s) parked for the next instance")
+
+def _handle_sigterm(signum, frame):
+    shutdown()
+    sys.exit(0)
+
+# ─── Singleton background jobs ───────────────────────────────────────────────
+# Repeat scheduling, backups, scheduled deletes, parked-send and broadcast
+# resumption must run once per deployment, not once per gunicorn worker or
+# per overlapping instance during a rolling deploy. Each process runs a
+# leader loop; whoever holds the 'bg_leader' lock runs them, and a follower
+# takes over when the leader's lock expires or is released on shutdown.
+_LEADER_KEY = 'bg_leader'
+_LEADER_TTL = 30
+_LEADER_RENEW_INTERVAL = 10
+_LEADER_RECONCILE_INTERVAL = 60
+_leader_token = f"{os.getpid()}:{time.time()}"
+_is_leader = threading.Event()
+_singleton_jobs_started = False
+
+# Compare-and-act on a lock in one step, so a renewal or release can never
+# touch a lock another process took after ours expired. Also used for the
+# per-job broadcast owner lock.
+_expire_if_owner = r.register_script(
+    "if redis.call('get', KEYS[1]) == ARGV[1] then "
+    "return redis.call('expire', KEYS[1], ARGV[2]) else return 0 end")
+_delete_if_owner = r.register_script(
+    "if redis.call('get', KEYS[1]) == ARGV[1] then "
+    "return redis.call('del', KEYS[1]) else return 0 end")
+
+def _start_singleton_jobs(register_webhook):
+    # Once per process: the delete, backup and polling loops idle while not
+    # leader, so regaining the lock just resumes them.
+    global _singleton_jobs_started
+    if _singleton_jobs_started:
+        return
+    _singleton_jobs_started = True
+    _startup_step('clear stale flags', _clear_stale_flags)
+    _startup_step('user registry migration', _migrate_legacy_user_registry)
+    _startup_step('first-seen index', _ensure_first_seen_index)
+    if register_webhook:
+        _startup_step('webhook', _register_webhook)
+        _startup_step('set_my_commands', _register_commands, attempts=1)
+    _delete_scheduler_thread.start()
     # Start auto-backup thread
     start_backup_thread()
+    if _INGEST_MODE == 'polling' or (_INGEST_MODE == 'auto' and not WEBHOOK_URL):
+        _startup_step('long polling', start_polling)
+    elif _INGEST_MODE == 'auto':
+        threading.Thread(target=_ingest_watchdog, daemon=True).start()
+
+def _on_leadership_acquired(register_webhook):
+    _start_singleton_jobs(register_webhook)
+    # Every acquisition: repeat threads and broadcast runners stop as soon as
+    # this process loses the lock, so each new term starts them again.
+    _startup_step('parked sends', _resume_pending_sends)
+    _startup_step('broadcast jobs', _resume_broadcast_jobs)
+    _startup_step('repeat threads', _restart_repeats)
+
+def _leader_worker(register_webhook):
+    last_reconcile = time.time()
+    while not _shutting_down.is_set():
+        try:
+            if _is_leader.is_set():
+                if not _expire_if_owner(keys=[_LEADER_KEY], args=[_leader_token, _LEADER_TTL]):
+                    logger.error("[LEADER] Lost the background-job lock to another process")
+                    _is_leader.clear()
+                elif time.time() - last_reconcile >= _LEADER_RECONCILE_INTERVAL:
+                    last_reconcile = time.time()
+                    _reconcile_repeats()
+                    _resume_broadcast_jobs(notify=False)
+            elif r.set(_LEADER_KEY, _leader_token, nx=True, ex=_LEADER_TTL):
+                _is_leader.set()
+                last_reconcile = time.time()
+                logger.info(f"[LEADER] pid {os.getpid()} runs the singleton background jobs")
+                _on_leadership_acquired(register_webhook)
+        except Exception as e:
+            logger.error(f"[LEADER] {e}")
+        time.sleep(_LEADER_RENEW_INTERVAL if _is_leader.is_set() else _LEADER_RENEW_INTERVAL / 2)
+
+def _release_leadership():
+    try:
+        if _is_leader.is_set():
+            _is_leader.clear()
+            _delete_if_owner(keys=[_LEADER_KEY], args=[_leader_token])
+    except Exception:
+        pass
+
+def init(register_webhook=True, install_signal_handler=True):
+    """
+    Application factory. Importing this module does no network I/O; this
+    writes defaults, starts the per-process workers and the leader loop that
+    runs singleton jobs (migrations, webhook, repeats, backups) in exactly
+    one process. Safe to call more than once.
+    """
+    global _initialized
+    with _init_lock:
+        if _initialized:
+            return app
+        _initialized = True
+
+    _startup_step('defaults', _write_defaults)
+
+    # Per-process: each process drains its own queues and caches
+    _send_worker_thread.start()
+    _heartbeat_thread.start()
+    _metrics_thread.start()
+    for t in _ingest_threads:
+        t.start()
+    # Redis-assisted invalidation for config caches (falls back to TTLs)
+    start_client_tracking()
+
+    threading.Thread(target=_leader_worker, args=(register_webhook,), daemon=True).start()
+    if install_signal_handler:
+        try:
+            signal.signal(signal.SIGTERM, _handle_sigterm)
+        except ValueError:
+            pass  # not the main thread — the host server owns signal handling
+    return app
 
+if __name__ == '__main__':
+    init()
     app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))